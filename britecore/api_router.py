@@ -1,7 +1,9 @@
 from django.conf import settings
+from django.urls import path
 from rest_framework.routers import DefaultRouter, SimpleRouter
 
-from insurance.api.views import RiskViewSet, RiskAndFieldsViewSet
+from insurance.api.views import RiskViewSet, RiskAndFieldsViewSet, RecordViewSet, CatalogView
+from insurance.api import async_views
 
 if settings.DEBUG:
     router = DefaultRouter()
@@ -10,7 +12,13 @@ else:
 
 router.register("risks", RiskViewSet)
 router.register("risks-fields", RiskAndFieldsViewSet)
+router.register(r"risks/(?P<risk_id>\d+)/records", RecordViewSet, basename="risk-records")
 
 
 app_name = "api"
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path("catalog/", CatalogView.as_view(), name="catalog"),
+    # Non-blocking versions of the hot endpoints, for the ASGI application
+    path("async/risks-fields/", async_views.risk_list, name="async-risks-fields-list"),
+    path("async/risks/<int:risk_id>/records/", async_views.record_list, name="async-risk-records-list"),
+]
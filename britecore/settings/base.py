@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 import os
+import time
 from dotenv import load_dotenv, find_dotenv
 
 # Load .env
@@ -40,15 +41,14 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
-    'insurance',
+    'insurance.apps.InsuranceConfig',
     'rest_framework',
     'corsheaders',
     'django_s3_storage',
-
-    'django_extensions'
 ]
 
 MIDDLEWARE = [
+    'insurance.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -115,6 +115,41 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# The tables of the risks go to the database alias and PostgreSQL schema of
+# their risk, see insurance.placement. Aliases holding risk tables only are
+# added to DATABASES, the metadata stay in the default one
+DATABASE_ROUTERS = ['insurance.placement.PlacementRouter']
+
+# Build every dynamic model when the app is ready: '' (lazily on first use),
+# 'build' (from the database) or 'snapshot' (from INSURANCE_SCHEMA_SNAPSHOT,
+# written by the dump_schema_snapshot command, or the database when stale)
+INSURANCE_BOOTSTRAP = os.getenv('INSURANCE_BOOTSTRAP', '')
+
+INSURANCE_SCHEMA_SNAPSHOT = os.path.join(BASE_DIR, 'schema_snapshot.json')
+
+# How a worker learns about the schema changes of the other workers to evict
+# their models: '' (single process), 'listen' (a thread LISTENing to the NOTIFY
+# events, e.g. gunicorn) or 'poll' (the change log, at most every
+# INSURANCE_SCHEMA_POLL_INTERVAL seconds when a request starts, e.g. Lambda)
+INSURANCE_SCHEMA_EVENTS = os.getenv('INSURANCE_SCHEMA_EVENTS', '')
+
+INSURANCE_SCHEMA_POLL_INTERVAL = 1.0
+
+# Start of the cold start import timing reported by the bootstrap
+INSURANCE_SETTINGS_LOADED_AT = time.perf_counter()
+
+# Seconds the results of the record aggregation endpoint are cached, 0 disables the cache
+AGGREGATION_CACHE_TIMEOUT = 0
+
+# Database connections of the async API views per event loop, see insurance.async_db
+INSURANCE_ASYNC_POOL_SIZE = 10
+
+# Addresses allowed to read /metrics/
+INSURANCE_METRICS_ALLOWED_IPS = os.getenv('INSURANCE_METRICS_ALLOWED_IPS', '127.0.0.1').split(',')
+
+# Requests slower than this many seconds are logged with their SQL, 0 disables the log
+INSURANCE_SLOW_REQUEST_SECONDS = float(os.getenv('INSURANCE_SLOW_REQUEST_SECONDS', '0'))
+
 # CORS_ORIGIN_WHITELIST = ('*')
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
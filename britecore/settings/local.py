@@ -1,5 +1,8 @@
 from .base import *
 
+# Development tools, kept out of the cold start of the deployed app
+INSTALLED_APPS += ['django_extensions']
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('SECRET_KEY')
 
@@ -30,6 +30,12 @@ DATABASES = {
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
 
+# Lambda cold starts build the dynamic models from the snapshot shipped with the package
+INSURANCE_BOOTSTRAP = os.getenv('INSURANCE_BOOTSTRAP', 'snapshot')
+
+# Frozen between invocations, a Lambda worker can not keep a listener thread
+INSURANCE_SCHEMA_EVENTS = os.getenv('INSURANCE_SCHEMA_EVENTS', 'poll')
+
 S3_BUCKET = "zappa-s03n0s46k"
 
 STATICFILES_STORAGE = "django_s3_storage.storage.StaticS3Storage"
@@ -20,6 +20,7 @@ from insurance import views
 urlpatterns = [
     path('admin/', admin.site.urls, name='admin'),
     path("api/v1/", include("britecore.api_router")),
+    path('metrics/', views.metrics, name='metrics'),
 ]
 
 handler500 = 'insurance.views.handler500'
@@ -1,13 +1,13 @@
 from django.contrib import admin
-from .models import RiskField, Risk, EnumChoice
+from .models import RiskField, Risk, EnumChoice, SchemaVersion, SchemaChange
 from .model_utils import SchemaBuilder
-from .forms import RiskFieldForm
-from django.apps import apps
+from .forms import RiskFieldForm, RiskFieldFormSet
 
 
 class RiskFieldLine(admin.TabularInline):
     model = RiskField
     form = RiskFieldForm
+    formset = RiskFieldFormSet
     extra = 1
 
 
@@ -16,31 +16,29 @@ class RiskAdmin(admin.ModelAdmin):
     inlines = (RiskFieldLine,)
     list_display = ['name']
 
+    def get_readonly_fields(self, request, obj=None):
+        # The records are not moved between storages or partitionings, tables
+        # are moved between databases and schemas by the move_risk command
+        return ('storage', 'partitioning', 'database', 'db_schema') if obj is not None else ()
+
     def save_related(self, request, form, formsets, change):
-        # This allows database table to be created at once with all data needed
-        super().save_related(request, form, formsets, change)
-        if not change:
-            risk = form.instance
-            model = risk.get_django_model()
-            builder = SchemaBuilder(model)
-            builder.create_db_table()
+        # This allows database table to be created at once with all data needed.
+        # On change, the field adds, renames, alters and drops of the inlines are
+        # applied together with a single model rebuild
+        with SchemaBuilder.change_set(form.instance, create_table=not change):
+            super().save_related(request, form, formsets, change)
 
     def delete_model(self, request, obj):
-        # Remove table from database when delete from admin change view
-        model = obj.get_django_model()
-        del apps.all_models[obj._meta.app_label][obj.get_model_name]
-        builder = SchemaBuilder(model)
-        builder.delete_model()
+        # Remove table from database when delete from admin change view, see Risk.delete
         super().delete_model(request, obj)
 
     def delete_queryset(self, request, queryset):
         # Remove table from database when delete from admin list view
+        tombstones = [SchemaChange(action=SchemaChange.DELETED, risk_id=obj.id) for obj in queryset]
         for obj in queryset:
-            model = obj.get_django_model()
-            del apps.all_models[obj._meta.app_label][obj.get_model_name]
-            builder = SchemaBuilder(model)
-            builder.delete_model()
+            obj.drop_django_model()
         super().delete_model(request, queryset)
+        SchemaVersion.bump(changes=tombstones)
 
 
 @admin.register(EnumChoice)
@@ -0,0 +1,153 @@
+import hashlib
+import re
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Aggregate, Avg, Count, DateField, FloatField, IntegerField, Max, Min, Q, Sum
+from django.db.models.functions import Trunc
+from .queries import QueryError
+from .documents import record_fields
+from .enums import EnumField
+
+BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+FUNCTIONS = {'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max}
+PERCENTILE = re.compile(r'^p(\d{1,2}(\.\d+)?)$')
+
+
+class Percentile(Aggregate):
+    # Continuous percentile of PostgreSQL, e.g. p90 is PERCENTILE_CONT(0.9)
+    function = 'PERCENTILE_CONT'
+    name = 'Percentile'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+class RecordAggregation:
+    """
+    Grouped statistics of the records of a dynamic model, computed by the
+    database in a single GROUP BY query:
+
+    * ``group_by`` field names; a DateField is bucketed with ``name:bucket``,
+      the bucket being one of day, week, month, quarter or year
+    * ``metrics`` ``count`` or ``function:field`` on an IntegerField, the
+      function being sum, avg, min, max or a percentile like p50 or p99.9
+    * ``where`` a Q filter on the records, e.g. the one of a RecordQuery
+
+    Result rows hold the group values and one key per metric, e.g.
+    ``{'date_bought_month': ..., 'count': 3, 'avg_no_seats': 2.5}``. A key
+    that is the name of a field, or of another group or metric, is rejected.
+    """
+
+    def __init__(self, model, group_by=(), metrics=('count',), where=Q()):
+        self.model = model
+        self.fields = {field.name: field for field in record_fields(model)}
+        self.where = where
+        errors = {}
+        try:
+            self.groups = dict(self.get_group(item) for item in group_by)
+        except QueryError as err:
+            errors['group_by'] = err.errors
+        try:
+            self.metrics = dict(self.get_metric(item) for item in metrics or ('count',))
+        except QueryError as err:
+            errors['metrics'] = err.errors
+        if errors:
+            raise QueryError(errors)
+        # The keys are annotations of the query, which can not shadow a field or each other
+        buckets = [key for key, expression in self.groups.items() if expression is not None]
+        for param, keys, taken in (('group_by', buckets, set(self.fields)),
+                                   ('metrics', list(self.metrics), set(self.fields) | set(self.groups))):
+            clashes = [key for key in keys if key in taken]
+            if clashes:
+                errors[param] = [f"Result key clashes with a field or group: {key}" for key in clashes]
+        if errors:
+            raise QueryError(errors)
+
+    def get_field(self, name):
+        if name not in self.fields:
+            raise QueryError([f"Unknown field: {name}"])
+        return self.fields[name]
+
+    def get_group(self, item):
+        name, _, bucket = item.partition(':')
+        field = self.get_field(name)
+        if not bucket:
+            return name, None
+        if not isinstance(field, DateField):
+            raise QueryError([f"Only date fields have buckets: {name}"])
+        if bucket not in BUCKETS:
+            raise QueryError([f"Unknown bucket: {bucket}. Use one of: {', '.join(BUCKETS)}"])
+        return f'{name}_{bucket}', Trunc(name, bucket, output_field=DateField())
+
+    def get_metric(self, item):
+        if item == 'count':
+            return 'count', Count('pk')
+        function, _, name = item.partition(':')
+        field = self.get_field(name)
+        # Enums are stored as integer codes but are not numbers
+        if not isinstance(field, IntegerField) or isinstance(field, EnumField) or name == 'id':
+            raise QueryError([f"Only number fields can be aggregated: {name}"])
+        if function in FUNCTIONS:
+            return f'{function}_{name}', FUNCTIONS[function](name)
+        match = PERCENTILE.match(function)
+        if match is None:
+            raise QueryError([f"Unknown metric: {function}. Use count, {', '.join(FUNCTIONS)} or p<percent>"])
+        if connection.vendor != 'postgresql':
+            raise QueryError(['Percentiles need PostgreSQL.'])
+        return f"{function.replace('.', '_')}_{name}", Percentile(name, float(match.group(1)) / 100)
+
+    def get_queryset(self):
+        queryset = self.model.objects.filter(self.where)
+        buckets = {key: expression for key, expression in self.groups.items() if expression is not None}
+        return queryset.annotate(**buckets).values(*self.groups).annotate(**self.metrics).order_by(*self.groups)
+
+    def get_cache_key(self, risk_id):
+        # The filter SQL holds the table and the filter values, the keys name the groups and metrics
+        query = self.model.objects.filter(self.where).query
+        digest = hashlib.md5(f'{query}|{list(self.groups)}|{list(self.metrics)}'.encode()).hexdigest()
+        return f'insurance:aggregation:{risk_id}:{get_records_version(risk_id)}:{digest}'
+
+    def execute(self):
+        if not self.groups:
+            return [self.model.objects.filter(self.where).aggregate(**self.metrics)]
+        return list(self.get_queryset())
+
+
+def get_records_version_key(risk_id):
+    return f'insurance:records:{risk_id}:version'
+
+
+def get_records_version(risk_id):
+    return cache.get_or_set(get_records_version_key(risk_id), uuid.uuid4().hex, None)
+
+
+def bump_records_version(risk_id):
+    cache.set(get_records_version_key(risk_id), uuid.uuid4().hex, None)
+
+
+def records_changed(risk_id):
+    "Invalidates the cached aggregations of a risk"
+    bump_records_version(risk_id)
+    # A reader may cache the old rows again until the write commits
+    transaction.on_commit(lambda: bump_records_version(risk_id))
+
+
+def aggregate_records(risk_id, aggregation):
+    """
+    Returns the rows of an aggregation, from the cache when
+    AGGREGATION_CACHE_TIMEOUT is set. Cached rows are keyed by a version of
+    the records of the risk that the record writes change.
+    """
+    timeout = getattr(settings, 'AGGREGATION_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return aggregation.execute()
+    key = aggregation.get_cache_key(risk_id)
+    rows = cache.get(key)
+    if rows is None:
+        rows = aggregation.execute()
+        cache.set(key, rows, timeout)
+    return rows
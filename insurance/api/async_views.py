@@ -0,0 +1,200 @@
+import functools
+import json
+from calendar import timegm
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound, ParseError, ValidationError
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.validators import UniqueValidator
+from insurance.models import Risk, RiskField, EnumChoice, SchemaVersion
+from insurance.model_cache import model_cache
+from insurance.async_db import fetch, fetch_rows, insert
+from insurance.queries import RecordQuery, QueryError
+from insurance.aggregations import bump_records_version
+from insurance.documents import record_fields
+from insurance.enums import EnumField, get_codes_queryset, is_text_enum
+from insurance.api.serializers import RiskAndFieldsSerializer, get_record_serializer
+from insurance.api.pagination import RiskCursorPagination, RecordKeysetPagination
+from insurance.api.views import RecordViewSet, schema_etag, schema_last_modified
+
+
+def async_api(*methods):
+    """
+    Turns an async function into an API view for the ASGI application,
+    answering DRF exceptions the way DRF does
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                                    status=status.HTTP_405_METHOD_NOT_ALLOWED)
+            try:
+                return await view(request, *args, **kwargs)
+            except APIException as err:
+                data = err.detail if isinstance(err.detail, (list, dict)) else {'detail': err.detail}
+                response = JsonResponse(data, status=err.status_code, safe=False, encoder=JSONEncoder)
+                if getattr(err, 'auth_header', None):
+                    response['WWW-Authenticate'] = err.auth_header
+                return response
+        # Session authenticated writes are checked for CSRF in authenticate(), like DRF views
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def async_schema_condition(view):
+    """
+    schema_condition for the async views of the whole catalog, answering 304
+    Not Modified from the catalog version read without blocking
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # Read by schema_etag() and schema_last_modified() instead of a blocking query, see get_schema_version()
+        rows = await fetch_rows(SchemaVersion.objects.filter(pk=1).values_list('version', 'updated_at'))
+        request._schema_version = rows[0] if rows else (0, None)
+        etag, updated_at = schema_etag(request), schema_last_modified(request)
+        last_modified = timegm(updated_at.utctimetuple()) if updated_at else None
+        # As django.views.decorators.http.condition
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await view(request, *args, **kwargs)
+            if last_modified and not response.has_header('Last-Modified'):
+                response['Last-Modified'] = http_date(last_modified)
+            if etag:
+                response.setdefault('ETag', etag)
+        return response
+    return wrapper
+
+
+async def authenticate(request):
+    "Authenticates a write with the DRF authentication classes, see IsAuthenticatedOrReadOnly"
+    drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    # Sessions and users are only synchronous in this Django version, this is the one thread hop of a write
+    user = await sync_to_async(lambda: drf_request.user)()
+    if user is None or not user.is_authenticated:
+        err = NotAuthenticated()
+        authenticators = drf_request.authenticators
+        err.auth_header = authenticators[0].authenticate_header(drf_request) if authenticators else None
+        if not err.auth_header:
+            err.status_code = status.HTTP_403_FORBIDDEN
+        raise err
+    return user
+
+
+async def get_risk(risk_id):
+    risks = await fetch(Risk.objects.filter(pk=risk_id))
+    if not risks:
+        raise NotFound()
+    return risks[0]
+
+
+async def get_record_model(risk):
+    "Returns the cached model of a risk, loading its fields without blocking on a miss"
+    model = model_cache.get(risk.id, risk.get_model_name)
+    if model is None:
+        fields = await fetch(RiskField.objects.filter(risk_id=risk.id))
+        model = model_cache.get_or_build(risk.id, risk.get_model_name, lambda: risk.build_django_model(fields))
+    # Loaded on first use otherwise, with a blocking query
+    for field in record_fields(model):
+        if isinstance(field, EnumField) and not field.has_codes:
+            field.set_codes(await fetch_rows(get_codes_queryset(field.enum_key)))
+    return model
+
+
+def set_prefetched(instance, name, objs):
+    "Attaches related objects the way prefetch_related() does, serializers read them without a query"
+    queryset = getattr(instance, name).get_queryset()
+    queryset._result_cache, queryset._prefetch_done = list(objs), True
+    instance.__dict__.setdefault('_prefetched_objects_cache', {})[name] = queryset
+
+
+async def get_enum_choices(risk):
+    "Async Risk.get_enum_choices()"
+    choices = {}
+    rows = await fetch_rows(EnumChoice.objects.filter(riskfield__risk_id=risk.id)
+                            .values_list('riskfield__name', 'value'))
+    for name, value in rows:
+        choices.setdefault(name, set()).add(value)
+    return choices
+
+
+@async_api('GET')
+@async_schema_condition
+async def risk_list(request):
+    """
+    Async ``risks-fields/``: the risks with their fields and choices, in
+    three queries per page, paginated and serialized like RiskAndFieldsViewSet
+    """
+    pagination = RiskCursorPagination()
+    risks = pagination.set_page(await fetch(pagination.get_page_queryset(Risk.objects.all(), Request(request))))
+    fields = await fetch(RiskField.objects.filter(risk_id__in=[risk.id for risk in risks]).order_by('id'))
+    through = RiskField.choices.through
+    rows = await fetch_rows(through.objects.filter(riskfield_id__in=[field.id for field in fields])
+                            .order_by('enumchoice_id')
+                            .values_list('riskfield_id', 'enumchoice__id', 'enumchoice__choice', 'enumchoice__value'))
+    choices = {}
+    for field_id, *row in rows:
+        choices.setdefault(field_id, []).append(EnumChoice.from_db(EnumChoice.objects.db, ['id', 'choice', 'value'],
+                                                                   row))
+    risk_fields = {}
+    for field in fields:
+        set_prefetched(field, 'choices', choices.get(field.id, []))
+        risk_fields.setdefault(field.risk_id, []).append(field)
+    for risk in risks:
+        set_prefetched(risk, 'fields', risk_fields.get(risk.id, []))
+    data = RiskAndFieldsSerializer(risks, many=True).data
+    return JsonResponse(OrderedDict([('next', pagination.get_next_link()), ('previous', pagination.get_previous_link()),
+                                     ('results', data)]), encoder=JSONEncoder)
+
+
+@async_api('GET', 'POST')
+async def record_list(request, risk_id):
+    """
+    Async ``risks/<risk_id>/records/``: GET lists the records with the
+    filters, ordering and keyset pagination of RecordViewSet, POST creates one
+    """
+    risk = await get_risk(risk_id)
+    model = await get_record_model(risk)
+    if request.method == 'POST':
+        return await create_record(request, risk, model)
+    try:
+        query = RecordQuery(model, request.GET, ignore=RecordViewSet.reserved_query_params)
+    except QueryError as err:
+        raise ValidationError(err.errors)
+    pagination = RecordKeysetPagination()
+    queryset = pagination.get_page_queryset(query.get_queryset(), Request(request), query)
+    records = pagination.set_page(await fetch(queryset))
+    data = get_record_serializer(model)(records, many=True).data
+    return JsonResponse(OrderedDict([('next', pagination.get_next_link()), ('results', data)]), encoder=JSONEncoder)
+
+
+async def create_record(request, risk, model):
+    import psycopg2
+    await authenticate(request)
+    try:
+        data = json.loads(request.body)
+    except ValueError as err:
+        raise ParseError(f'JSON parse error - {err}')
+    serializer_class = get_record_serializer(model)
+    # Only text enums need their choices read, see EnumValueField
+    enum_choices = await get_enum_choices(risk) if any(map(is_text_enum, record_fields(model))) else {}
+    serializer = serializer_class(data=data, context={'enum_choices': enum_choices})
+    # Unique columns are checked by their constraint instead of a blocking query
+    for field in serializer.fields.values():
+        field.validators = [v for v in field.validators if not isinstance(v, UniqueValidator)]
+    serializer.is_valid(raise_exception=True)
+    record = model(**serializer.validated_data)
+    try:
+        await insert(model, [record])
+    except psycopg2.IntegrityError as err:
+        raise ValidationError({'non_field_errors': [err.diag.message_primary or 'Integrity error.']})
+    # The insert has committed, see records_changed()
+    bump_records_version(risk.id)
+    return JsonResponse(serializer_class(record).data, status=status.HTTP_201_CREATED, encoder=JSONEncoder)
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination, _reverse_ordering
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from insurance.queries import QueryError
+
+
+class RiskCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key, no COUNT(*) and no OFFSET scans.
+    Async views run get_page_queryset() themselves and hand the risks to
+    set_page(), like RecordKeysetPagination.
+    """
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.get_page_queryset(queryset, request, view)))
+
+    def get_page_queryset(self, queryset, request, view=None):
+        "Returns the unevaluated queryset of the page, which holds one risk more"
+        # CursorPagination.paginate_queryset() up to the query, the ordering is a single field
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, position = self.cursor or (0, False, None)
+        queryset = queryset.order_by(*(_reverse_ordering(self.ordering) if reverse else self.ordering))
+        if position is not None:
+            queryset = queryset.filter(**{f"{self.ordering[0]}__{'lt' if reverse else 'gt'}": position})
+        return queryset[offset:offset + self.page_size + 1]
+
+    def set_page(self, risks):
+        # The rest of CursorPagination.paginate_queryset()
+        offset, reverse, position = self.cursor or (0, False, None)
+        self.page = list(risks[:self.page_size])
+        following = self._get_position_from_instance(risks[-1], self.ordering) if len(risks) > self.page_size else None
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None or offset > 0, following is not None
+            self.next_position, self.previous_position = position, following
+        else:
+            self.has_next, self.has_previous = following is not None, position is not None or offset > 0
+            self.next_position, self.previous_position = following, position
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+
+class RecordKeysetPagination(BasePagination):
+    """
+    Forward keyset pagination over the ordering of a RecordQuery: the cursor
+    holds the ordering key values of the last record of the page and the next
+    page starts right after them, so any page costs one indexed range scan.
+    The view gives the query through get_record_query(); async views run
+    get_page_queryset() themselves and hand the records to set_page().
+    """
+    cursor_query_param = 'cursor'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.get_page_queryset(queryset, request, view.get_record_query())))
+
+    def get_page_queryset(self, queryset, request, query):
+        "Returns the unevaluated queryset of the page, which holds one record more"
+        self.request = request
+        self.query = query
+        self.limit = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                queryset = queryset.filter(self.query.after(self.query.decode_position(cursor)))
+            except QueryError as err:
+                raise ValidationError({self.cursor_query_param: err.errors})
+        # One record more tells whether there is a next page
+        return queryset[:self.limit + 1]
+
+    def set_page(self, records):
+        self.has_next = len(records) > self.limit
+        self.page = records[:self.limit]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        cursor = self.query.encode_position(self.query.get_position(self.page[-1]))
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
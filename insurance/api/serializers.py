@@ -1,5 +1,22 @@
+import weakref
 from rest_framework import serializers
 from insurance.models import Risk, RiskField, EnumChoice
+from insurance.metrics import metrics
+from insurance.documents import record_fields
+from insurance.enums import EnumField, LABEL_LENGTH, is_text_enum
+
+
+class TimedDataMixin:
+    "Observes the time spent building the data of a top level serializer, see insurance.metrics"
+
+    @property
+    def data(self):
+        with metrics.timer('serialization'):
+            return super().data
+
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    pass
 
 
 class EnumChoiceSerializer(serializers.ModelSerializer):
@@ -16,15 +33,77 @@ class RiskFieldSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'field_type', 'kwargs', 'choices']
 
 
-class RiskOnlySerializer(serializers.ModelSerializer):
+class RiskOnlySerializer(TimedDataMixin, serializers.ModelSerializer):
     class Meta:
         model = Risk
-        fields = ['id', 'name', 'description']
+        fields = ['id', 'name', 'description', 'schema_version']
+        list_serializer_class = TimedListSerializer
 
 
-class RiskAndFieldsSerializer(serializers.ModelSerializer):
+class RiskAndFieldsSerializer(TimedDataMixin, serializers.ModelSerializer):
     fields = RiskFieldSerializer(many=True)
 
     class Meta:
         model = Risk
-        fields = ['id', 'name', 'description', 'fields']
+        fields = ['id', 'name', 'description', 'schema_version', 'fields']
+        list_serializer_class = TimedListSerializer
+
+
+class EnumValueField(serializers.CharField):
+    "Validates an enum column against the choices of its RiskField"
+    default_error_messages = {
+        'invalid_choice': '"{input}" is not a valid choice.'
+    }
+
+    def __init__(self, enum_field=None, **kwargs):
+        self.enum_field = enum_field
+        super().__init__(**kwargs)
+
+    def get_choices(self):
+        if self.enum_field is not None:
+            # In memory with the model, see insurance.enums.EnumField
+            return self.enum_field.get_codes().by_label
+        # Text enums, their choices are read for the request
+        return self.context.get('enum_choices', {}).get(self.source)
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        choices = self.get_choices()
+        if choices is not None and value not in choices:
+            self.fail('invalid_choice', input=value)
+        return value
+
+
+class RecordListSerializer(TimedListSerializer):
+    batch_size = 1000
+
+    def create(self, validated_data):
+        # A single multi-row INSERT per batch instead of one save() per record
+        model = self.child.Meta.model
+        batch_size = self.context.get('batch_size', self.batch_size)
+        return model.objects.bulk_create([model(**item) for item in validated_data], batch_size=batch_size)
+
+
+_record_serializers = weakref.WeakKeyDictionary()
+
+
+def get_record_serializer(model):
+    "Returns a serializer for the records of a dynamic model, built once per model class"
+    serializer_class = _record_serializers.get(model)
+    if serializer_class is None:
+        attrs = {}
+        fields = record_fields(model)
+        for field in fields:
+            # Enums are read and written as their labels, the values of their EnumChoices
+            if isinstance(field, EnumField):
+                attrs[field.name] = EnumValueField(field, max_length=LABEL_LENGTH, allow_null=field.null,
+                                                   required=not (field.null or field.has_default()))
+            elif is_text_enum(field):
+                attrs[field.name] = EnumValueField(max_length=field.max_length, allow_null=field.null,
+                                                   required=not (field.null or field.has_default()))
+        meta = type('Meta', (), {'model': model, 'fields': [field.name for field in fields],
+                                 'list_serializer_class': RecordListSerializer})
+        attrs['Meta'] = meta
+        serializer_class = type(f'{model.__name__}Serializer', (TimedDataMixin, serializers.ModelSerializer), attrs)
+        _record_serializers[model] = serializer_class
+    return serializer_class
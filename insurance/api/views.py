@@ -1,14 +1,266 @@
+from django.db import router, transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, CreateModelMixin
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser, SAFE_METHODS
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.generics import RetrieveAPIView, ListAPIView
-from insurance.models import Risk
-from insurance.api.serializers import RiskOnlySerializer, RiskAndFieldsSerializer
+from insurance.models import Risk, RiskField, EnumChoice, SchemaVersion, SchemaChange
+from insurance.documents import record_fields
+from insurance.enums import is_text_enum
+from insurance.catalog import export_catalog, import_catalog, CatalogError
+from insurance.exports import export_records, get_export_columns, EXPORT_FORMATS
+from insurance.queries import RecordQuery, QueryError
+from insurance.aggregations import RecordAggregation, aggregate_records, records_changed
+from insurance.api.serializers import RiskOnlySerializer, RiskAndFieldsSerializer, get_record_serializer
+from insurance.api.pagination import RiskCursorPagination, RecordKeysetPagination
+
+
+def get_schema_version(request, pk=None, **kwargs):
+    # One primary key lookup gives both the ETag and the Last-Modified of a request
+    if not hasattr(request, '_schema_version'):
+        if pk is None:
+            request._schema_version = SchemaVersion.current()
+        else:
+            try:
+                risks = Risk.objects.filter(pk=pk)
+            except (TypeError, ValueError):
+                # Not a primary key, the view answers 404
+                request._schema_version = None
+            else:
+                request._schema_version = risks.values_list('schema_version', 'schema_updated_at').first()
+    return request._schema_version
+
+
+def schema_etag(request, pk=None, **kwargs):
+    version = get_schema_version(request, pk)
+    if version is None:
+        return None
+    return f'"risk-{pk}-v{version[0]}"' if pk is not None else f'"risks-v{version[0]}"'
+
+
+def schema_last_modified(request, pk=None, **kwargs):
+    version = get_schema_version(request, pk)
+    return version[1] if version is not None else None
+
+
+# Answers 304 Not Modified from the schema versions, without loading any risk
+schema_condition = method_decorator(condition(etag_func=schema_etag, last_modified_func=schema_last_modified))
 
 
 class RiskViewSet(RetrieveAPIView, GenericViewSet):
     queryset = Risk.objects.all()
     serializer_class = RiskOnlySerializer
 
+    @schema_condition
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 
 class RiskAndFieldsViewSet(ListAPIView, GenericViewSet):
-    queryset = Risk.objects.all()
+    """
+    The risks with their fields and choices.
+    ``risks-fields/changes/?since=<cursor>`` returns the risks changed after
+    the cursor, the ids of the deleted risks and fields, and the cursor to
+    send next time. A first sync starts from cursor 0; ``more`` tells that
+    the next changes have to be fetched right away.
+    """
+    # The whole risk -> fields -> choices tree is fetched in three queries per page,
+    # fields and choices in creation order like the async view
+    queryset = Risk.objects.prefetch_related(Prefetch('fields', queryset=RiskField.objects.order_by('id')),
+                                             Prefetch('fields__choices', queryset=EnumChoice.objects.order_by('id')))
     serializer_class = RiskAndFieldsSerializer
+    pagination_class = RiskCursorPagination
+    changes_limit = 1000
+
+    @schema_condition
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request, *args, **kwargs):
+        since = request.query_params.get('since', '0')
+        if not since.isdigit():
+            raise ValidationError({'since': ['Must be a cursor returned by this endpoint.']})
+        changes = list(SchemaChange.objects.filter(id__gt=int(since)).order_by('id')
+                       .values_list('id', 'action', 'risk_id', 'field_id')[:self.changes_limit + 1])
+        more = len(changes) > self.changes_limit
+        changes = changes[:self.changes_limit]
+        deleted_risks = {risk_id for id, action, risk_id, field_id in changes
+                         if action == SchemaChange.DELETED and field_id is None}
+        deleted_fields = {(field_id, risk_id) for id, action, risk_id, field_id in changes
+                          if action == SchemaChange.DELETED and field_id is not None and risk_id not in deleted_risks}
+        changed_risks = {risk_id for id, action, risk_id, field_id in changes if risk_id not in deleted_risks}
+        risks = self.get_queryset().filter(pk__in=changed_risks).order_by('id')
+        return Response({
+            'cursor': str(changes[-1][0]) if changes else since,
+            'more': more,
+            'risks': self.get_serializer(risks, many=True).data,
+            'deleted_risks': sorted(deleted_risks),
+            'deleted_fields': [{'id': field_id, 'risk': risk_id} for field_id, risk_id in sorted(deleted_fields)],
+        })
+
+
+class CatalogView(APIView):
+    """
+    The whole catalog of risks, see insurance.catalog. GET exports it, POST
+    imports one, creating and altering the risks in one transaction; with
+    ``?prune=1`` the risks and fields missing from it are deleted, with
+    ``?dry_run=1`` the changes are only returned. Importing changes tables,
+    it is left to staff users.
+    """
+
+    def get_permissions(self):
+        if self.request.method in SAFE_METHODS:
+            return super().get_permissions()
+        return [IsAdminUser()]
+
+    def get(self, request, *args, **kwargs):
+        return Response(export_catalog())
+
+    def post(self, request, *args, **kwargs):
+        flags = {name: request.query_params.get(name) in ('1', 'true') for name in ('prune', 'dry_run')}
+        try:
+            changes = import_catalog(request.data, **flags)
+        except CatalogError as err:
+            raise ValidationError({'errors': err.errors})
+        return Response(changes)
+
+
+class RecordViewSet(ListModelMixin, RetrieveModelMixin, CreateModelMixin, GenericViewSet):
+    """
+    Records stored in the dynamic table of a risk.
+    The list takes filters and an ordering on any field, see RecordQuery, and
+    is paginated by keyset.
+    ``records/bulk/`` accepts a list of records: POST inserts them, PATCH
+    updates them by id. Both are applied in batches in a single transaction.
+    ``records/export/`` streams the whole table as NDJSON or CSV.
+    ``records/aggregate/`` groups the filtered records and computes statistics
+    in the database, see RecordAggregation.
+    """
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = RecordKeysetPagination
+    bulk_batch_size = 1000
+    # Query parameters that are not record filters
+    reserved_query_params = ('cursor', 'page_size', 'format', 'group_by', 'metrics')
+
+    def get_risk(self):
+        if not hasattr(self, '_risk'):
+            self._risk = get_object_or_404(Risk, pk=self.kwargs['risk_id'])
+        return self._risk
+
+    def get_record_model(self):
+        return self.get_risk().get_django_model()
+
+    def get_record_query(self):
+        if not hasattr(self, '_record_query'):
+            try:
+                self._record_query = RecordQuery(self.get_record_model(), self.request.query_params,
+                                                 ignore=self.reserved_query_params)
+            except QueryError as err:
+                raise ValidationError(err.errors)
+        return self._record_query
+
+    def get_queryset(self):
+        if self.action == 'list':
+            return self.get_record_query().get_queryset()
+        return self.get_record_model().objects.all()
+
+    def get_serializer_class(self):
+        return get_record_serializer(self.get_record_model())
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request.method not in SAFE_METHODS:
+            # Only text enums need their choices read, see EnumValueField
+            if any(map(is_text_enum, record_fields(self.get_record_model()))):
+                context['enum_choices'] = self.get_risk().get_enum_choices()
+            context['batch_size'] = self.bulk_batch_size
+        return context
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        records_changed(self.get_risk().id)
+
+    def get_bulk_data(self):
+        if not isinstance(self.request.data, list):
+            raise ValidationError({'non_field_errors': ['Expected a list of records.']})
+        return self.request.data
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=self.get_bulk_data(), many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic(using=router.db_for_write(self.get_record_model())):
+            records = serializer.save()
+            records_changed(self.get_risk().id)
+        return Response({'created': len(records)}, status=status.HTTP_201_CREATED)
+
+    @bulk.mapping.patch
+    def bulk_update(self, request, *args, **kwargs):
+        data = self.get_bulk_data()
+        ids = [item.get('id') for item in data if isinstance(item, dict) and isinstance(item.get('id'), int)]
+        records = self.get_queryset().in_bulk(ids)
+        errors, changed, fields = [], [], set()
+        for item in data:
+            record = records.get(item.get('id')) if isinstance(item, dict) else None
+            if record is None:
+                errors.append({'id': ['Record not found.']})
+                continue
+            serializer = self.get_serializer(record, data=item, partial=True)
+            if not serializer.is_valid():
+                errors.append(serializer.errors)
+                continue
+            errors.append({})
+            for name, value in serializer.validated_data.items():
+                setattr(record, name, value)
+                fields.add(name)
+            changed.append(record)
+        if any(errors):
+            raise ValidationError(errors)
+        if fields:
+            with transaction.atomic(using=router.db_for_write(self.get_record_model())):
+                self.get_record_model().objects.bulk_update(changed, fields, batch_size=self.bulk_batch_size)
+                records_changed(self.get_risk().id)
+        return Response({'updated': len(changed)})
+
+    @action(detail=False, methods=['get'])
+    def aggregate(self, request, *args, **kwargs):
+        group_by = request.query_params.get('group_by')
+        metrics = request.query_params.get('metrics')
+        try:
+            aggregation = RecordAggregation(self.get_record_model(), group_by.split(',') if group_by else (),
+                                            metrics.split(',') if metrics else None, self.get_record_query().where)
+        except QueryError as err:
+            raise ValidationError(err.errors)
+        return Response(aggregate_records(self.get_risk().id, aggregation))
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        # ``output`` rather than ``format``, which DRF keeps for content negotiation
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({'output': [f"Must be one of: {', '.join(EXPORT_FORMATS)}."]})
+        since = request.query_params.get('since')
+        if since is not None and not since.isdigit():
+            raise ValidationError({'since': ['Must be a record id.']})
+        fields = request.query_params.get('fields')
+        fields = fields.split(',') if fields else None
+        model = self.get_record_model()
+        try:
+            get_export_columns(model, fields)
+        except ValueError as err:
+            raise ValidationError({'fields': [str(err)]})
+        response = StreamingHttpResponse(export_records(model, output, fields, since and int(since)),
+                                         content_type=EXPORT_FORMATS[output])
+        filename = f'{model._meta.app_label}_{model._meta.model_name}.{output}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
@@ -5,4 +5,13 @@ class InsuranceConfig(AppConfig):
     name = 'insurance'
 
     def ready(self):
-        import insurance.signals
+        # Builds the dynamic models up front when INSURANCE_BOOTSTRAP is set
+        from .bootstrap import bootstrap
+        from .metrics import metrics
+        from . import schema_events
+        # Times the queries of every connection, before the bootstrap opens one
+        metrics.install()
+        # Follows the schema changes of the other workers when INSURANCE_SCHEMA_EVENTS is set,
+        # from before the models are built so no change in between is missed
+        schema_events.start()
+        bootstrap()
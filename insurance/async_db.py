@@ -0,0 +1,149 @@
+import asyncio
+import time
+import weakref
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.db.models.sql import InsertQuery
+from .metrics import metrics
+
+# One pool per event loop, connections cannot be shared between loops
+_pools = weakref.WeakKeyDictionary()
+
+
+async def wait(conn):
+    "Waits without blocking the loop until an asynchronous psycopg2 connection is ready"
+    import psycopg2.extensions
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+        # The fd may be reported ready again before the waiting task resumes
+        callback = lambda: ready.done() or ready.set_result(None)
+        fd = conn.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, callback)
+            remove = loop.remove_reader
+        else:
+            loop.add_writer(fd, callback)
+            remove = loop.remove_writer
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class AsyncPool:
+    """
+    Asynchronous psycopg2 connections to the database of an alias, for async
+    views. Queries run in autocommit mode, each statement is a transaction.
+    At most ``size`` connections are open, other queries wait for one.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, size=10):
+        self.using = using
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def connect(self):
+        import psycopg2.extras
+        db = connections[self.using]
+        params = db.get_connection_params()
+        # Same session time zone as the connections of Django
+        params['options'] = f"{params.get('options', '')} -c timezone={db.timezone_name}".strip()
+        conn = psycopg2.connect(async_=True, **params)
+        await wait(conn)
+        # Leave jsonb to the converters of JSONField, like Django does
+        psycopg2.extras.register_default_jsonb(conn_or_curs=conn, loads=lambda x: x)
+        return conn
+
+    async def execute(self, sql, params=None):
+        "Runs a statement and returns its rows, an empty list when it returns none"
+        import psycopg2
+        async with self.slots:
+            conn = self.idle.pop() if self.idle else await self.connect()
+            started = time.perf_counter()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                await wait(conn)
+                rows = cursor.fetchall() if cursor.description is not None else []
+            except BaseException as err:
+                # A failed statement leaves the connection usable, a cancelled one busy
+                if isinstance(err, psycopg2.DatabaseError) and not conn.closed:
+                    self.idle.append(conn)
+                else:
+                    conn.close()
+                raise
+            finally:
+                metrics.record_query(sql, params, time.perf_counter() - started)
+            self.idle.append(conn)
+            return rows
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+def get_pool(using=DEFAULT_DB_ALIAS):
+    loop = asyncio.get_event_loop()
+    pools = _pools.setdefault(loop, {})
+    if using not in pools:
+        pools[using] = AsyncPool(using, getattr(settings, 'INSURANCE_ASYNC_POOL_SIZE', 10))
+    return pools[using]
+
+
+def close_pools():
+    "Closes the connections of the pools of the running loop"
+    for pool in _pools.pop(asyncio.get_event_loop(), {}).values():
+        pool.close()
+
+
+async def fetch_rows(queryset):
+    """
+    Runs a queryset, e.g. a values_list() one, without blocking the loop and
+    returns its rows converted like Django does
+    """
+    compiler = queryset.query.get_compiler(queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return []
+    rows = await get_pool(queryset.db).execute(sql, params)
+    return [tuple(row) for row in compiler.results_iter([rows])]
+
+
+async def fetch(queryset):
+    "Returns the model instances of a plain queryset, without blocking the loop"
+    compiler = queryset.query.get_compiler(queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return []
+    rows = await get_pool(queryset.db).execute(sql, params)
+    select_fields = compiler.klass_info['select_fields']
+    start, end = select_fields[0], select_fields[-1] + 1
+    names = [column[0].target.attname for column in compiler.select[start:end]]
+    model = queryset.model
+    return [model.from_db(queryset.db, names, row[start:end]) for row in compiler.results_iter([rows])]
+
+
+async def insert(model, objs, using=None):
+    "Inserts new model instances in one statement and sets their primary keys"
+    if not objs:
+        return objs
+    using = using or router.db_for_write(model)
+    fields = [field for field in model._meta.concrete_fields if field is not model._meta.auto_field]
+    query = InsertQuery(model)
+    query.insert_values(fields, objs)
+    compiler = query.get_compiler(using)
+    compiler.returning_fields = [model._meta.pk]
+    (sql, params), = compiler.as_sql()
+    rows = await get_pool(using).execute(sql, params)
+    for obj, (pk,) in zip(objs, rows):
+        obj.pk = pk
+        obj._state.adding = False
+        obj._state.db = using
+    return objs
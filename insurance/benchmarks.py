@@ -0,0 +1,467 @@
+import asyncio
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, models
+from django.test import Client, AsyncClient
+from django.test.utils import override_settings
+from .models import Risk, RiskField, EnumChoice
+from .model_cache import model_cache
+from .model_utils import SchemaBuilder, create_model
+from .imports import import_records
+from .queries import RecordQuery
+from .async_db import close_pools
+from .schema_diff import FieldSpec, diff_schema
+
+
+def get_environment():
+    "Describes what the benchmarks ran on, to compare results between commits"
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=settings.BASE_DIR, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    if connection.vendor == 'postgresql':
+        server = connection.pg_version
+    else:
+        server = getattr(connection.Database, 'sqlite_version', None)
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'database_version': server,
+        'platform': sys.platform,
+    }
+
+
+def bulk_create(objs, created):
+    """
+    Inserts model instances in bulk and returns them with their primary keys,
+    read back from the ``created`` queryset on databases that do not return
+    them, e.g. SQLite
+    """
+    objs = type(objs[0]).objects.bulk_create(objs)
+    if connection.features.can_return_rows_from_bulk_insert:
+        return objs
+    return list(created.order_by('pk'))
+
+
+def best_time(func, repeat):
+    "Returns the best wall clock time of func over repeat runs"
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_risk_iteration(rows=500, fields=5, repeat=5):
+    """
+    Per row cost in microseconds of iterating Risk rows. ``eager`` replays the
+    old __init__ that rebuilt the dynamic model for every row, ``lazy`` is a
+    plain queryset iteration and ``plain_model`` an ordinary model of the
+    same size for reference.
+    """
+    risks = bulk_create([Risk(name=f'Bench Risk {i}', description='benchmark') for i in range(rows)],
+                        Risk.objects.filter(name__startswith='Bench Risk '))
+    RiskField.objects.bulk_create([
+        RiskField(name=f'field_{j}', field_type='IntegerField', risk=risk, kwargs={'null': True})
+        for risk in risks for j in range(fields)
+    ])
+    EnumChoice.objects.bulk_create([EnumChoice(choice=f'choice {i}', value=f'value {i}') for i in range(rows)])
+
+    def eager():
+        for risk in Risk.objects.all():
+            model_cache.invalidate(risk.id)
+            risk.get_django_model()
+
+    results = {
+        'eager': best_time(eager, repeat),
+        'lazy': best_time(lambda: list(Risk.objects.all()), repeat),
+        'plain_model': best_time(lambda: list(EnumChoice.objects.all()), repeat),
+    }
+    for risk in risks:
+        risk.unregister_django_model()
+    return {name: value / rows * 1e6 for name, value in results.items()}
+
+
+def bench_schema_diff(field_counts=(100, 500, 1000), repeat=20):
+    """
+    Microseconds to diff a risk with the given number of fields against a
+    version where a tenth of them are renamed, altered, dropped and added.
+    Runs in memory, no database involved.
+    """
+    results = {}
+    for count in field_counts:
+        old = tuple(FieldSpec(i, f'field_{i}', 'CharField', json.dumps({'max_length': 20, 'null': True}), None)
+                    for i in range(count))
+        new = []
+        for spec in old:
+            if spec.key % 40 == 0:
+                continue
+            if spec.key % 40 == 10:
+                spec = spec._replace(name=f'renamed_{spec.key}')
+            elif spec.key % 40 == 20:
+                spec = spec._replace(kwargs=json.dumps({'max_length': 40, 'null': True}))
+            new.append(spec)
+        new.extend(FieldSpec(count + i, f'added_{i}', 'IntegerField', json.dumps({'null': True}), None)
+                   for i in range(count // 40))
+        results[f'{count}_fields'] = best_time(lambda: diff_schema(old, tuple(new)), repeat) * 1e6
+    return results
+
+
+def get_client():
+    "Returns a test client logged in as a superuser, for the requests of the benchmarks"
+    user = User.objects.create_superuser(f'bench_{uuid.uuid4().hex[:12]}', 'bench')
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def create_bench_risk(name, rows=0, storage=Risk.TABLE):
+    "Creates a risk with a CharField ``name`` and an IntegerField ``seats``, its table and ``rows`` records"
+    risk = Risk.objects.create(name=name, description='benchmark', storage=storage)
+    RiskField.objects.bulk_create([
+        RiskField(name='name', field_type='CharField', risk=risk, kwargs={'max_length': 20}),
+        RiskField(name='seats', field_type='IntegerField', risk=risk, kwargs={'null': True}),
+    ])
+    model = risk.get_django_model()
+    SchemaBuilder(model).create_db_table()
+    model.objects.bulk_create([model(name=f'record {i}', seats=i % 7) for i in range(rows)], batch_size=5000)
+    return risk
+
+
+def bench_model_build(field_counts=(10, 50, 200), repeat=20):
+    """
+    Milliseconds to build a dynamic model class with the given number of
+    fields, the work of a cache miss. Runs in memory, no database involved.
+    """
+    results = {}
+    for count in field_counts:
+        name = f'BenchBuild{count}'
+
+        def build():
+            fields = {f'field_{i}': models.IntegerField(null=True) for i in range(count)}
+            create_model(name, fields, 'insurance', 'insurance.models')
+            model_cache.unregister(name.lower())
+
+        results[f'{count}_fields'] = best_time(build, repeat) * 1e3
+    return results
+
+
+def bench_risks_fields_api(sizes=((10, 5), (100, 5), (100, 20)), repeat=5):
+    """
+    Milliseconds per GET of ``/api/v1/risks-fields/`` returning one page of
+    ``risks x fields`` risks, each field with two choices
+    """
+    client = Client()
+    choices = bulk_create([EnumChoice(choice='Bench Yes', value='yes'), EnumChoice(choice='Bench No', value='no')],
+                          EnumChoice.objects.filter(choice__startswith='Bench '))
+    results = {}
+    for risk_count, field_count in sizes:
+        risks = bulk_create([Risk(name=f'Bench Api {i}', description='benchmark') for i in range(risk_count)],
+                            Risk.objects.filter(name__startswith='Bench Api '))
+        fields = bulk_create([
+            RiskField(name=f'field_{j}', field_type='CharField', risk=risk,
+                      kwargs={'choices': True, 'max_length': 10, 'null': True})
+            for risk in risks for j in range(field_count)
+        ], RiskField.objects.filter(risk__in=risks))
+        RiskField.choices.through.objects.bulk_create([
+            RiskField.choices.through(riskfield_id=field.id, enumchoice_id=choice.id)
+            for field in fields for choice in choices
+        ])
+        url = f'/api/v1/risks-fields/?page_size={risk_count}'
+
+        def get():
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        results[f'{risk_count}_risks_{field_count}_fields'] = best_time(get, repeat) * 1e3
+        # One by one, Risk.delete drops the models from the cache and the registry
+        for risk in risks:
+            risk.delete()
+    return results
+
+
+def get_admin_add_data(name, field_count):
+    data = {'name': name, 'description': 'benchmark', 'storage': Risk.TABLE, 'fields-TOTAL_FORMS': str(field_count),
+            'fields-INITIAL_FORMS': '0', 'fields-MIN_NUM_FORMS': '0', 'fields-MAX_NUM_FORMS': '1000',
+            '_save': 'Save'}
+    for i in range(field_count):
+        data.update({f'fields-{i}-id': '', f'fields-{i}-risk': '', f'fields-{i}-name': f'field_{i}',
+                     f'fields-{i}-field_type': 'CharField', f'fields-{i}-max_length': '20',
+                     f'fields-{i}-default': ''})
+    return data
+
+
+def bench_admin_save(inline_counts=(5, 20, 50), repeat=3):
+    """
+    Milliseconds per admin add of a Risk with K inline fields, the creation
+    of its table included
+    """
+    client = get_client()
+    results = {}
+    for count in inline_counts:
+        timings = []
+        for run in range(repeat):
+            name = f'Bench Admin {count} {run}'
+            data = get_admin_add_data(name, count)
+            started = time.perf_counter()
+            response = client.post('/admin/insurance/risk/add/', data=data)
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 302, response.status_code
+            Risk.objects.get(name=name).delete()
+        results[f'{count}_fields'] = min(timings) * 1e3
+    return results
+
+
+def bench_schema_changes(row_counts=(1000, 10000)):
+    """
+    Milliseconds of adding a nullable number column to tables of the given
+    number of rows, changing it to text and removing it, through RiskField
+    saves as the admin and the API do: schema diff, SchemaBuilder DDL and
+    model rebuild
+    """
+    results = {}
+    for rows in row_counts:
+        risk = create_bench_risk(f'Bench Schema {rows}', rows=rows)
+        field = RiskField(name='extra', field_type='IntegerField', risk=risk, kwargs={'null': True})
+
+        def alter():
+            field.field_type, field.kwargs = 'CharField', {'max_length': 20, 'null': True}
+            field.save()
+
+        operations = [('add', field.save), ('alter', alter), ('remove', field.delete)]
+        if connection.vendor == 'sqlite':
+            # SQLite drops a column by copying the table from a model that still has
+            # it, which SchemaBuilder does not build
+            operations.pop()
+        for operation, run in operations:
+            started = time.perf_counter()
+            run()
+            results[f'{operation}_{rows}_rows'] = (time.perf_counter() - started) * 1e3
+        risk.delete()
+    return results
+
+
+def bench_ingest(rows=10000, batch_size=1000):
+    """
+    Rows per second of loading records through the ``records/bulk/``
+    endpoint and through import_records() from CSV
+    """
+    client = get_client()
+    risk = create_bench_risk('Bench Ingest')
+    records = [{'name': f'record {i}', 'seats': i % 7} for i in range(rows)]
+    started = time.perf_counter()
+    for start in range(0, rows, batch_size):
+        response = client.post(f'/api/v1/risks/{risk.id}/records/bulk/', records[start:start + batch_size],
+                               content_type='application/json')
+        assert response.status_code == 201, response.status_code
+    results = {'bulk_api': rows / (time.perf_counter() - started)}
+    stream = io.StringIO('name,seats\n' + ''.join(f'record {i},{i % 7}\n' for i in range(rows)))
+    results['import_csv'] = import_records(risk, stream, 'csv', batch_size=batch_size)['rows_per_second']
+    risk.delete()
+    return results
+
+
+def get_storages():
+    "Returns the record storages to compare, documents need PostgreSQL"
+    return [Risk.TABLE, Risk.DOCUMENT] if connection.vendor == 'postgresql' else [Risk.TABLE]
+
+
+def bench_storage_throughput(rows=10000, batch_size=1000, repeat=3):
+    """
+    Rows per second of each record storage: ``write`` inserts records in
+    bulk, ``read`` reads them all back as model instances and ``query``
+    reads the first pages of a filtered and ordered RecordQuery
+    """
+    results = {}
+    for storage in get_storages():
+        risk = create_bench_risk(f'Bench Storage {storage}', storage=storage)
+        model = risk.get_django_model()
+        started = time.perf_counter()
+        for start in range(0, rows, batch_size):
+            model.objects.bulk_create([model(name=f'record {i}', seats=i % 7)
+                                       for i in range(start, min(start + batch_size, rows))])
+        results[f'{storage}_write'] = rows / (time.perf_counter() - started)
+        results[f'{storage}_read'] = rows / best_time(lambda: list(model.objects.all()), repeat)
+        query = RecordQuery(model, {'seats__gte': '3', 'ordering': '-seats'})
+        page = 100
+        results[f'{storage}_query'] = page / best_time(lambda: list(query.get_queryset()[:page]), repeat)
+        risk.delete()
+    return results
+
+
+def bench_storage_schema_changes(rows=10000):
+    """
+    Milliseconds of the field changes of each record storage with ``rows``
+    records: adding, renaming, changing the type of and removing a field,
+    through RiskField saves
+    """
+    results = {}
+    for storage in get_storages():
+        risk = create_bench_risk(f'Bench Storage Schema {storage}', rows=rows, storage=storage)
+        field = RiskField(name='extra', field_type='IntegerField', risk=risk, kwargs={'null': True})
+
+        def rename():
+            field.name = 'renamed'
+            field.save()
+
+        def alter():
+            field.field_type, field.kwargs = 'CharField', {'max_length': 20, 'null': True}
+            field.save()
+
+        operations = [('add', field.save), ('rename', rename), ('alter', alter), ('remove', field.delete)]
+        if connection.vendor == 'sqlite':
+            # See bench_schema_changes()
+            operations.pop()
+        for operation, run in operations:
+            started = time.perf_counter()
+            run()
+            results[f'{storage}_{operation}'] = (time.perf_counter() - started) * 1e3
+        risk.delete()
+    return results
+
+
+ENUM_LABELS = ('active', 'lapsed', 'cancelled', 'pending_renewal')
+# How each enum storage is declared: labels in a text column, or codes, see insurance.enums
+ENUM_STORAGES = {
+    'text': ('CharField', {'choices': True, 'max_length': 20, 'null': True}),
+    'codes': ('EnumField', {'null': True}),
+}
+
+
+def create_enum_bench_risk(name, storage, rows=0):
+    "Creates a risk with an indexed enum ``status`` stored as ``text`` or ``codes``, its table and records"
+    risk = Risk.objects.create(name=name, description='benchmark')
+    field_type, kwargs = ENUM_STORAGES[storage]
+    field = RiskField(name='status', field_type=field_type, risk=risk, kwargs=dict(kwargs, db_index=True))
+    field = bulk_create([field], RiskField.objects.filter(risk=risk))[0]
+    field.choices.set([EnumChoice.objects.create(choice=label.title(), value=label) for label in ENUM_LABELS])
+    model = risk.get_django_model()
+    SchemaBuilder(model).create_db_table()
+    model.objects.bulk_create([model(status=ENUM_LABELS[i % len(ENUM_LABELS)]) for i in range(rows)],
+                              batch_size=5000)
+    return risk
+
+
+def bench_enum_storage(rows=10000):
+    """
+    Bytes per row of an indexed enum column stored as labels and as codes:
+    ``column`` the stored value, ``table`` and ``index`` the relations. On
+    PostgreSQL only, the other databases do not report their sizes.
+    """
+    results = {}
+    if connection.vendor != 'postgresql':
+        return results
+    for storage in ENUM_STORAGES:
+        risk = create_enum_bench_risk(f'Bench Enum Storage {storage}', storage, rows=rows)
+        table = risk.get_django_model()._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT AVG(pg_column_size(status)), pg_table_size(%s), pg_indexes_size(%s) '
+                           f'FROM {connection.ops.quote_name(table)}', [table, table])
+            column, table_size, index_size = cursor.fetchone()
+        results[f'{storage}_column'] = float(column)
+        results[f'{storage}_table'] = table_size / rows
+        results[f'{storage}_index'] = index_size / rows
+        risk.delete()
+    return results
+
+
+def bench_enum_validation(records=1000, repeat=5):
+    """
+    Microseconds per record of validating a bulk write of ``records`` enum
+    values: labels in a text column are checked against the choices read for
+    the request, codes against the code map held by the model
+    """
+    from .api.serializers import get_record_serializer
+    results = {}
+    data = [{'status': ENUM_LABELS[i % len(ENUM_LABELS)]} for i in range(records)]
+    for storage in ENUM_STORAGES:
+        risk = create_enum_bench_risk(f'Bench Enum Validation {storage}', storage)
+        serializer_class = get_record_serializer(risk.get_django_model())
+
+        def validate():
+            context = {'enum_choices': risk.get_enum_choices()} if storage == 'text' else {}
+            assert serializer_class(data=data, many=True, context=context).is_valid()
+
+        results[storage] = best_time(validate, repeat) / records * 1e6
+        risk.delete()
+    return results
+
+
+def run_wsgi(urls, concurrency):
+    "Requests per second of the WSGI handler serving the urls from a pool of threads"
+    def get(url):
+        response = Client().get(url)
+        assert response.status_code == 200, response.status_code
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        started = time.perf_counter()
+        list(pool.map(get, urls))
+        return len(urls) / (time.perf_counter() - started)
+
+
+def run_asgi(urls, concurrency):
+    "Requests per second of the ASGI handler serving the urls from concurrent tasks of one loop"
+    async def main():
+        client, slots = AsyncClient(), asyncio.Semaphore(concurrency)
+
+        async def get(url):
+            async with slots:
+                response = await client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(get(url) for url in urls))
+            return len(urls) / (time.perf_counter() - started)
+        finally:
+            close_pools()
+    # asyncio.run() is Python 3.7+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def bench_api_throughput(requests=200, concurrency=20, records=100):
+    """
+    Requests per second of the risk listing and the record list served by
+    the sync views through the WSGI handler and by the async views through
+    the ASGI handler, ``concurrency`` requests at a time. The handlers run in
+    process, the figures leave out the server. The data is committed, the
+    connections of the async views cannot see a transaction of this one,
+    and removed afterwards, see the load_test command.
+    """
+    risk = Risk.objects.create(name='Bench Load', description='benchmark')
+    try:
+        RiskField.objects.create(name='name', field_type='CharField', risk=risk, kwargs={'max_length': 20})
+        RiskField.objects.create(name='seats', field_type='IntegerField', risk=risk, kwargs={'null': True})
+        model = risk.get_django_model()
+        SchemaBuilder(model).create_db_table()
+        model.objects.bulk_create([model(name=f'record {i}', seats=i % 7) for i in range(records)])
+        pages = {
+            'risk_list': ('/api/v1/risks-fields/', '/api/v1/async/risks-fields/'),
+            'record_list': (f'/api/v1/risks/{risk.id}/records/?ordering=-seats',
+                            f'/api/v1/async/risks/{risk.id}/records/?ordering=-seats'),
+        }
+        results = {}
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name, (sync_url, async_url) in pages.items():
+                results[f'{name}_wsgi'] = run_wsgi([sync_url] * requests, concurrency)
+                results[f'{name}_asgi'] = run_asgi([async_url] * requests, concurrency)
+        return results
+    finally:
+        risk.delete()
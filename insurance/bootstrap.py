@@ -0,0 +1,121 @@
+import json
+import logging
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.utils import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+BOOTSTRAP_MODES = ('build', 'snapshot')
+
+# Filled by InsuranceConfig.ready(), see bootstrap()
+stats = {
+    'mode': None,
+    'import_seconds': None,
+    'bootstrap_seconds': None,
+    'queries': None,
+    'models': 0,
+    'source': None,
+}
+
+
+def load_definitions():
+    """
+    Returns (risk, fields) pairs for all the risks, in two queries. Enum
+    choices are left out, the tables only need to know a field is an enum
+    """
+    from .models import Risk
+    return [(risk, list(risk.fields.all())) for risk in Risk.objects.prefetch_related('fields')]
+
+
+def dump_snapshot(path):
+    """
+    Writes the definitions of every risk to ``path`` as JSON, stamped with the
+    catalog version they were read at
+    """
+    from .models import SchemaVersion
+    version = SchemaVersion.current()[0]
+    snapshot = {
+        'version': version,
+        'risks': [{
+            'id': risk.id,
+            'name': risk.name,
+            'description': risk.description,
+            'storage': risk.storage,
+            'partitioning': risk.partitioning,
+            'database': risk.database,
+            'db_schema': risk.db_schema,
+            'schema_version': risk.schema_version,
+            'fields': [{'id': f.id, 'name': f.name, 'field_type': f.field_type, 'kwargs': f.kwargs}
+                       for f in fields],
+        } for risk, fields in load_definitions()],
+    }
+    with open(path, 'w') as output:
+        json.dump(snapshot, output)
+    return snapshot
+
+
+def load_snapshot(path):
+    """
+    Returns the (risk, fields) pairs of a snapshot file, or None when the
+    file is missing or older than the catalog. Costs one query.
+    """
+    from .models import Risk, RiskField, SchemaVersion
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('version') != SchemaVersion.current()[0]:
+        return None
+    definitions = []
+    for data in snapshot['risks']:
+        fields = data.pop('fields')
+        risk = Risk(**data)
+        definitions.append((risk, [RiskField(risk_id=risk.id, **field) for field in fields]))
+    return definitions
+
+
+def bootstrap(mode=None, snapshot_path=None):
+    """
+    Builds the dynamic model of every risk up front so no request pays for it:
+    ``build`` loads the definitions in two queries, ``snapshot`` reads them
+    from the file written by the ``dump_schema_snapshot`` command and checks
+    it is current with one query, falling back to ``build`` otherwise.
+    Returns the timing stats, which are also logged.
+    """
+    mode = mode or getattr(settings, 'INSURANCE_BOOTSTRAP', '')
+    if mode not in BOOTSTRAP_MODES:
+        return stats
+    started = time.perf_counter()
+    # From the settings being read to the app being ready, which is mostly importing the apps
+    settings_loaded = getattr(settings, 'INSURANCE_SETTINGS_LOADED_AT', None)
+    if settings_loaded is not None:
+        stats['import_seconds'] = started - settings_loaded
+    queries = len(connection.queries_log)
+    force_debug_cursor, connection.force_debug_cursor = connection.force_debug_cursor, True
+    try:
+        definitions = None
+        if mode == 'snapshot':
+            definitions = load_snapshot(snapshot_path or settings.INSURANCE_SCHEMA_SNAPSHOT)
+            stats['source'] = 'snapshot'
+        if definitions is None:
+            definitions = load_definitions()
+            stats['source'] = 'database'
+        for risk, fields in definitions:
+            risk.build_django_model(fields)
+        stats['models'] = len(definitions)
+    except DatabaseError as err:
+        # e.g. migrate runs before the tables exist, models are then built lazily
+        logger.warning("Registry bootstrap skipped: %s", err)
+        stats['source'] = None
+    finally:
+        connection.force_debug_cursor = force_debug_cursor
+    stats.update({
+        'mode': mode,
+        'bootstrap_seconds': time.perf_counter() - started,
+        'queries': len(connection.queries_log) - queries,
+    })
+    logger.info("Registry bootstrap: %s", stats)
+    return stats
@@ -0,0 +1,360 @@
+import json
+import time
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Prefetch
+from .models import Risk, RiskField, EnumChoice, SchemaVersion
+from .model_utils import SchemaBuilder
+from .enums import ENUM, assign_codes
+from .schema_diff import check_condition
+
+CATALOG_FORMATS = ('json', 'yaml')
+RISK_KEYS = ('name', 'description', 'storage', 'partitioning', 'database', 'db_schema', 'fields')
+FIELD_KEYS = ('name', 'field_type', 'kwargs', 'choices')
+
+
+class CatalogError(ValueError):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def get_yaml():
+    # PyYAML is only needed by YAML catalogs
+    try:
+        import yaml
+    except ImportError:
+        raise CatalogError(['YAML catalogs need PyYAML, install it with "pip install pyyaml"'])
+    return yaml
+
+
+def load_catalog(stream, catalog_format='json'):
+    "Reads a catalog from a file object"
+    if catalog_format == 'yaml':
+        yaml = get_yaml()
+        try:
+            catalog = yaml.safe_load(stream)
+        except yaml.YAMLError as err:
+            raise CatalogError([f'Invalid YAML: {err}'])
+        # Dates, e.g. defaults, are read as text as they are in JSON
+        return json.loads(json.dumps(catalog, default=str))
+    try:
+        return json.load(stream)
+    except ValueError as err:
+        raise CatalogError([f'Invalid JSON: {err}'])
+
+
+def dump_catalog(catalog, stream, catalog_format='json'):
+    "Writes a catalog to a file object"
+    if catalog_format == 'yaml':
+        get_yaml().safe_dump(catalog, stream, sort_keys=False, allow_unicode=True)
+    else:
+        json.dump(catalog, stream, indent=2)
+        stream.write('\n')
+
+
+def export_catalog(risks=None):
+    """
+    Returns the definitions of the risks, all by default, with their fields
+    and the choices of their enums as a catalog that import_catalog() reads
+    back. Choices keep their creation order, which is the order of the codes
+    of an enum. Costs four queries.
+    """
+    risks = Risk.objects.all() if risks is None else risks
+    risks = risks.prefetch_related('fields__choices').order_by('id')
+    return {
+        'version': SchemaVersion.current()[0],
+        'risks': [export_risk(risk) for risk in risks],
+    }
+
+
+def export_risk(risk):
+    fields = []
+    for field in sorted(risk.fields.all(), key=lambda f: f.id):
+        data = {'name': field.name, 'field_type': field.field_type, 'kwargs': field.kwargs}
+        choices = sorted(field.choices.all(), key=lambda c: c.id)
+        if choices:
+            data['choices'] = [{'choice': choice.choice, 'value': choice.value} for choice in choices]
+        fields.append(data)
+    return {
+        'name': risk.name,
+        'description': risk.description,
+        'storage': risk.storage,
+        'partitioning': risk.partitioning,
+        'database': risk.database,
+        'db_schema': risk.db_schema,
+        'fields': fields,
+    }
+
+
+def error_messages(err):
+    if hasattr(err, 'error_dict'):
+        return [message if name == '__all__' else f'{name}: {message}'
+                for name, messages in err.message_dict.items() for message in messages]
+    return err.messages
+
+
+def check_keys(data, keys, kind):
+    if not isinstance(data, dict):
+        raise ValidationError(f'A {kind} must be an object')
+    unknown = set(data) - set(keys)
+    if unknown:
+        raise ValidationError(f"Unknown key(s): {', '.join(sorted(unknown))}")
+
+
+def parse_risk(data):
+    "Returns the unsaved Risk of a catalog entry with its (RiskField, choices) pairs"
+    check_keys(data, RISK_KEYS, 'risk')
+    risk = Risk(name=data.get('name'), description=data.get('description'),
+                storage=data.get('storage', Risk.TABLE), partitioning=data.get('partitioning') or {},
+                database=data.get('database', ''), db_schema=data.get('db_schema', ''))
+    # The name is matched against the current risks rather than kept unique
+    risk.full_clean(validate_unique=False)
+    if not isinstance(data.get('fields', []), list):
+        raise ValidationError('fields: Must be a list')
+    fields, errors = [], []
+    for index, field_data in enumerate(data.get('fields', [])):
+        try:
+            fields.append(parse_field(field_data))
+        except ValidationError as err:
+            name = field_data.get('name') if isinstance(field_data, dict) else None
+            errors.extend(f'fields.{name or index}: {message}' for message in error_messages(err))
+    names = [field.name for field, choices in fields]
+    errors.extend(f'fields.{name}: Defined more than once' for name in sorted(set(names))
+                  if names.count(name) > 1)
+    if errors:
+        raise ValidationError(errors)
+    return risk, fields
+
+
+def parse_field(data):
+    "Returns the unsaved RiskField of a catalog entry with the (choice, value) pairs of its choices"
+    check_keys(data, FIELD_KEYS, 'field')
+    field = RiskField(name=data.get('name'), field_type=data.get('field_type'), kwargs=data.get('kwargs', {}))
+    if not isinstance(field.kwargs, dict):
+        raise ValidationError('kwargs: Must be an object')
+    field.full_clean(exclude=['risk', 'kwargs', 'choices'], validate_unique=False)
+    choices = data.get('choices') or []
+    if not isinstance(choices, list):
+        raise ValidationError('choices: Must be a list')
+    pairs = []
+    for choice_data in choices:
+        check_keys(choice_data, ('choice', 'value'), 'choice')
+        choice = EnumChoice(choice=choice_data.get('choice'), value=choice_data.get('value'))
+        choice.full_clean()
+        pairs.append((choice.choice, choice.value))
+    kwargs = field.kwargs
+    if field.field_type == 'CharField' and not kwargs.get('max_length'):
+        raise ValidationError('Text fields need a max_length')
+    if field.field_type == ENUM or kwargs.get('choices'):
+        if not pairs:
+            raise ValidationError('Enum fields need choices')
+        if kwargs.get('default') and kwargs['default'] not in {value for choice, value in pairs}:
+            raise ValidationError('The default must be the value of one of the choices')
+    elif pairs:
+        raise ValidationError('Only enum fields have choices')
+    if not kwargs.get('db_index') and (kwargs.get('index_with') or kwargs.get('index_condition')):
+        raise ValidationError('Composite and partial indexes need db_index')
+    try:
+        field.get_django_field()
+    except (TypeError, ValueError) as err:
+        raise ValidationError(f'Invalid kwargs: {err}')
+    return field, pairs
+
+
+def schema_state(field, pairs):
+    return field.field_type, field.kwargs, set(pairs)
+
+
+class CatalogImport:
+    """
+    Changes bringing the risks to the definitions of a catalog, found by
+    diffing the catalog with the current risks. Risks and fields are matched
+    by name: the ones missing from the catalog are kept unless ``prune`` is
+    set, renaming one drops it and creates another. The storage, the
+    partitioning and the placement of a risk are not changed, its records
+    would have to move, see the move_risk command.
+    Raises CatalogError with every problem of the catalog before anything is
+    changed.
+    """
+
+    def __init__(self, catalog, prune=False):
+        self.prune = prune
+        risks = catalog.get('risks') if isinstance(catalog, dict) else None
+        if not isinstance(risks, list):
+            raise CatalogError(['A catalog must be an object with a list of risks'])
+        current = {risk.name: risk for risk in Risk.objects.prefetch_related(
+            Prefetch('fields', queryset=RiskField.objects.prefetch_related('choices'), to_attr='current_fields'))}
+        self.created, self.altered, errors, names = [], [], [], []
+        for index, data in enumerate(risks):
+            name = data.get('name') if isinstance(data, dict) else None
+            names.append(name)
+            try:
+                risk, fields = parse_risk(data)
+                if risk.name in current:
+                    change = self.diff_risk(current[risk.name], risk, fields)
+                    if change is not None:
+                        self.altered.append(change)
+                else:
+                    self.check_fields(risk, [field for field, pairs in fields])
+                    self.created.append((risk, fields))
+            except ValidationError as err:
+                errors.extend(f'{name or index}: {message}' for message in error_messages(err))
+        errors.extend(f'{name}: Defined more than once' for name in sorted(set(filter(None, names)))
+                      if names.count(name) > 1)
+        if errors:
+            raise CatalogError(errors)
+        self.deleted = [risk for name, risk in current.items() if name not in names] if prune else []
+
+    def diff_risk(self, risk, new_risk, fields):
+        "Returns the (risk, description, added, changed, removed) changes of a current risk, None when unchanged"
+        if ([getattr(risk, name) for name in ('storage', 'partitioning', 'database', 'db_schema')] !=
+                [getattr(new_risk, name) for name in ('storage', 'partitioning', 'database', 'db_schema')]):
+            raise ValidationError('The storage, the partitioning and the placement of a risk can not be changed')
+        current = {field.name: field for field in risk.current_fields}
+        added, changed = [], []
+        for field, pairs in fields:
+            old = current.get(field.name)
+            if old is None:
+                field.risk = risk
+                added.append((field, pairs))
+            elif schema_state(old, [(c.choice, c.value) for c in old.choices.all()]) != schema_state(field, pairs):
+                old.field_type, old.kwargs = field.field_type, field.kwargs
+                changed.append((old, pairs))
+        names = {field.name for field, pairs in fields}
+        removed = [field for name, field in current.items() if name not in names] if self.prune else []
+        kept = [field for field in risk.current_fields if field.name in names or not self.prune]
+        self.check_fields(risk, [field for field, pairs in added] + kept)
+        description = new_risk.description if new_risk.description != risk.description else None
+        if description is None and not (added or changed or removed):
+            return None
+        return risk, description, added, changed, removed
+
+    def check_fields(self, risk, fields):
+        "Checks the fields a risk will have, the fields to change being updated already"
+        names = {field.name for field in fields}
+        for field in fields:
+            for name in field.kwargs.get('index_with') or []:
+                if name not in names:
+                    raise ValidationError(f'fields.{field.name}: Indexes an unknown field "{name}"')
+            if field.kwargs.get('index_condition'):
+                try:
+                    check_condition(field.kwargs['index_condition'],
+                                    {other.name: other.get_django_field() for other in fields})
+                except ValidationError as error:
+                    raise ValidationError(f'fields.{field.name}: {error.messages[0]}')
+        partitioning = risk.get_partitioning()
+        if partitioning is None:
+            return
+        if any(field.kwargs.get('unique') for field in fields):
+            raise ValidationError('Fields of a partitioned risk can not be unique')
+        if partitioning.field:
+            key = next((field for field in fields if field.name == partitioning.field), None)
+            if key is None or key.field_type != 'DateField' or key.kwargs.get('null'):
+                raise ValidationError(f'"{partitioning.field}" partitions the table, '
+                                      f'it has to be one of the fields, a date that is not null')
+
+    def summary(self):
+        altered = {}
+        for risk, description, added, changed, removed in self.altered:
+            changes = {'added': [field.name for field, pairs in added],
+                       'changed': [field.name for field, pairs in changed],
+                       'removed': [field.name for field in removed]}
+            if description is not None:
+                changes['description'] = description
+            altered[risk.name] = {key: value for key, value in changes.items() if value}
+        return {
+            'created': [risk.name for risk, fields in self.created],
+            'altered': altered,
+            'deleted': [risk.name for risk in self.deleted],
+        }
+
+    def apply(self):
+        """
+        Applies the changes in one transaction: the new risks, their fields
+        and choices are inserted in bulk and their tables created from the
+        models built on the rows in hand, the current risks are altered in a
+        change set each, see SchemaBuilder.change_set(), and the catalog
+        version is bumped once for all the new risks.
+        """
+        with transaction.atomic():
+            choice_ids = get_choice_ids(self.get_choices())
+            # First, a new risk may take the table name of a deleted one
+            for risk in self.deleted:
+                risk.delete()
+            self.create_risks(choice_ids)
+            for risk, description, added, changed, removed in self.altered:
+                if description is not None:
+                    risk.description = description
+                    Risk.objects.filter(pk=risk.pk).update(description=description)
+                    SchemaVersion.bump(risk.pk)
+                with SchemaBuilder.change_set(risk):
+                    for field in removed:
+                        field.delete()
+                    for field, pairs in added + changed:
+                        field.save()
+                        field.choices.set([choice_ids[pair] for pair in dict.fromkeys(pairs)])
+
+    def get_choices(self):
+        "Returns the (choice, value) pairs of the fields to save"
+        fields = [field for risk, fields in self.created for field in fields]
+        for risk, description, added, changed, removed in self.altered:
+            fields.extend(added + changed)
+        return [pair for field, pairs in fields for pair in pairs]
+
+    def create_risks(self, choice_ids):
+        if not self.created:
+            return
+        risks = create_all(Risk, [risk for risk, fields in self.created])
+        for risk, (unused, fields) in zip(risks, self.created):
+            for field, pairs in fields:
+                field.risk = risk
+        create_all(RiskField, [field for risk, fields in self.created for field, pairs in fields])
+        RiskField.choices.through.objects.bulk_create([
+            RiskField.choices.through(riskfield_id=field.id, enumchoice_id=choice_ids[pair])
+            for risk, fields in self.created for field, pairs in fields for pair in dict.fromkeys(pairs)
+        ])
+        assign_codes([field.id for risk, fields in self.created for field, pairs in fields])
+        for risk, fields in self.created:
+            model = risk.build_django_model([field for field, pairs in fields])
+            SchemaBuilder(model).create_db_table(risk.get_partitioning())
+        SchemaVersion.bump(*[risk.id for risk in risks])
+
+
+def create_all(model, objs):
+    "Inserts the objects in one query where the database returns their ids, one by one otherwise"
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    for obj in objs:
+        # Without the schema changes of the save() of the model, made by the caller
+        models.Model.save(obj)
+    return objs
+
+
+def get_choice_ids(pairs):
+    "Returns the {(choice, value): id} of EnumChoices, creating the missing ones in the given order"
+    ids = {}
+    values = {value for choice, value in pairs}
+    # The oldest of identical choices is used
+    for id, choice, value in EnumChoice.objects.filter(value__in=values).order_by('-id').values_list(
+            'id', 'choice', 'value'):
+        ids[(choice, value)] = id
+    missing = [EnumChoice(choice=choice, value=value) for choice, value in dict.fromkeys(pairs)
+               if (choice, value) not in ids]
+    for choice in create_all(EnumChoice, missing):
+        ids[(choice.choice, choice.value)] = choice.id
+    return ids
+
+
+def import_catalog(catalog, prune=False, dry_run=False):
+    """
+    Brings the risks to the definitions of a catalog, see CatalogImport.
+    Returns the names of the risks created, altered and deleted, with the
+    fields added, changed and removed of the altered ones. Nothing is changed
+    with ``dry_run``.
+    """
+    started = time.perf_counter()
+    catalog_import = CatalogImport(catalog, prune)
+    if not dry_run:
+        catalog_import.apply()
+    return dict(catalog_import.summary(), dry_run=dry_run, seconds=time.perf_counter() - started)
@@ -0,0 +1,272 @@
+import datetime
+import json
+import math
+from collections import namedtuple
+from django.core.exceptions import ValidationError
+from django.db import connection, models
+from django.db.models import Expression, Q
+from django.db.models.lookups import Exact
+from django.db.models.sql import Query
+from .schema_diff import FieldSpec, IndexSpec
+from .enums import EnumField
+
+# Fields of the models of document risks holding the columns of RiskRecord,
+# the names can not be used by RiskFields
+RISK_FIELD = 'document_risk'
+DOCUMENT_FIELD = 'document'
+RESERVED_NAMES = ('id', RISK_FIELD, DOCUMENT_FIELD)
+# IMMUTABLE text to date cast returning NULL for non-dates, see migration 0004
+DATE_FUNCTION = 'insurance_document_date'
+
+
+def value_sql(column, key, field_type):
+    """
+    Returns the SQL reading the value of a field from a document column,
+    typed like the column of the field would be. A value stored under
+    another type, e.g. before the field type changed, reads as NULL.
+    """
+    key = f"'{int(key)}'"
+    if field_type == 'IntegerField':
+        return f"(CASE WHEN jsonb_typeof({column} -> {key}) = 'number' THEN ({column} ->> {key})::integer END)"
+    if field_type == 'DateField':
+        return f"{DATE_FUNCTION}({column} ->> {key})"
+    return f"({column} ->> {key})"
+
+
+class DocumentValue(Expression):
+    "The value of a document field in a query, what a Col is to a field with a column"
+
+    def __init__(self, alias, target):
+        super().__init__(output_field=target)
+        self.alias, self.target = alias, target
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.alias}, {self.target})'
+
+    def relabeled_clone(self, relabels):
+        return self.__class__(relabels.get(self.alias, self.alias), self.target)
+
+    def get_group_by_cols(self, alias=None):
+        return [self]
+
+    def column_sql(self, compiler, connection):
+        column = connection.ops.quote_name(self.target.model._meta.get_field(DOCUMENT_FIELD).column)
+        if self.alias is None:
+            return column
+        return f'{compiler.quote_name_unless_alias(self.alias)}.{column}'
+
+    def as_sql(self, compiler, connection):
+        return value_sql(self.column_sql(compiler, connection), self.target.document_key,
+                         self.target.get_internal_type()), []
+
+
+class DocumentExact(Exact):
+    """
+    Equality as JSON containment, which the GIN index of RiskRecord serves.
+    Text fields read numbers and booleans stored before the field type
+    changed as their JSON text, see value_sql(), so they match that value too.
+    """
+
+    def as_sql(self, compiler, connection):
+        if not isinstance(self.lhs, DocumentValue) or hasattr(self.rhs, 'resolve_expression'):
+            return super().as_sql(compiler, connection)
+        target = self.lhs.target
+        values = [target.to_document(self.rhs)]
+        if isinstance(self.rhs, str) and target.get_internal_type() not in ('IntegerField', 'DateField'):
+            try:
+                stored = json.loads(self.rhs)
+            except ValueError:
+                stored = None
+            if isinstance(stored, (int, float)) and math.isfinite(stored):
+                values.append(stored)
+        column = self.lhs.column_sql(compiler, connection)
+        # Each containment is served by the index, a BitmapOr combines them
+        sql = ' OR '.join(f'{column} @> %s' for value in values)
+        return f'({sql})', [json.dumps({target.document_key: value}) for value in values]
+
+
+class DocumentAttribute:
+    "Reads and writes the value of a field in the document of a record"
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        return self.field.from_document(instance.document.get(self.field.document_key))
+
+    def __set__(self, instance, value):
+        instance.document[self.field.document_key] = self.field.to_document(value)
+
+
+class DocumentFieldMixin:
+    """
+    Field of a document risk: it has no column, its value is kept in the
+    document of the record under ``document_key``, the id of its RiskField,
+    so renaming the field leaves the records as they are.
+    """
+    def __init__(self, *args, document_key, **kwargs):
+        self.document_key = document_key
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['document_key'] = self.document_key
+        return name, path, args, kwargs
+
+    def get_attname_column(self):
+        # Not concrete, so left out of the SELECT, INSERT and UPDATE of the model
+        return self.get_attname(), None
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        # Fields without a column get no descriptor from Django
+        setattr(cls, self.attname, DocumentAttribute(self))
+
+    def get_col(self, alias, output_field=None):
+        return DocumentValue(alias, self)
+
+    def get_lookup(self, lookup_name):
+        if lookup_name == 'exact':
+            return DocumentExact
+        return super().get_lookup(lookup_name)
+
+    def from_document(self, value):
+        "Returns a stored value the way value_sql() reads it"
+        if value is None:
+            return None
+        internal_type = self.get_internal_type()
+        if internal_type == 'IntegerField':
+            return value if isinstance(value, int) and not isinstance(value, bool) else None
+        if internal_type == 'DateField':
+            try:
+                return self.to_python(value) if isinstance(value, str) else None
+            except ValidationError:
+                return None
+        return value if isinstance(value, str) else json.dumps(value)
+
+    def to_document(self, value):
+        return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+_field_classes = {}
+
+
+def document_field(risk_field):
+    "Returns the field of a RiskField on the model of a document risk"
+    field = risk_field.get_django_field()
+    if isinstance(field, EnumField):
+        # Documents hold the labels, codes would not make them smaller
+        field = field.text_field()
+    field_class = type(field)
+    if field_class not in _field_classes:
+        _field_classes[field_class] = type(f'Document{field_class.__name__}', (DocumentFieldMixin, field_class), {})
+    name, path, args, kwargs = field.deconstruct()
+    return _field_classes[field_class](*args, document_key=str(risk_field.id), **kwargs)
+
+
+class DocumentQuerySet(models.QuerySet):
+    def bulk_update(self, objs, fields, batch_size=None):
+        # The values of all the fields of a record are in its document
+        fields = {DOCUMENT_FIELD if isinstance(self.model._meta.get_field(name), DocumentFieldMixin) else name
+                  for name in fields}
+        return super().bulk_update(objs, fields, batch_size=batch_size)
+
+
+class DocumentManager(models.Manager.from_queryset(DocumentQuerySet)):
+    "Manager of the records of one document risk"
+
+    def get_queryset(self):
+        return super().get_queryset().filter(**{RISK_FIELD: get_document_risk_id(self.model)})
+
+
+class DocumentRecord(models.Model):
+    """
+    Base of the models of the risks with document storage, which read and
+    write their rows of RiskRecord. See Risk.build_django_model().
+    """
+    id = models.BigAutoField(primary_key=True)
+    document = models.JSONField(default=dict)
+
+    objects = DocumentManager()
+
+    class Meta:
+        abstract = True
+
+
+def document_model_fields(risk, risk_fields):
+    "Returns the (name, field) pairs of the model of a document risk"
+    # Created after the document of DocumentRecord, which Model.__init__ then sets first
+    fields = [(RISK_FIELD, models.IntegerField(db_column='risk_id', default=risk.id, editable=False))]
+    return fields + [(f.name, document_field(f)) for f in risk_fields]
+
+
+def is_document_model(model):
+    return issubclass(model, DocumentRecord)
+
+
+def get_document_risk_id(model):
+    return model._meta.get_field(RISK_FIELD).default
+
+
+def record_fields(model):
+    "Returns the fields of the records of a dynamic model, without the RiskRecord columns"
+    if not is_document_model(model):
+        return model._meta.fields
+    return [field for field in model._meta.fields if field.name not in (RISK_FIELD, DOCUMENT_FIELD)]
+
+
+class DocumentIndexSpec(namedtuple('DocumentIndexSpec', 'name columns condition unique')):
+    """
+    Stored description of an index of a document risk on RiskRecord:
+    ``columns`` the (RiskField id, field type) of its values, ``condition``
+    the JSON text of the lookups of a partial index with the fields given
+    the same way. Renaming fields keeps the specs, their SQL reads ids.
+    """
+
+
+def document_index_specs(risk_id, snapshot):
+    "Returns the DocumentIndexSpecs of the indexed and unique fields of a schema snapshot"
+    fields = {spec.name: spec for spec in snapshot if isinstance(spec, FieldSpec)}
+    specs = []
+    for spec in snapshot:
+        if isinstance(spec, FieldSpec) and spec.get_kwargs().get('unique'):
+            specs.append(DocumentIndexSpec(f'insurance_r{risk_id}_f{spec.key}_uniq',
+                                           ((spec.key, spec.field_type),), None, True))
+        elif isinstance(spec, IndexSpec):
+            columns = tuple((fields[name].key, fields[name].field_type) for name in spec.fields)
+            condition = None
+            if spec.condition:
+                lookups = []
+                for lookup, value in json.loads(spec.condition).items():
+                    name, _, rest = lookup.partition('__')
+                    lookups.append([fields[name].key, fields[name].field_type, rest, value])
+                condition = json.dumps(sorted(lookups, key=lambda item: item[:3]))
+            specs.append(DocumentIndexSpec(spec.name, columns, condition, False))
+    return sorted(specs)
+
+
+def document_index_sql(model, spec, concurrently=False):
+    """
+    Returns the CREATE INDEX of a DocumentIndexSpec for the current model of
+    its risk: an expression index over the values of the fields, partial on
+    the rows of the risk
+    """
+    quote = connection.ops.quote_name
+    column = quote(model._meta.get_field(DOCUMENT_FIELD).column)
+    expressions = ', '.join(f'({value_sql(column, key, field_type)})' for key, field_type in spec.columns)
+    risk_field = model._meta.get_field(RISK_FIELD)
+    where = f'{quote(risk_field.column)} = {int(risk_field.default)}'
+    if spec.condition:
+        names = {field.document_key: field.name for field in record_fields(model)
+                 if isinstance(field, DocumentFieldMixin)}
+        lookups = {'__'.join(filter(None, (names[str(key)], lookup))): value
+                   for key, field_type, lookup, value in json.loads(spec.condition)}
+        query = Query(model, alias_cols=False)
+        condition, params = query.build_where(Q(**lookups)).as_sql(query.get_compiler(connection=connection),
+                                                                   connection)
+        quote_value = connection.schema_editor().quote_value
+        where += ' AND ' + condition % tuple(quote_value(param) for param in params)
+    return (f"CREATE {'UNIQUE ' if spec.unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS {quote(spec.name)} ON {quote(model._meta.db_table)} ({expressions}) WHERE {where}")
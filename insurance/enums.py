@@ -0,0 +1,182 @@
+from collections import namedtuple
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+
+ENUM = 'EnumField'
+# Length of the labels, see EnumChoice.value
+LABEL_LENGTH = 20
+# Largest code of a smallint column
+MAX_CODE = 32767
+
+
+class EnumCodes(namedtuple('EnumCodes', 'by_label by_code')):
+    "Code map of an enum field: {label: code} of its choices and {code: label}"
+
+    @classmethod
+    def from_rows(cls, rows):
+        by_label = dict(rows)
+        return cls(by_label, {code: label for label, code in by_label.items()})
+
+
+def get_codes_queryset(risk_field_id):
+    "Returns the (label, code) rows of the choices of an enum field"
+    from .models import EnumCode
+    return EnumCode.objects.filter(risk_field=risk_field_id, choice__riskfield=risk_field_id).values_list(
+        'choice__value', 'code')
+
+
+def assign_codes(risk_field_ids):
+    """
+    Gives the choices of the fields that have no code yet the next codes of
+    their field, in the order the choices were created
+    """
+    from .models import RiskField, EnumCode
+    through = RiskField.choices.through
+    with transaction.atomic():
+        # Fields taking codes at once wait for each other
+        risk_field_ids = list(RiskField.objects.select_for_update().filter(pk__in=risk_field_ids).order_by('pk')
+                              .values_list('pk', flat=True))
+        codes, next_codes = set(), {}
+        for risk_field_id, choice_id, code in EnumCode.objects.filter(risk_field__in=risk_field_ids).values_list(
+                'risk_field', 'choice', 'code'):
+            codes.add((risk_field_id, choice_id))
+            next_codes[risk_field_id] = max(next_codes.get(risk_field_id, 1), code + 1)
+        missing = []
+        links = through.objects.filter(riskfield__in=risk_field_ids).order_by('enumchoice')
+        for risk_field_id, choice_id in links.values_list('riskfield', 'enumchoice'):
+            if (risk_field_id, choice_id) in codes:
+                continue
+            code = next_codes.get(risk_field_id, 1)
+            if code > MAX_CODE:
+                raise ValidationError(f'An enum field can not take more than {MAX_CODE} choices')
+            next_codes[risk_field_id] = code + 1
+            missing.append(EnumCode(risk_field_id=risk_field_id, choice_id=choice_id, code=code))
+        EnumCode.objects.bulk_create(missing)
+
+
+class EnumField(models.SmallIntegerField):
+    """
+    Enum of a risk stored as a small integer code, the EnumCode of each value
+    in the field. Values are the labels, the EnumChoice values, converted with
+    the code map of the field which is loaded on first use and kept with the
+    dynamic model, so it is rebuilt along with the model when the choices
+    change. Codes order by addition of the choices to the field then by their
+    creation, not by label, and codes of choices removed from the field read
+    as None until they are added back.
+    """
+    description = 'Enum'
+
+    def __init__(self, *args, enum_key=None, **kwargs):
+        # The id of the RiskField whose EnumChoices give the codes
+        self.enum_key = enum_key
+        self._codes = None
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['enum_key'] = self.enum_key
+        return name, path, args, kwargs
+
+    @property
+    def has_codes(self):
+        return self._codes is not None
+
+    def set_codes(self, rows):
+        self._codes = EnumCodes.from_rows(rows)
+
+    def get_codes(self):
+        if self._codes is None:
+            self.set_codes(get_codes_queryset(self.enum_key))
+        return self._codes
+
+    def get_label(self, code):
+        return self.get_codes().by_code.get(code)
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else self.get_label(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str) and value in self.get_codes().by_label:
+            return value
+        if isinstance(value, int) and not isinstance(value, bool):
+            return self.get_label(value)
+        raise ValidationError(f'"{value}" is not a valid choice.', code='invalid_choice')
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, int) and not isinstance(value, bool):
+            return value
+        try:
+            return self.get_codes().by_label[value]
+        except KeyError:
+            raise ValueError(f'"{value}" is not a valid choice of {self.name}')
+
+    def text_field(self):
+        "Returns the text field holding the labels instead, e.g. in documents"
+        name, path, args, kwargs = super().deconstruct()
+        return models.CharField(*args, **dict(kwargs, max_length=LABEL_LENGTH, choices=True))
+
+
+def build_field(field_type, kwargs, risk_field_id):
+    "Returns the Django field of a RiskField type and kwargs"
+    if field_type == ENUM:
+        return EnumField(enum_key=risk_field_id, **kwargs)
+    return getattr(models, field_type)(**kwargs)
+
+
+def is_text_enum(field):
+    "Text columns holding the labels of an enum, as created before EnumField"
+    return getattr(field, 'choices', None) is True
+
+
+def conversion_map(old_field, new_field):
+    """
+    Returns the {old value: new value} of a column turned from text enum to
+    EnumField or back, None for any other change
+    """
+    if isinstance(new_field, EnumField) and not isinstance(old_field, EnumField):
+        return new_field.get_codes().by_label
+    if isinstance(old_field, EnumField) and not isinstance(new_field, EnumField):
+        return old_field.get_codes().by_code
+    return None
+
+
+def conversion_sql(column, mapping, connection=connection):
+    "Returns a CASE expression mapping the values of a column, unknown values become NULL"
+    if not mapping:
+        return 'NULL'
+    quote_value = connection.schema_editor().quote_value
+    cases = ' '.join(f'WHEN {quote_value(old)} THEN {quote_value(new)}' for old, new in mapping.items())
+    return f'CASE {column} {cases} END'
+
+
+def relabel_sql(table, column, mapping, connection=connection):
+    """
+    Returns the UPDATE of the values of a text column from a conversion map,
+    which turns labels into codes before the column type changes, or codes
+    into labels after
+    """
+    column = connection.ops.quote_name(column)
+    mapping = {str(old): str(new) for old, new in mapping.items()}
+    return f'UPDATE {connection.ops.quote_name(table)} SET {column} = {conversion_sql(column, mapping, connection)}'
+
+
+def compact_text_enums(risk, online=False):
+    """
+    Turns the text enums of a risk stored in a table of its own into
+    EnumFields, their labels into codes, in one change set. Returns the names
+    of the fields converted.
+    """
+    from .model_utils import SchemaBuilder
+    risk_fields = [field for field in risk.fields.all()
+                   if field.field_type == 'CharField' and field.kwargs.get('choices')]
+    if risk.storage != risk.TABLE or not risk_fields:
+        return []
+    # Choices linked in bulk, e.g. by the catalog, have no codes yet
+    assign_codes([risk_field.id for risk_field in risk_fields])
+    with SchemaBuilder.change_set(risk, online=online):
+        for risk_field in risk_fields:
+            risk_field.field_type = ENUM
+            risk_field.kwargs = {key: value for key, value in risk_field.kwargs.items()
+                                 if key not in ('choices', 'max_length')}
+            risk_field.save()
+    return [risk_field.name for risk_field in risk_fields]
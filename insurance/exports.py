@@ -0,0 +1,55 @@
+import csv
+from django.core.serializers.json import DjangoJSONEncoder
+from .documents import record_fields
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class Echo:
+    "File-like object handing back what csv.writer writes"
+    def write(self, value):
+        return value
+
+
+def get_export_columns(model, fields=None):
+    "Returns the columns to export, all of them unless a projection is given"
+    names = [f.name for f in record_fields(model)]
+    if not fields:
+        return names
+    unknown = [name for name in fields if name not in names]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    return list(fields)
+
+
+def export_records(model, output='ndjson', fields=None, since=None, chunk_size=2000):
+    """
+    Yields the records of a dynamic model as NDJSON or CSV text, one chunk of
+    rows at a time. Rows are read in primary key order through a server-side
+    cursor so memory use does not depend on the size of the table. ``since``
+    only exports the records with a greater id than the given one.
+    """
+    if output not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {output}")
+    columns = get_export_columns(model, fields)
+    queryset = model.objects.order_by('pk').values_list(*columns)
+    if since is not None:
+        queryset = queryset.filter(pk__gt=since)
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(columns)
+        format_row = writer.writerow
+    else:
+        encoder = DjangoJSONEncoder()
+        format_row = lambda row: encoder.encode(dict(zip(columns, row))) + '\n'
+    lines = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        lines.append(format_row(row))
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
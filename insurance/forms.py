@@ -1,6 +1,9 @@
+import json
 from django import forms
 from django.core.exceptions import ValidationError
-from .models import RiskField, EnumChoice
+from .models import RiskField, EnumChoice, validate_variable
+from .enums import build_field
+from .schema_diff import check_condition
 from datetime import datetime
 
 
@@ -8,12 +11,18 @@ class RiskFieldForm(forms.ModelForm):
     max_length = forms.IntegerField(required=False, min_value=1)
     null = forms.BooleanField(required=False)
     default = forms.CharField(max_length=20, required=False)
+    db_index = forms.BooleanField(required=False, label='Index')
+    index_with = forms.CharField(max_length=200, required=False,
+                                 help_text='Other fields of a composite index, comma separated')
+    index_condition = forms.CharField(max_length=200, required=False,
+                                      help_text='Lookups of a partial index, e.g. {"status": "active"}')
     kwargs = forms.CharField(widget=forms.Textarea(attrs={'rows': 2, 'readonly': 'readonly'}),
                              label='KWARGS - (not editable)', required=False)
 
     class Meta:
         model = RiskField
-        fields = ['name', 'field_type', 'max_length', 'null', 'default', 'choices', 'kwargs']
+        fields = ['name', 'field_type', 'max_length', 'null', 'default', 'choices', 'db_index', 'index_with',
+                  'index_condition', 'kwargs']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -23,6 +32,10 @@ class RiskFieldForm(forms.ModelForm):
             if kwargs.get('choices'):
                 self.initial.update({'field_type': 'EnumField'})
                 update_kwargs.pop('choices')
+            if kwargs.get('index_with'):
+                update_kwargs['index_with'] = ', '.join(kwargs['index_with'])
+            if kwargs.get('index_condition'):
+                update_kwargs['index_condition'] = json.dumps(kwargs['index_condition'])
             self.initial.update(update_kwargs)
 
     def clean_name(self):
@@ -63,6 +76,39 @@ class RiskFieldForm(forms.ModelForm):
             raise ValidationError('This field is required for Enum field')
         return value
 
+    def clean_index_with(self):
+        value = self.cleaned_data.get('index_with')
+        names = [name.strip().lower() for name in value.split(',') if name.strip()]
+        for name in names:
+            validate_variable(name)
+        return names
+
+    def clean_index_condition(self):
+        value = self.cleaned_data.get('index_condition')
+        if not value:
+            return {}
+        try:
+            condition = json.loads(value)
+        except ValueError:
+            raise ValidationError('Condition must be a JSON object of lookups')
+        if not isinstance(condition, dict):
+            raise ValidationError('Condition must be a JSON object of lookups')
+        for lookup in condition:
+            if not lookup.split('__')[0]:
+                raise ValidationError('Lookups must start with a field name')
+            validate_variable(lookup.split('__')[0])
+        return condition
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('db_index') and (cleaned_data.get('index_with') or cleaned_data.get('index_condition')):
+            raise ValidationError('Composite and partial indexes need Index to be checked')
+        choices = cleaned_data.get('choices')
+        if cleaned_data.get('field_type') == 'EnumField' and cleaned_data.get('default') and choices is not None:
+            if cleaned_data['default'] not in {choice.value for choice in choices}:
+                self.add_error('default', 'The default must be the value of one of the choices')
+        return cleaned_data
+
     def save(self, commit=True):
         form = super().save(commit=False)
         data = self.cleaned_data
@@ -74,12 +120,16 @@ class RiskFieldForm(forms.ModelForm):
         else:
             if default_val:
                 kwargs_data.update({'default': default_val})
-        if field_type == 'EnumField':
-            form.field_type = 'CharField'
-            kwargs_data.update({'choices': True, 'max_length': 20})
-        else:
+        # Enums are stored as the codes of their choices, see insurance.enums.EnumField
+        if field_type != 'EnumField':
             data.update({'choices': []})
         kwargs_data.update({'null': data.get('null')})
+        if data.get('db_index'):
+            kwargs_data.update({'db_index': True})
+            if data.get('index_with'):
+                kwargs_data.update({'index_with': data.get('index_with')})
+            if data.get('index_condition'):
+                kwargs_data.update({'index_condition': data.get('index_condition')})
         form.kwargs = kwargs_data
         if commit:
             form.save()
@@ -88,3 +138,43 @@ class RiskFieldForm(forms.ModelForm):
             else:
                 form.choices.set([])
         return form
+
+
+class RiskFieldFormSet(forms.BaseInlineFormSet):
+    def clean(self):
+        super().clean()
+        self.clean_index_conditions()
+        try:
+            partitioning = self.instance.get_partitioning()
+        except ValueError:
+            # Reported on the partitioning of the risk form
+            return
+        if partitioning is None or not partitioning.field:
+            return
+        # The partition key is found by its saved name as well, the field may be renamed
+        key = None
+        for form in self.forms:
+            data = getattr(form, 'cleaned_data', None)
+            if data and not data.get('DELETE') and partitioning.field in (data.get('name'), form.initial.get('name')):
+                key = data
+        if key is None:
+            raise ValidationError(f'"{partitioning.field}" partitions the table, it has to be one of the fields')
+        if key.get('field_type') != 'DateField' or key.get('null'):
+            raise ValidationError(f'"{partitioning.field}" partitions the table, it has to be a date that is not null')
+
+    def clean_index_conditions(self):
+        # The lookups of the partial indexes are checked against the fields the risk will have
+        forms = [form for form in self.forms
+                 if getattr(form, 'cleaned_data', None) and not form.cleaned_data.get('DELETE')
+                 and form.cleaned_data.get('name') and form.cleaned_data.get('field_type')]
+        fields = {}
+        for form in forms:
+            data = form.cleaned_data
+            kwargs = {'max_length': data.get('max_length') or 1} if data['field_type'] == 'CharField' else {}
+            fields[data['name']] = build_field(data['field_type'], kwargs, form.instance.id)
+        for form in forms:
+            if form.cleaned_data.get('index_condition'):
+                try:
+                    check_condition(form.cleaned_data['index_condition'], fields)
+                except ValidationError as error:
+                    form.add_error('index_condition', error)
@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+import time
+from datetime import date, datetime
+from django.db import transaction
+from .aggregations import records_changed
+from .documents import RISK_FIELD, DOCUMENT_FIELD, is_document_model
+from .enums import ENUM, EnumField
+from .placement import model_connection
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+# Bounds of a PostgreSQL integer column, checked here so a bad value
+# rejects its row instead of aborting the COPY of a whole batch
+MIN_INTEGER, MAX_INTEGER = -2147483648, 2147483647
+
+
+class RowError(ValueError):
+    pass
+
+
+def to_char(value, field):
+    value = str(value)
+    max_length = field.kwargs.get('max_length')
+    if max_length is not None and len(value) > max_length:
+        raise RowError(f'Ensure this value has at most {max_length} characters.')
+    return value
+
+
+def to_integer(value, field):
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise RowError('A valid integer is required.')
+    try:
+        value = int(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise RowError('A valid integer is required.')
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise RowError('Integer out of range.')
+    return value
+
+
+def to_date(value, field):
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        raise RowError('Date must be in "YYYY-MM-DD" format.')
+
+
+CONVERTERS = {
+    'CharField': to_char,
+    'EnumField': to_char,
+    'IntegerField': to_integer,
+    'DateField': to_date,
+}
+
+
+class RecordValidator:
+    """
+    Checks import rows against the RiskField definitions of a risk: field
+    type, EnumChoice values and the null/max_length/default kwargs. Rows are
+    dicts keyed by field name; the ``id`` column of an export is ignored.
+    """
+
+    def __init__(self, risk):
+        self.fields = list(risk.fields.prefetch_related('choices').order_by('id'))
+        self.columns = [field.name for field in self.fields]
+        self.choices = {field.name: {choice.value for choice in field.choices.all()}
+                        for field in self.fields if field.field_type == ENUM or field.kwargs.get('choices')}
+
+    def validate(self, row):
+        "Returns the row as a tuple of column values and a dict of errors"
+        values, errors = [], {}
+        unknown = set(row) - set(self.columns) - {'id'}
+        if unknown:
+            errors['non_field_errors'] = [f"Unknown field(s): {', '.join(sorted(unknown))}"]
+        for field in self.fields:
+            try:
+                values.append(self.clean(field, row.get(field.name)))
+            except RowError as err:
+                errors[field.name] = [str(err)]
+        return tuple(values), errors
+
+    def clean(self, field, value):
+        # An empty CSV cell is a missing value, except for plain text fields
+        if value is None or value == '' and (field.field_type != 'CharField' or field.kwargs.get('choices')):
+            if 'default' in field.kwargs:
+                value = field.kwargs['default']
+            elif field.kwargs.get('null'):
+                return None
+            else:
+                raise RowError('This field cannot be null.')
+        value = CONVERTERS[field.field_type](value, field)
+        choices = self.choices.get(field.name)
+        if choices is not None and value not in choices:
+            raise RowError(f'"{value}" is not a valid choice.')
+        return value
+
+
+def read_rows(stream, input_format):
+    "Yields (line number, row dict or None when the line can not be parsed)"
+    if input_format == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), start=2):
+            yield number, row
+    else:
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+
+
+def copy_value(value):
+    # Escaping of the COPY text format, \N stands for NULL
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(model, columns, rows):
+    "Loads value tuples into the model table, with COPY FROM STDIN on PostgreSQL"
+    if not rows:
+        return
+    connection = model_connection(model)
+    if connection.vendor != 'postgresql':
+        model.objects.bulk_create([model(**dict(zip(columns, row))) for row in rows])
+        return
+    if is_document_model(model):
+        # The values of each row go into the document of a RiskRecord row
+        records = [model(**dict(zip(columns, row))) for row in rows]
+        columns = [model._meta.get_field(name).column for name in (RISK_FIELD, DOCUMENT_FIELD)]
+        rows = [(record.document_risk, json.dumps(record.document)) for record in records]
+    else:
+        # Enum labels go in as their codes
+        fields = [model._meta.get_field(name) for name in columns]
+        if any(isinstance(field, EnumField) for field in fields):
+            rows = [tuple(field.get_prep_value(value) if isinstance(field, EnumField) else value
+                          for field, value in zip(fields, row)) for row in rows]
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    quote = connection.ops.quote_name
+    sql = f"COPY {quote(model._meta.db_table)} ({', '.join(quote(c) for c in columns)}) FROM STDIN"
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(sql, buffer)
+
+
+def import_records(risk, stream, input_format='csv', batch_size=10000, rejects=None, progress=None):
+    """
+    Validates and loads records from a CSV or NDJSON stream into the table of a
+    risk, one COPY per batch. Each batch is committed on its own so a long
+    import can be followed and resumed. Rejected rows are written as NDJSON to
+    ``rejects`` along with their line number and errors. ``progress`` is called
+    after every batch with the running totals.
+    """
+    if input_format not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {input_format}")
+    model = risk.get_django_model()
+    validator = RecordValidator(risk)
+    stats = {'loaded': 0, 'rejected': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    started = time.perf_counter()
+    batch = []
+
+    def update_stats():
+        stats['seconds'] = time.perf_counter() - started
+        stats['rows_per_second'] = (stats['loaded'] + stats['rejected']) / (stats['seconds'] or 1)
+
+    def flush():
+        with transaction.atomic(using=model_connection(model).alias):
+            copy_rows(model, validator.columns, batch)
+            records_changed(risk.id)
+        stats['loaded'] += len(batch)
+        batch.clear()
+        update_stats()
+        if progress is not None:
+            progress(stats)
+
+    for number, row in read_rows(stream, input_format):
+        if row is None:
+            values, errors = None, {'non_field_errors': ['Line is not a JSON object.']}
+        else:
+            values, errors = validator.validate(row)
+        if errors:
+            stats['rejected'] += 1
+            if rejects is not None:
+                rejects.write(json.dumps({'line': number, 'errors': errors, 'row': row}) + '\n')
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    update_stats()
+    return stats
@@ -0,0 +1,80 @@
+import json
+import sys
+import time
+from contextlib import redirect_stdout
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from insurance import benchmarks
+
+# name: (unit, run), the suites run in one transaction that is rolled back
+SUITES = {
+    'risk_iteration': ('microseconds per row',
+                       lambda options: benchmarks.bench_risk_iteration(rows=options['rows'],
+                                                                       repeat=options['repeat'])),
+    'schema_diff': ('microseconds per diff', lambda options: benchmarks.bench_schema_diff()),
+    'model_build': ('milliseconds per build', lambda options: benchmarks.bench_model_build()),
+    'risks_fields_api': ('milliseconds per request',
+                         lambda options: benchmarks.bench_risks_fields_api(repeat=options['repeat'])),
+    'admin_save': ('milliseconds per save', lambda options: benchmarks.bench_admin_save()),
+    'schema_changes': ('milliseconds per change', lambda options: benchmarks.bench_schema_changes()),
+    'ingest': ('rows per second', lambda options: benchmarks.bench_ingest(rows=options['ingest_rows'])),
+    'storage_throughput': ('rows per second',
+                           lambda options: benchmarks.bench_storage_throughput(rows=options['ingest_rows'],
+                                                                               repeat=options['repeat'])),
+    'storage_schema_changes': ('milliseconds per change',
+                               lambda options: benchmarks.bench_storage_schema_changes(rows=options['ingest_rows'])),
+    'enum_storage': ('bytes per row', lambda options: benchmarks.bench_enum_storage(rows=options['ingest_rows'])),
+    'enum_validation': ('microseconds per record',
+                        lambda options: benchmarks.bench_enum_validation(repeat=options['repeat'])),
+}
+
+
+class Command(BaseCommand):
+    help = ('Runs the dynamic model benchmarks inside a transaction that is rolled back, against a '
+            'throwaway database. --json writes the results for comparing commits')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--ingest-rows', type=int, default=10000)
+        parser.add_argument('--only', nargs='+', choices=list(SUITES), help='Suites to run, all by default')
+        parser.add_argument('--json', nargs='?', const='-', metavar='PATH',
+                            help='Write the results as JSON to PATH, or to stdout')
+
+    def handle(self, *args, **options):
+        names = options['only'] or list(SUITES)
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(f'Unsupported database: {connection.vendor}')
+        started = time.time()
+        results = {}
+        # SQLite only changes tables in a transaction with the foreign key checks off.
+        # The API suites go through the test client. Prints of the code under test
+        # go to stderr, stdout may hold the JSON
+        with connection.constraint_checks_disabled(), transaction.atomic(), redirect_stdout(sys.stderr), \
+                override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            for name in names:
+                results[name] = SUITES[name][1](options)
+            transaction.set_rollback(True)
+        if options['json'] is None:
+            for name in names:
+                self.report(f'{name}, {SUITES[name][0]}', results[name])
+            return
+        document = {
+            'started_at': started,
+            'environment': benchmarks.get_environment(),
+            'options': {key: options[key] for key in ('rows', 'repeat', 'ingest_rows')},
+            'suites': {name: {'unit': SUITES[name][0], 'results': results[name]} for name in names},
+        }
+        output = json.dumps(document, indent=2, sort_keys=True)
+        if options['json'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['json'], 'w') as output_file:
+                output_file.write(output + '\n')
+
+    def report(self, title, results):
+        self.stdout.write(title)
+        for name, value in results.items():
+            self.stdout.write(f'  {name:<24} {value:10.1f}')
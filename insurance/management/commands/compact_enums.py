@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from insurance.models import Risk
+from insurance.enums import compact_text_enums
+
+
+class Command(BaseCommand):
+    help = "Converts the enums stored as text into small integer codes, see insurance.enums.EnumField"
+
+    def add_arguments(self, parser):
+        parser.add_argument('risk_ids', type=int, nargs='*', help='Risks to convert, all by default')
+        parser.add_argument('--online', action='store_true',
+                            help='Convert with the online schema editor, for large tables on PostgreSQL')
+
+    def handle(self, *args, **options):
+        risks = Risk.objects.order_by('id')
+        if options['risk_ids']:
+            risks = risks.filter(pk__in=options['risk_ids'])
+        for risk in risks:
+            names = compact_text_enums(risk, online=options['online'])
+            if names:
+                self.stdout.write(f"{risk.name}: {', '.join(names)}")
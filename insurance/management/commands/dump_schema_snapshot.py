@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from insurance.bootstrap import dump_snapshot
+
+
+class Command(BaseCommand):
+    help = "Writes the risk definitions the 'snapshot' bootstrap builds the dynamic models from"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output', default=settings.INSURANCE_SCHEMA_SNAPSHOT,
+                            help='File to write to, INSURANCE_SCHEMA_SNAPSHOT by default')
+
+    def handle(self, *args, **options):
+        snapshot = dump_snapshot(options['output'])
+        self.stdout.write(f"{len(snapshot['risks'])} risk(s) at catalog version {snapshot['version']} "
+                          f"written to {options['output']}")
@@ -0,0 +1,30 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from insurance.models import Risk
+from insurance.catalog import export_catalog, dump_catalog, CatalogError, CATALOG_FORMATS
+
+
+class Command(BaseCommand):
+    help = "Writes the definitions of the risks, their fields and enum choices as a JSON or YAML catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Risks to export, all by default')
+        parser.add_argument('--output-format', choices=CATALOG_FORMATS, default='json')
+        parser.add_argument('-o', '--output', help='File to write to, standard output by default')
+
+    def handle(self, *args, **options):
+        risks = Risk.objects.all()
+        if options['names']:
+            risks = risks.filter(name__in=options['names'])
+            missing = set(options['names']) - set(risks.values_list('name', flat=True))
+            if missing:
+                raise CommandError(f"Unknown risk(s): {', '.join(sorted(missing))}")
+        catalog = export_catalog(risks)
+        stream = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            dump_catalog(catalog, stream, options['output_format'])
+        except CatalogError as err:
+            raise CommandError('\n'.join(err.errors))
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from insurance.models import Risk
+from insurance.exports import export_records, EXPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = "Streams the records of a risk's table as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('risk_id', type=int)
+        parser.add_argument('--output-format', choices=list(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--fields', help='Comma separated list of columns to export')
+        parser.add_argument('--since', type=int, help='Only export records with a greater id')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('-o', '--output', help='File to write to, standard output by default')
+
+    def handle(self, *args, **options):
+        try:
+            risk = Risk.objects.get(pk=options['risk_id'])
+        except Risk.DoesNotExist:
+            raise CommandError(f"Risk {options['risk_id']} does not exist")
+        fields = options['fields'].split(',') if options['fields'] else None
+        chunks = export_records(risk.get_django_model(), options['output_format'], fields,
+                                options['since'], options['chunk_size'])
+        stream = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for chunk in chunks:
+                stream.write(chunk)
+        except ValueError as err:
+            raise CommandError(err)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
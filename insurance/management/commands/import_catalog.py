@@ -0,0 +1,43 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from insurance.catalog import import_catalog, load_catalog, CatalogError, CATALOG_FORMATS
+
+
+class Command(BaseCommand):
+    help = ("Creates and alters the risks, their fields and enum choices to match a JSON or YAML catalog, "
+            "in one transaction")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Catalog to import, '-' for standard input")
+        parser.add_argument('--input-format', choices=CATALOG_FORMATS,
+                            help='Format of the catalog, from the file extension by default')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete the risks and fields missing from the catalog, with their records')
+        parser.add_argument('--dry-run', action='store_true', help='Only show the changes')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['input_format'] or ('yaml' if path.endswith(('.yaml', '.yml')) else 'json')
+        stream = sys.stdin if path == '-' else open(path)
+        try:
+            changes = import_catalog(load_catalog(stream, input_format), options['prune'], options['dry_run'])
+        except CatalogError as err:
+            raise CommandError('Invalid catalog:\n' + '\n'.join(err.errors))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        for name in changes['created']:
+            self.stdout.write(f'+ {name}')
+        for name, altered in changes['altered'].items():
+            parts = [f"{key} {', '.join(altered[key])}" for key in ('added', 'changed', 'removed') if key in altered]
+            if 'description' in altered:
+                parts.append('new description')
+            self.stdout.write(f"~ {name}: {'; '.join(parts)}")
+        for name in changes['deleted']:
+            self.stdout.write(f'- {name}')
+        summary = (f"{len(changes['created'])} created, {len(changes['altered'])} altered, "
+                   f"{len(changes['deleted'])} deleted")
+        if options['dry_run']:
+            self.stdout.write(f'Dry run, nothing changed: {summary}')
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Imported the catalog in {changes['seconds']:.1f}s: {summary}"))
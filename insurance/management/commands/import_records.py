@@ -0,0 +1,38 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from insurance.models import Risk
+from insurance.imports import import_records, IMPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = "Validates CSV or NDJSON records and loads them into a risk's table with COPY"
+
+    def add_arguments(self, parser):
+        parser.add_argument('risk_id', type=int)
+        parser.add_argument('path', help="File to import, '-' for standard input")
+        parser.add_argument('--input-format', choices=IMPORT_FORMATS, default='csv')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--rejects', help='File receiving the rejected rows as NDJSON')
+
+    def handle(self, *args, **options):
+        try:
+            risk = Risk.objects.get(pk=options['risk_id'])
+        except Risk.DoesNotExist:
+            raise CommandError(f"Risk {options['risk_id']} does not exist")
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], newline='')
+        rejects = open(options['rejects'], 'w') if options['rejects'] else None
+        try:
+            stats = import_records(risk, stream, options['input_format'], options['batch_size'],
+                                   rejects, self.report)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if rejects is not None:
+                rejects.close()
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['loaded']} records, rejected {stats['rejected']} in {stats['seconds']:.1f}s"
+        ))
+
+    def report(self, stats):
+        self.stdout.write(f"loaded {stats['loaded']} rejected {stats['rejected']} "
+                          f"({stats['rows_per_second']:.0f} rows/s)")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from insurance.benchmarks import bench_api_throughput
+
+# Prefix of the databases created by the test runner
+TEST_DATABASE_PREFIX = 'test_'
+
+
+class Command(BaseCommand):
+    help = ('Compares the throughput of the sync API under WSGI with the async API under ASGI. The benchmark '
+            'data is committed, so it runs against a test database unless --commit is given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--records', type=int, default=100)
+        parser.add_argument('--commit', action='store_true',
+                            help='Run against any database, the benchmark data is committed and removed afterwards')
+
+    def handle(self, *args, **options):
+        # Unlike the benchmark command it can not roll back, the async views use connections of their own
+        name = connection.settings_dict['NAME'] or ''
+        if not options['commit'] and not str(name).startswith(TEST_DATABASE_PREFIX):
+            raise CommandError(f'{name} is not a test database, pass --commit to run against it anyway')
+        results = bench_api_throughput(requests=options['requests'], concurrency=options['concurrency'],
+                                       records=options['records'])
+        self.stdout.write('API throughput, requests per second')
+        for name, value in results.items():
+            self.stdout.write(f'  {name:<16} {value:10.1f}')
@@ -0,0 +1,22 @@
+import datetime
+from django.core.management.base import BaseCommand
+from insurance.partitions import maintain_partitions
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = ("Creates the upcoming range partitions of the partitioned risks and drops the ones past their "
+            "retention, run daily")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--today', type=parse_date,
+                            help='Date to maintain the partitions for, YYYY-MM-DD, today by default')
+
+    def handle(self, *args, **options):
+        results = maintain_partitions(options['today'])
+        for risk_id, changes in sorted(results.items()):
+            self.stdout.write(f"Risk {risk_id}: created {', '.join(changes['created']) or 'none'}, "
+                              f"dropped {', '.join(changes['dropped']) or 'none'}")
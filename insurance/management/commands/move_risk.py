@@ -0,0 +1,34 @@
+import copy
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from insurance.models import Risk
+from insurance.placement import move_risk, MOVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Moves the table of a risk to another database alias or PostgreSQL schema, see insurance.placement"
+
+    def add_arguments(self, parser):
+        parser.add_argument('risk_id', type=int)
+        parser.add_argument('--database', default='', help='Alias of the target database, the default one by default')
+        parser.add_argument('--schema', default='', help='Target PostgreSQL schema, the search path by default')
+        parser.add_argument('--batch-size', type=int, default=MOVE_BATCH_SIZE,
+                            help='Rows copied at a time when moving to another database')
+
+    def handle(self, *args, **options):
+        try:
+            risk = Risk.objects.get(pk=options['risk_id'])
+        except Risk.DoesNotExist:
+            raise CommandError(f"Risk {options['risk_id']} does not exist")
+        # Checked like a risk created there
+        placed = copy.copy(risk)
+        placed.database, placed.db_schema = options['database'], options['schema']
+        try:
+            placed.clean()
+        except ValidationError as err:
+            raise CommandError('; '.join(err.messages))
+        source = risk.get_placement_alias()
+        if not move_risk(risk, options['database'], options['schema'], options['batch_size']):
+            self.stdout.write(f'{risk.name} is on {source} already')
+            return
+        self.stdout.write(self.style.SUCCESS(f'Moved {risk.name} from {source} to {risk.get_placement_alias()}'))
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from asgiref.local import Local
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+HELP = {
+    'request': 'Requests served',
+    'db_query': 'SQL statements run',
+    'model_build': 'Dynamic model classes built',
+    'ddl': 'Schema changes run by SchemaBuilder',
+    'serialization': 'Serializer data rendered',
+}
+# Statements kept per request for the slow request log
+SLOW_LOG_STATEMENTS = 50
+# Label of what runs outside of a request, e.g. the bootstrap or a command
+NO_ENDPOINT = '-'
+
+_current = Local()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    "Observations of one request, added to the registry with its endpoint when it ends"
+
+    def __init__(self, collect_sql=False):
+        self.observations = {}
+        self.sql = [] if collect_sql else None
+
+
+class MetricsRegistry:
+    """
+    Counts and durations of the work done per endpoint: for every
+    observation ``name``, ``<namespace>_<name>_total`` counts the
+    observations and ``<namespace>_<name>_seconds_total`` sums their time,
+    as Prometheus counters. Observations made during a request are kept with
+    it until its endpoint is known, see insurance.middleware.MetricsMiddleware.
+    """
+
+    def __init__(self, namespace='insurance'):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def add(self, name, labels, count, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = self._values.setdefault(key, [0, 0.0])
+            values[0] += count
+            values[1] += seconds
+
+    def observe(self, name, seconds, **labels):
+        request = getattr(_current, 'request', None)
+        if request is None:
+            self.add(name, dict(labels, endpoint=NO_ENDPOINT), 1, seconds)
+            return
+        values = request.observations.setdefault((name, tuple(sorted(labels.items()))), [0, 0.0])
+        values[0] += 1
+        values[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        "Observes the time of the block, unless it runs inside another timer of the same name"
+        timing = getattr(_current, 'timing', None)
+        if timing is None:
+            timing = _current.timing = set()
+        if name in timing:
+            yield
+            return
+        timing.add(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing.discard(name)
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name):
+        "Decorator observing the time of a method, labelled with its name"
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, operation=func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_query(self, sql, params, seconds):
+        self.observe('db_query', seconds)
+        request = getattr(_current, 'request', None)
+        if request is not None and request.sql is not None and len(request.sql) < SLOW_LOG_STATEMENTS:
+            request.sql.append((seconds, sql, params))
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record_query(sql, params, time.perf_counter() - started)
+
+    def install(self):
+        "Times the queries of every database connection"
+        def add_wrapper(connection, **kwargs):
+            if self.query_wrapper not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self.query_wrapper)
+        connection_created.connect(add_wrapper, weak=False, dispatch_uid='insurance-metrics')
+        for connection in connections.all():
+            if connection.connection is not None:
+                add_wrapper(connection)
+
+    def start_request(self):
+        _current.request = RequestMetrics(collect_sql=bool(getattr(settings, 'INSURANCE_SLOW_REQUEST_SECONDS', 0)))
+
+    def finish_request(self, request, endpoint, seconds):
+        current = getattr(_current, 'request', None)
+        _current.request = None
+        if current is None:
+            return
+        self.add('request', {'endpoint': endpoint}, 1, seconds)
+        for (name, labels), (count, total) in current.observations.items():
+            self.add(name, dict(labels, endpoint=endpoint), count, total)
+        threshold = getattr(settings, 'INSURANCE_SLOW_REQUEST_SECONDS', 0)
+        if threshold and seconds >= threshold:
+            statements = '\n'.join(f'  {duration * 1000:8.1f} ms  {sql}  {params!r}'
+                                   for duration, sql, params in current.sql)
+            logger.warning("Slow request %s %s (%s) took %.3fs:\n%s", request.method, request.path, endpoint,
+                           seconds, statements)
+
+    def render(self):
+        "Returns the metrics in the Prometheus text format"
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        for name in sorted({name for (name, labels), value in values}):
+            for suffix, index, help_text in (('_total', 0, HELP.get(name, name)),
+                                             ('_seconds_total', 1, f"Seconds spent: {HELP.get(name, name)}")):
+                metric = f'{self.namespace}_{name}{suffix}'
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} counter')
+                for (key_name, labels), value in values:
+                    if key_name != name:
+                        continue
+                    label_text = ','.join(f'{label}="{escape(label_value)}"' for label, label_value in labels)
+                    lines.append(f'{metric}{{{label_text}}} {value[index]}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+metrics = MetricsRegistry()
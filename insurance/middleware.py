@@ -0,0 +1,41 @@
+import asyncio
+import time
+from .metrics import metrics
+
+
+class MetricsMiddleware:
+    """
+    Collects the metrics of each request under its endpoint, the name of
+    its URL pattern. Runs in the mode of the handler, sync under WSGI and
+    async under ASGI, so it adds no thread hop to the async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Tells Django this middleware is a coroutine, like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        metrics.start_request()
+        try:
+            return self.get_response(request)
+        finally:
+            metrics.finish_request(request, self.get_endpoint(request), time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        metrics.start_request()
+        try:
+            return await self.get_response(request)
+        finally:
+            metrics.finish_request(request, self.get_endpoint(request), time.perf_counter() - started)
+
+    def get_endpoint(self, request):
+        match = getattr(request, 'resolver_match', None)
+        return match.view_name if match is not None else 'unmatched'
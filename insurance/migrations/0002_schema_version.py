@@ -0,0 +1,38 @@
+# Generated by Django 3.1.3 on 2026-10-18 20:44
+
+from django.db import migrations, models
+import django.utils.timezone
+import insurance.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchemaVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='risk',
+            name='schema_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='risk',
+            name='schema_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='riskfield',
+            name='name',
+            field=models.CharField(max_length=50, validators=[insurance.models.validate_variable]),
+        ),
+    ]
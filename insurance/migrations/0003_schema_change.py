@@ -0,0 +1,33 @@
+# Generated by Django 3.1.3 on 2026-10-18 20:46
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def log_existing_risks(apps, schema_editor):
+    # A first sync from cursor 0 has to see the risks created before the log
+    Risk = apps.get_model('insurance', 'Risk')
+    SchemaChange = apps.get_model('insurance', 'SchemaChange')
+    SchemaChange.objects.bulk_create([SchemaChange(risk_id=risk_id) for risk_id in
+                                      Risk.objects.order_by('id').values_list('id', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0002_schema_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchemaChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('action', models.CharField(choices=[('updated', 'Updated'), ('deleted', 'Deleted')], default='updated', max_length=7)),
+                ('risk_id', models.IntegerField()),
+                ('field_id', models.IntegerField(null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(log_existing_risks, migrations.RunPython.noop),
+    ]
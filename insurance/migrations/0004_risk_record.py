@@ -0,0 +1,52 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+DOCUMENT_SQL = [
+    # A text to date cast that can be indexed, the documents hold ISO dates
+    """
+    CREATE OR REPLACE FUNCTION insurance_document_date(value text) RETURNS date AS $$
+    BEGIN
+        RETURN value::date;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql IMMUTABLE STRICT
+    """,
+    'CREATE INDEX insurance_riskrecord_document_gin ON insurance_riskrecord USING gin (document jsonb_path_ops)',
+]
+
+
+def create_document_sql(apps, schema_editor):
+    # Document storage is PostgreSQL only
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in DOCUMENT_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_document_sql(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS insurance_riskrecord_document_gin')
+        schema_editor.execute('DROP FUNCTION IF EXISTS insurance_document_date(text)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0003_schema_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='risk',
+            name='storage',
+            field=models.CharField(choices=[('table', 'Table of its own'), ('document', 'Documents in a shared table')], default='table', max_length=8),
+        ),
+        migrations.CreateModel(
+            name='RiskRecord',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('document', models.JSONField(default=dict)),
+                ('risk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='insurance.risk')),
+            ],
+        ),
+        migrations.RunPython(create_document_sql, drop_document_sql),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0004_risk_record'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='risk',
+            name='partitioning',
+            field=models.JSONField(blank=True, default=dict, help_text='PostgreSQL partitioning of the table, e.g. {"method": "range", "field": "bought", "interval": "month"} or {"method": "hash", "partitions": 8}'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0005_risk_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='risk',
+            name='database',
+            field=models.CharField(blank=True, help_text='Alias of the database holding the table, the default database when empty', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='risk',
+            name='db_schema',
+            field=models.CharField(blank=True, help_text='PostgreSQL schema holding the table, the search path when empty', max_length=63),
+        ),
+    ]
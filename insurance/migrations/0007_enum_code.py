@@ -0,0 +1,39 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def code_existing_choices(apps, schema_editor):
+    # Codes of each field in the order its choices were created, see insurance.enums.assign_codes
+    Through = apps.get_model('insurance', 'RiskField').choices.through
+    EnumCode = apps.get_model('insurance', 'EnumCode')
+    next_codes, codes = {}, []
+    links = Through.objects.order_by('enumchoice_id')
+    for risk_field_id, choice_id in links.values_list('riskfield_id', 'enumchoice_id'):
+        next_codes[risk_field_id] = next_codes.get(risk_field_id, 0) + 1
+        codes.append(EnumCode(risk_field_id=risk_field_id, choice_id=choice_id, code=next_codes[risk_field_id]))
+    EnumCode.objects.bulk_create(codes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insurance', '0006_risk_placement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnumCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.SmallIntegerField()),
+                ('choice', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='insurance.enumchoice')),
+                ('risk_field', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to='insurance.riskfield')),
+            ],
+            options={
+                'unique_together': {('risk_field', 'choice'), ('risk_field', 'code')},
+            },
+        ),
+        migrations.RunPython(code_existing_choices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,143 @@
+import threading
+from contextlib import contextmanager
+from django.apps import apps
+from .schema_diff import schema_snapshot
+
+
+def schema_fingerprint(model_name, risk_fields):
+    "Returns a hashable description of the table a risk's fields produce"
+    return model_name, schema_snapshot(risk_fields)
+
+
+class CacheEntry:
+    def __init__(self, model, fingerprint):
+        self.model = model
+        self.fingerprint = fingerprint
+
+
+class ModelCache:
+    """
+    Process-wide cache of the dynamic model classes built for each Risk.
+
+    Entries are keyed by risk id and stamped with the fingerprint of the
+    schema they were built from. A lookup only compares the model name held
+    by the Risk instance, so a hit never touches the database. The save and
+    delete paths of Risk and RiskField call invalidate() when they actually
+    change the schema; changes made by other processes are evicted through
+    insurance.schema_events.
+
+    The cache is also the only writer of the dynamic models in the app
+    registry and is safe to share between threads: the registry is changed
+    under a lock and each risk is built by a single thread at a time.
+    """
+
+    def __init__(self, app_label):
+        self.app_label = app_label
+        self._entries = {}
+        # Guards the entries, the counters and the app registry. Held briefly,
+        # builds run under the lock of their risk only, see building()
+        self._lock = threading.RLock()
+        self._build_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.invalidations = 0
+
+    def get(self, risk_id, model_name):
+        with self._lock:
+            entry = self._entries.get(risk_id)
+            if entry is not None and entry.fingerprint[0] == model_name:
+                self.hits += 1
+                return entry.model
+            self.misses += 1
+            return None
+
+    def get_fingerprint(self, risk_id):
+        entry = self._entries.get(risk_id)
+        return entry.fingerprint if entry is not None else None
+
+    @contextmanager
+    def building(self, risk_id):
+        "Holds the build lock of a risk, one thread at a time builds or changes its model"
+        with self._lock:
+            lock = self._build_locks.setdefault(risk_id, threading.RLock())
+        with lock:
+            yield
+
+    def get_or_build(self, risk_id, model_name, build):
+        """
+        Returns the cached model, or the one returned by ``build()``. Threads
+        asking for the same risk at once wait for a single build and share it
+        """
+        model = self.get(risk_id, model_name)
+        if model is not None:
+            return model
+        with self.building(risk_id):
+            entry = self._entries.get(risk_id)
+            if entry is not None and entry.fingerprint[0] == model_name:
+                # Built by the thread that held the lock
+                return entry.model
+            return build()
+
+    def register(self, risk_id, model_name, create, fingerprint):
+        """
+        Creates a model class with ``create()`` in place of the one registered
+        under the same name and caches it
+        """
+        with self._lock:
+            self.unregister(model_name)
+            model = create()
+            self.set(risk_id, model, fingerprint)
+            return model
+
+    def set(self, risk_id, model, fingerprint):
+        with self._lock:
+            self.builds += 1
+            old = self._entries.get(risk_id)
+            if old is not None and old.fingerprint[0] != fingerprint[0]:
+                # The risk was renamed, drop the class registered under the old name
+                self.unregister(old.fingerprint[0])
+            if risk_id is not None:
+                self._entries[risk_id] = CacheEntry(model, fingerprint)
+
+    def invalidate(self, risk_id, fingerprint=None):
+        "Drop the cached model unless it was built from the given fingerprint"
+        with self._lock:
+            entry = self._entries.get(risk_id)
+            if entry is None or (fingerprint is not None and entry.fingerprint == fingerprint):
+                return False
+            del self._entries[risk_id]
+            self.invalidations += 1
+            return True
+
+    def evict(self, risk_id):
+        "Drops the cached model of a risk and its registration, e.g. when another process changed the risk"
+        with self._lock:
+            entry = self._entries.pop(risk_id, None)
+            if entry is None:
+                return False
+            self.invalidations += 1
+            self.unregister(entry.fingerprint[0])
+            return True
+
+    def unregister(self, model_name):
+        # Remove a model from the app registry so it can be built again
+        with self._lock:
+            apps.all_models[self.app_label].pop(model_name, None)
+            apps.clear_cache()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'builds': self.builds,
+            'invalidations': self.invalidations,
+        }
+
+
+model_cache = ModelCache('insurance')
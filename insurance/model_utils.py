@@ -1,16 +1,101 @@
+import logging
+import threading
+from contextlib import contextmanager
 from django.db import models
-from django.db import connection
-from django.db.utils import ProgrammingError
+from django.db import transaction
+from django.db.utils import DatabaseError, ProgrammingError
 from django.contrib import admin
+from .model_cache import model_cache
+from .metrics import metrics
+from .schema_diff import INDEX_KWARGS, schema_snapshot, diff_schema
+from .online_schema import OnlineSchemaEditor
+from .documents import is_document_model, get_document_risk_id, document_index_specs, document_index_sql
+from .partitions import PartitionManager
+from .enums import EnumField, build_field, conversion_map, relabel_sql
+from .placement import model_connection, create_schema
+
+logger = logging.getLogger(__name__)
+
+INDEX_ACTIONS = ('remove_index', 'add_index')
+_active_change_sets = threading.local()
+
+
+class SchemaChangeSet:
+    """
+    Field changes of one risk made while its RiskFields are saved or deleted,
+    applied at once: the stored schema is diffed against the final one, the
+    model is rebuilt a single time and all the DDL runs in one schema editor,
+    i.e. one transaction.
+    """
+
+    def __init__(self, risk, create_table=False, online=False):
+        self.risk = risk
+        self.create_table = create_table
+        self.online = online
+        self.old_snapshot = None if create_table else schema_snapshot(risk.fields.all())
+
+    def apply(self):
+        # Requests of other threads wait for the new model instead of building the old one
+        with model_cache.building(self.risk.id):
+            model_cache.invalidate(self.risk.id)
+            builder = SchemaBuilder(self.risk.get_django_model())
+            if self.create_table:
+                builder.create_db_table(self.risk.get_partitioning())
+                return
+            fingerprint = model_cache.get_fingerprint(self.risk.id)
+            # Evicted meanwhile by a change of another process
+            new_snapshot = fingerprint[1] if fingerprint is not None else schema_snapshot(self.risk.fields.all())
+            if is_document_model(builder.model):
+                # The fields are metadata, only the indexes of the risk change
+                builder.apply_document_indexes(self.old_snapshot, new_snapshot)
+                return
+            builder.apply_operations(diff_schema(self.old_snapshot, new_snapshot), online=self.online)
 
 
 class SchemaBuilder:
-    def __init__(self, model):
+    def __init__(self, model, using=None):
         self.model = model
+        # The database and schema of the risk, see insurance.placement, or ``using``
+        self.connection = model_connection(model, using)
+
+    @classmethod
+    @contextmanager
+    def change_set(cls, risk, create_table=False, online=False):
+        """
+        Defers the DDL of the RiskField saves and deletes of a risk made inside
+        the block and applies it in one go when the block exits
+        """
+        change_sets = _active_change_sets.__dict__.setdefault('risks', {})
+        change_set = SchemaChangeSet(risk, create_table, online)
+        change_sets[risk.id] = change_set
+        try:
+            yield change_set
+        finally:
+            del change_sets[risk.id]
+        change_set.apply()
+
+    @classmethod
+    def get_change_set(cls, risk_id):
+        "Returns the change set collecting the changes of a risk, if any"
+        return _active_change_sets.__dict__.get('risks', {}).get(risk_id)
+
+    def get_snapshot(self):
+        fingerprint = model_cache.get_fingerprint(get_document_risk_id(self.model))
+        return fingerprint[1] if fingerprint is not None else ()
 
-    def create_db_table(self):
+    @metrics.timed('ddl')
+    def create_db_table(self, partitioning=None):
+        if is_document_model(self.model):
+            # RiskRecord holds the rows already
+            self.apply_document_indexes((), self.get_snapshot())
+            return
+        create_schema(self.connection)
+        if partitioning is not None:
+            # Field changes of a partitioned table are then applied to its partitions by PostgreSQL
+            PartitionManager(self.model, partitioning, self.connection.alias).create_table()
+            return
         try:
-            with connection.schema_editor() as editor:
+            with self.connection.schema_editor() as editor:
                 editor.create_model(self.model)
         except ProgrammingError as err:
             # TODO: I couldn't figure out why sometimes despite the
@@ -19,9 +104,10 @@ class SchemaBuilder:
             # error
             pass
 
+    @metrics.timed('ddl')
     def remove_field(self, field):
         try:
-            with connection.schema_editor() as editor:
+            with self.connection.schema_editor() as editor:
                 editor.remove_field(self.model, field)
         except ProgrammingError as err:
             # TODO: I couldn't figure out why sometimes despite the
@@ -30,43 +116,153 @@ class SchemaBuilder:
             # error
             pass
 
+    @metrics.timed('ddl')
     def alter_table(self, old_name, new_name):
         try:
-            with connection.schema_editor() as editor:
+            with self.connection.schema_editor() as editor:
                 editor.alter_db_table(self.model, old_name, new_name)
         except ProgrammingError as err:
             pass
 
+    @metrics.timed('ddl')
     def delete_model(self):
+        if is_document_model(self.model):
+            # The rows go along with the risk, see RiskRecord.risk
+            self.apply_document_indexes(self.get_snapshot(), ())
+            return
         try:
-            with connection.schema_editor() as editor:
+            with self.connection.schema_editor() as editor:
                 editor.delete_model(self.model)
         except ProgrammingError as err:
             pass
 
-    def add_field(self, old_field, new_field):
+    @metrics.timed('ddl')
+    def add_field(self, old_field, new_field, online=False, **options):
+        if online:
+            # See OnlineSchemaEditor for the options
+            editor = OnlineSchemaEditor(self.model, using=self.connection.alias, **options)
+            if old_field is None:
+                editor.add_field(new_field)
+            else:
+                editor.alter_field(old_field, new_field)
+            return
         if old_field is None:
             try:
-                with connection.schema_editor() as editor:
+                with self.connection.schema_editor() as editor:
                     editor.add_field(self.model, new_field)
             except ProgrammingError as err:
                 pass
         else:
             try:
-                with connection.schema_editor() as editor:
-                    editor.alter_field(self.model, old_field, new_field)
+                with self.connection.schema_editor() as editor:
+                    self.alter_column(editor, old_field, new_field)
             except ProgrammingError as err:
                 pass
 
-    def alter_field(self, old_field, new_field):
+    @metrics.timed('ddl')
+    def alter_field(self, old_field, new_field, online=False, **options):
+        if online:
+            OnlineSchemaEditor(self.model, using=self.connection.alias, **options).alter_field(old_field, new_field)
+            return
         try:
-            with connection.schema_editor() as editor:
-                editor.alter_field(self.model, old_field, new_field)
+            with self.connection.schema_editor() as editor:
+                self.alter_column(editor, old_field, new_field)
         except ProgrammingError as err:
             pass
 
+    def alter_column(self, editor, old_field, new_field):
+        # The type change only casts, enum labels and codes are mapped around it
+        mapping = conversion_map(old_field, new_field)
+        table = self.model._meta.db_table
+        if mapping is not None and isinstance(new_field, EnumField):
+            editor.execute(relabel_sql(table, old_field.column, mapping, editor.connection), None)
+        editor.alter_field(self.model, old_field, new_field)
+        if mapping is not None and isinstance(old_field, EnumField):
+            editor.execute(relabel_sql(table, new_field.column, mapping, editor.connection), None)
+
+    def make_field(self, spec):
+        "Returns an unbound Django field for a FieldSpec of this model"
+        kwargs = {key: value for key, value in spec.get_kwargs().items() if key not in INDEX_KWARGS}
+        field = build_field(spec.field_type, kwargs, spec.key)
+        field.set_attributes_from_name(spec.name)
+        field.model = self.model
+        return field
+
+    @metrics.timed('ddl')
+    def apply_operations(self, operations, online=False, **options):
+        # Run the operations of a schema diff in one schema editor, or one by one
+        # with the lock-minimizing online editor. Index changes wait for the commit
+        index_operations = [operation for operation in operations if operation.action in INDEX_ACTIONS]
+        operations = [operation for operation in operations if operation.action not in INDEX_ACTIONS]
+        if online:
+            editor = OnlineSchemaEditor(self.model, using=self.connection.alias, **options)
+            for operation in operations:
+                if operation.action == 'remove':
+                    # Dropping a column only touches the catalog
+                    self.remove_field(self.make_field(operation.old))
+                elif operation.action == 'add':
+                    editor.add_field(self.make_field(operation.new))
+                else:
+                    editor.alter_field(self.make_field(operation.old), self.make_field(operation.new))
+        elif operations:
+            try:
+                with self.connection.schema_editor() as editor:
+                    for operation in operations:
+                        if operation.action == 'remove':
+                            editor.remove_field(self.model, self.make_field(operation.old))
+                        elif operation.action == 'add':
+                            editor.add_field(self.model, self.make_field(operation.new))
+                        else:
+                            self.alter_column(editor, self.make_field(operation.old),
+                                              self.make_field(operation.new))
+            except ProgrammingError as err:
+                pass
+        if index_operations:
+            transaction.on_commit(lambda: self.apply_index_operations(index_operations, **options),
+                                  using=self.connection.alias)
+
+    @metrics.timed('ddl')
+    def apply_index_operations(self, operations, **options):
+        # Out of a transaction, so PostgreSQL builds and drops the indexes CONCURRENTLY
+        # and writes to the table go on meanwhile
+        editor = OnlineSchemaEditor(self.model, using=self.connection.alias, **options)
+        for operation in operations:
+            try:
+                if operation.action == 'remove_index':
+                    editor.remove_index(operation.old.name)
+                else:
+                    editor.add_index(operation.new.get_index())
+            except DatabaseError:
+                # A failed concurrent build leaves an invalid index that the next change replaces
+                logger.exception("Could not apply %s on %s", operation.action, self.model._meta.db_table)
+
+    @metrics.timed('ddl')
+    def apply_document_indexes(self, old_snapshot, new_snapshot):
+        """
+        Replaces the indexes of a document risk that differ between two schema
+        snapshots, once the transaction commits like apply_index_operations()
+        """
+        risk_id = get_document_risk_id(self.model)
+        old, new = set(document_index_specs(risk_id, old_snapshot)), set(document_index_specs(risk_id, new_snapshot))
+        removes, adds = sorted(old - new), sorted(new - old)
+        if removes or adds:
+            transaction.on_commit(lambda: self.apply_document_index_operations(removes, adds))
+
+    @metrics.timed('ddl')
+    def apply_document_index_operations(self, removes, adds):
+        editor = OnlineSchemaEditor(self.model, using=self.connection.alias)
+        concurrently = editor.is_online and not self.connection.in_atomic_block
+        for spec in removes:
+            editor.remove_index(spec.name)
+        for spec in adds:
+            try:
+                editor.execute(document_index_sql(self.model, spec, concurrently))
+            except DatabaseError:
+                # e.g. duplicate values of a field made unique, the index is left out
+                logger.exception("Could not create %s on %s", spec.name, self.model._meta.db_table)
+
 
-def create_model(name, fields=None, app_label='', module='', options=None, admin_opts=None):
+def create_model(name, fields=None, app_label='', module='', options=None, admin_opts=None, base=models.Model):
     """
     Create specified model
     """
@@ -92,7 +288,8 @@ def create_model(name, fields=None, app_label='', module='', options=None, admin
         attrs.update(fields)
 
     # Create the class, which automatically triggers ModelBase processing
-    model = type(name, (models.Model,), attrs)
+    with metrics.timer('model_build'):
+        model = type(name, (base,), attrs)
 
     # Create an Admin class if admin options were provided
     if admin_opts is not None:
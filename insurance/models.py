@@ -1,31 +1,112 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, connection, connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
-from django.core.exceptions import FieldDoesNotExist
+from django.utils import timezone
 import re
+import copy
+from contextlib import ExitStack
 from .model_utils import create_model, SchemaBuilder
+from .model_cache import model_cache, schema_fingerprint
+from .schema_events import publish
+from .schema_diff import INDEX_KWARGS, IndexSpec
+from .documents import DocumentRecord, RESERVED_NAMES, document_model_fields
+from .partitions import Partitioning
+from .enums import build_field, assign_codes
+from .placement import SCHEMA_NAME, placement_alias
 from django.apps import apps
 
 
 # Create your models here.
 class Risk(models.Model):
+    TABLE = 'table'
+    DOCUMENT = 'document'
+    STORAGE_CHOICES = (
+        (TABLE, 'Table of its own'),
+        (DOCUMENT, 'Documents in a shared table'),
+    )
+
     name = models.CharField(max_length=50, unique=True)
     description = models.CharField(max_length=200)
+    # Where the records go: a table altered along with the fields, or JSONB
+    # documents in RiskRecord whose field changes touch no table
+    storage = models.CharField(max_length=8, choices=STORAGE_CHOICES, default=TABLE)
+    # Set when the table is created, see insurance.partitions.Partitioning
+    partitioning = models.JSONField(default=dict, blank=True,
+                                    help_text='PostgreSQL partitioning of the table, e.g. '
+                                              '{"method": "range", "field": "bought", "interval": "month"} '
+                                              'or {"method": "hash", "partitions": 8}')
+    # Where the table is, see insurance.placement. Moved by the move_risk command
+    database = models.CharField(max_length=50, blank=True,
+                                help_text='Alias of the database holding the table, the default database when empty')
+    db_schema = models.CharField(max_length=63, blank=True,
+                                 help_text='PostgreSQL schema holding the table, the search path when empty')
+    # Bumped on every change of the risk, its fields or their choices, see SchemaVersion
+    schema_version = models.PositiveIntegerField(default=1, editable=False)
+    schema_updated_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __init__(self, *args, **kwargs):
-        # Get old value to check variations
+        # Get old value to check variations. The dynamic model is only built when
+        # it is asked for, so loading a Risk costs the same as any other model
         super().__init__(*args, **kwargs)
-        self.__initial_model = self.get_django_model()
-        self.__old_name = self.name
+        self.__old_name = self.__dict__.get('name')
 
     def get_django_model(self):
         "Returns a functional Django model based on current data"
-        # Get all associated fields into a list ready for dict()
-        fields = [(f.name, f.get_django_field()) for f in self.fields.all()]
+        # Served from the process-wide cache without any query when possible
+        # Threads missing it at once share a single build
+        return model_cache.get_or_build(self.id, self.get_model_name,
+                                        lambda: self.build_django_model(self.fields.all()))
+
+    def build_django_model(self, risk_fields):
+        "Builds the model of the given RiskFields of the risk into the registry and the cache"
+        # In creation order whatever order the rows come in
+        risk_fields = sorted(risk_fields, key=lambda f: f.id or 0)
+        fingerprint = schema_fingerprint(self.get_model_name, risk_fields)
+        if self.storage == self.DOCUMENT:
+            # Rows of RiskRecord, the indexes are created by SchemaBuilder
+            fields = document_model_fields(self, risk_fields)
+            options = {'db_table': RiskRecord._meta.db_table, 'managed': False}
+            base = DocumentRecord
+        else:
+            # Get all associated fields into a list ready for dict()
+            fields = [(f.name, f.get_django_field()) for f in risk_fields]
+            # Read by insurance.placement.PlacementRouter, RiskField names hold no __ so it never clashes
+            fields.append(('__risk_placement__', (self.database, self.db_schema)))
+            # The field indexes go to Meta, so they are created along with the table
+            options = {'indexes': [spec.get_index() for spec in fingerprint[1] if isinstance(spec, IndexSpec)]}
+            base = models.Model
         # Use the create_model function defined above
         model_name = self.parse_model_name(self.name.lower())
-        if self.is_registered:
-            del apps.all_models[self._meta.app_label][self.get_model_name]
-        return create_model(model_name, dict(fields), self._meta.app_label, f"{self._meta.app_label}.models")
+        # Replaces the registered model, if any, under the registry lock
+        with model_cache.building(self.id):
+            return model_cache.register(
+                self.id, self.get_model_name,
+                lambda: create_model(model_name, dict(fields), self._meta.app_label,
+                                     f"{self._meta.app_label}.models", options, base=base),
+                fingerprint)
+
+    def unregister_django_model(self):
+        "Drops the dynamic model from the cache and the app registry"
+        with model_cache.building(self.id):
+            model_cache.invalidate(self.id)
+            model_cache.unregister(self.get_model_name)
+
+    def drop_django_model(self):
+        "Drops the table of the risk and unregisters its model"
+        # No other thread builds the model again in between
+        with model_cache.building(self.id):
+            model = self.get_django_model()
+            SchemaBuilder(model).delete_model()
+            self.unregister_django_model()
+
+    def get_enum_choices(self):
+        "Returns the allowed values of every enum field, keyed by field name"
+        choices = {}
+        for name, value in EnumChoice.objects.filter(riskfield__risk=self).values_list('riskfield__name', 'value'):
+            choices.setdefault(name, set()).add(value)
+        return choices
 
     def get_django_model_app(self):
         return apps.get_model(self._meta.app_label, self.get_model_name)
@@ -42,22 +123,148 @@ class Risk(models.Model):
     def get_model_name(self):
         return self.parse_model_name(self.name).lower()
 
+    def get_initial_db_table(self):
+        "Returns the table name the risk was loaded with"
+        old_name = self.__old_name
+        if old_name is None:
+            # The name was deferred when the risk was loaded
+            old_name = Risk.objects.filter(pk=self.pk).values_list('name', flat=True).get()
+        return f"{self._meta.app_label}_{self.parse_model_name(old_name).lower()}"
+
+    def get_placement_alias(self):
+        "Returns the alias of the connections to the table of the risk"
+        return placement_alias(self.database, self.db_schema)
+
+    def get_partitioning(self):
+        "Returns the Partitioning of the table of the risk, None when it is a plain table"
+        return Partitioning.parse(self.partitioning)
+
+    def clean(self):
+        if self.storage == self.DOCUMENT and connection.vendor != 'postgresql':
+            raise ValidationError({'storage': 'Document storage needs PostgreSQL.'})
+        try:
+            partitioning = self.get_partitioning()
+        except ValueError as err:
+            raise ValidationError({'partitioning': str(err)})
+        if partitioning is not None and (self.storage != self.TABLE or connection.vendor != 'postgresql'):
+            raise ValidationError({'partitioning': 'Partitioning needs table storage on PostgreSQL.'})
+        if (self.database or self.db_schema) and self.storage != self.TABLE:
+            raise ValidationError({'database': 'Only tables can be placed, documents are in the default database.'})
+        if self.database and self.database not in settings.DATABASES:
+            raise ValidationError({'database': f'"{self.database}" is not a database of the settings.'})
+        if self.db_schema:
+            if not SCHEMA_NAME.match(self.db_schema):
+                raise ValidationError({'db_schema': 'Only lowercase alphanumeric characters and _ are allowed.'})
+            if connections[self.database or DEFAULT_DB_ALIAS].vendor != 'postgresql':
+                raise ValidationError({'db_schema': 'Schemas need PostgreSQL.'})
+
     def save(self, *args, **kwargs):
-        # Alter table if there a change in the name column of the record. For update only
-        if self.id is not None:
-            old_db_name = self.__initial_model._meta.db_table
+        # Alter table if there a change in the name column of the record. For update only.
+        # Documents stay where they are, RiskRecord is shared
+        if self.id is not None and self.__old_name != self.name and self.storage == self.TABLE:
+            old_db_name = self.get_initial_db_table()
             new_db_name = self.get_django_model()._meta.db_table
             if old_db_name != new_db_name:
                 builder = SchemaBuilder(self.get_django_model())
                 builder.alter_table(old_db_name, new_db_name)
+        counted = self.id is not None
+        if counted:
+            # Counted by the database so concurrent changes never reuse a version
+            self.schema_version = models.F('schema_version') + 1
+        self.schema_updated_at = timezone.now()
         super().save(*args, **kwargs)
+        if counted:
+            # Read back from the database when accessed
+            del self.schema_version
+        self.__old_name = self.name
+        SchemaVersion.bump(changes=[SchemaChange(risk_id=self.id)])
 
     def delete(self, *args, **kwargs):
-        model = self.get_django_model()
-        del apps.all_models[self._meta.app_label][self.get_model_name]
-        builder = SchemaBuilder(model)
-        builder.delete_model()
+        self.drop_django_model()
+        tombstone = SchemaChange(action=SchemaChange.DELETED, risk_id=self.id)
         super().delete(*args, **kwargs)
+        SchemaVersion.bump(changes=[tombstone])
+
+
+class SchemaVersion(models.Model):
+    """
+    Version of the whole risk catalog, a single row bumped along with the
+    schema version of a risk and when a risk is deleted. Conditional GETs
+    compare it in one primary key lookup.
+    """
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def bump(cls, *risk_ids, changes=()):
+        """
+        Marks the schema of the given risks, and so the catalog, as changed,
+        appends them to the SchemaChange log along with the given changes and
+        publishes them to the other processes
+        """
+        now = timezone.now()
+        if risk_ids:
+            Risk.objects.filter(pk__in=risk_ids).update(schema_version=models.F('schema_version') + 1,
+                                                        schema_updated_at=now)
+        if not cls.objects.filter(pk=1).update(version=models.F('version') + 1, updated_at=now):
+            cls.objects.get_or_create(pk=1, defaults={'version': 1, 'updated_at': now})
+        changes = [SchemaChange(risk_id=risk_id) for risk_id in risk_ids] + list(changes)
+        SchemaChange.append(changes)
+        # Other processes evict their models of these risks once the change commits
+        publish([change.risk_id for change in changes])
+
+    @classmethod
+    def current(cls):
+        "Returns the (version, updated_at) of the catalog"
+        return cls.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+
+
+class SchemaChange(models.Model):
+    """
+    Append-only log of the risk schema changes, read by the delta sync API
+    from a cursor which is the id of the last change seen. Risks and fields
+    are referenced by id without foreign keys so deletions stay as tombstones.
+    """
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTION_CHOICES = (
+        (UPDATED, 'Updated'),
+        (DELETED, 'Deleted'),
+    )
+    # Any constant, shared by the writers of the log
+    LOCK_ID = 7_302_104
+
+    id = models.BigAutoField(primary_key=True)
+    action = models.CharField(max_length=7, choices=ACTION_CHOICES, default=UPDATED)
+    risk_id = models.IntegerField()
+    field_id = models.IntegerField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def append(cls, changes):
+        if not changes:
+            return
+        # The lock is held until the transaction commits, in autocommit it would be
+        # released before the insert
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Writers take turns until they commit, so ids become visible in order
+                # and a reader's cursor never skips a change committed later
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [cls.LOCK_ID])
+            cls.objects.bulk_create(changes)
+
+
+class RiskRecord(models.Model):
+    """
+    Records of all the risks with document storage. The values of a record
+    are in ``document`` keyed by RiskField id, see insurance.documents.
+    Equality filters use the GIN index of the documents, the indexed fields
+    of a risk get expression indexes partial on its rows.
+    """
+    id = models.BigAutoField(primary_key=True)
+    risk = models.ForeignKey(Risk, on_delete=models.CASCADE, related_name='records')
+    document = models.JSONField(default=dict)
 
 
 class EnumChoice(models.Model):
@@ -67,6 +274,31 @@ class EnumChoice(models.Model):
     def __str__(self):
         return self.choice
 
+    def get_risk_ids(self):
+        return list(Risk.objects.filter(fields__choices=self).values_list('id', flat=True).distinct())
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        enum_choices_changed(*self.get_risk_ids())
+
+
+class EnumCode(models.Model):
+    "Code of a choice in the column of an enum field, see insurance.enums.EnumField"
+    risk_field = models.ForeignKey('RiskField', on_delete=models.CASCADE, related_name='codes')
+    # Kept when the choice is deleted, so that its code is never given to another choice
+    choice = models.ForeignKey(EnumChoice, null=True, on_delete=models.SET_NULL)
+    code = models.SmallIntegerField()
+
+    class Meta:
+        unique_together = (('risk_field', 'choice'), ('risk_field', 'code'))
+
+
+def enum_choices_changed(*risk_ids):
+    "Rebuilds the models of the risks, which hold the codes of their enums, here and in the other processes"
+    for risk_id in risk_ids:
+        model_cache.invalidate(risk_id)
+    SchemaVersion.bump(*risk_ids)
+
 
 def validate_variable(value):
     if value[0].isdigit():
@@ -98,50 +330,130 @@ class RiskField(models.Model):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__old_name = self.name
-        # self.__field_type = self.field_type
-        # self.__old_kwargs = self.kwargs
+        self.__old_name, self.__old_field_type, self.__old_kwargs = self.get_schema_state()
+
+    def clean(self):
+        # Taken by the columns of RiskRecord on the models of document risks
+        if self.name in RESERVED_NAMES:
+            raise ValidationError({'name': f'"{self.name}" is a reserved name'})
+        # Taken by the lookups of the queries, and the attributes of the models such as __risk_placement__
+        if '__' in self.name:
+            raise ValidationError({'name': 'Names can not contain __'})
+        risk = Risk.objects.filter(pk=self.risk_id).first() if self.risk_id else None
+        partitioning = risk.get_partitioning() if risk is not None else None
+        if partitioning is None:
+            return
+        # Unique indexes of a partitioned table have to hold the partition key
+        if self.kwargs and self.kwargs.get('unique'):
+            raise ValidationError('Fields of a partitioned risk can not be unique')
+        if self.id is not None and self.__old_name == partitioning.field and (
+                self.field_type != 'DateField' or (self.kwargs or {}).get('null')):
+            raise ValidationError(f'"{self.__old_name}" partitions the table, it has to stay a date that is not null')
+
+    def is_partition_key(self):
+        partitioning = self.risk.get_partitioning()
+        return partitioning is not None and partitioning.field == self.__old_name
+
+    def get_schema_state(self):
+        # Deferred attributes are left out, reading them would query the database
+        return tuple(copy.deepcopy(self.__dict__.get(attr)) for attr in ('name', 'field_type', 'kwargs'))
+
+    @property
+    def schema_changed(self):
+        "True when saving this field would change the table of its risk"
+        return self.id is None or self.get_schema_state() != (self.__old_name, self.__old_field_type,
+                                                              self.__old_kwargs)
 
     def get_django_field(self):
         "Returns the correct field type, instantiated with applicable settings"
-        # Get all associated settings into a list ready for dict()
-        settings = self.kwargs
+        # Get all associated settings into a list ready for dict(). Indexes are
+        # declared in the Meta options of the model, see get_index_name()
+        settings = [(key, value) for key, value in self.kwargs.items() if key not in INDEX_KWARGS]
 
         # Instantiate the field with the settings as **kwargs
-        return getattr(models, self.field_type)(**dict(settings))
+        return build_field(self.field_type, dict(settings), self.id)
+
+    def get_index_name(self):
+        # Built from ids so renaming the risk or the field keeps the index
+        return f"{self._meta.app_label}_r{self.risk_id}_f{self.id}_idx"
+
+    def update_index_references(self, old_name, new_name=None):
+        "Points the composite and partial indexes of the other fields to a renamed field, or drops a deleted one"
+        for risk_field in RiskField.objects.filter(risk_id=self.risk_id, kwargs__db_index=True).exclude(pk=self.pk):
+            kwargs = dict(risk_field.kwargs)
+            index_with = [new_name if name == old_name else name for name in kwargs.get('index_with') or []
+                          if new_name or name != old_name]
+            condition = {}
+            for lookup, value in (kwargs.get('index_condition') or {}).items():
+                name, separator, rest = lookup.partition('__')
+                if name == old_name:
+                    if new_name is None:
+                        continue
+                    lookup = new_name + separator + rest
+                condition[lookup] = value
+            if (index_with, condition) == (kwargs.pop('index_with', None) or [],
+                                           kwargs.pop('index_condition', None) or {}):
+                continue
+            if index_with:
+                kwargs['index_with'] = index_with
+            if condition:
+                kwargs['index_condition'] = condition
+            risk_field.kwargs = kwargs
+            risk_field.save()
 
     def delete(self, **kwargs):
         print("remove")
-        # When a column/field is removed from the model, it removes from the table
-        model = self.risk.get_django_model()
-        field = model._meta.get_field(self.name)
-        builder = SchemaBuilder(model)
-        builder.remove_field(field)
-        super().delete(**kwargs)
-
-    def get_old_field(self):
-        # Return old field record
-        model = self.risk.get_django_model()
-        try:
-            field = model._meta.get_field(self.__old_name)
-            return field
-        except FieldDoesNotExist:
-            return None
-
-    def get_latest_field(self):
-        # Return new field record
-        model = self.risk.get_django_model()
-        try:
-            field = model._meta.get_field(self.name)
-            return field
-        except FieldDoesNotExist:
-            return None
+        # When a column/field is removed from the model, it removes from the table.
+        # Inside a change set the column is dropped when the change set is applied
+        if self.is_partition_key():
+            raise ValidationError(f'"{self.name}" partitions the table of its risk and can not be removed')
+        in_change_set = SchemaBuilder.get_change_set(self.risk_id) is not None
+        with ExitStack() if in_change_set else SchemaBuilder.change_set(self.risk):
+            self.update_index_references(self.name)
+            tombstone = SchemaChange(action=SchemaChange.DELETED, risk_id=self.risk_id, field_id=self.id)
+            deleted = super().delete(**kwargs)
+            SchemaVersion.bump(self.risk_id, changes=[tombstone])
+            return deleted
 
     def save(self, *args, **kwargs):
-        # Get old field and new.
+        # The table is altered by diffing the stored schema with the saved one, only
+        # when the field schema changed and no change set will do it later.
         # This works for both created and updated
-        old_field = self.get_old_field()
-        super().save(*args, **kwargs)
-        model = self.risk.get_django_model()
-        builder = SchemaBuilder(model)
-        builder.add_field(old_field, self.get_latest_field())
+        schema_changed = self.schema_changed
+        alters_table = schema_changed and SchemaBuilder.get_change_set(self.risk_id) is None
+        with SchemaBuilder.change_set(self.risk) if alters_table else ExitStack():
+            super().save(*args, **kwargs)
+            if self.__old_name not in (None, self.name):
+                self.update_index_references(self.__old_name, self.name)
+                if self.is_partition_key():
+                    # The partition key column is renamed along with the field
+                    self.risk.partitioning = dict(self.risk.partitioning, field=self.name)
+                    Risk.objects.filter(pk=self.risk_id).update(partitioning=self.risk.partitioning)
+            if schema_changed:
+                SchemaVersion.bump(self.risk_id)
+        self.__old_name, self.__old_field_type, self.__old_kwargs = self.get_schema_state()
+
+
+@receiver(m2m_changed, sender=RiskField.choices.through)
+def risk_field_choices_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Setting the choices of a field changes the schema of its risk
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_add':
+        assign_codes([instance.pk] if not reverse else pk_set)
+    if not reverse:
+        enum_choices_changed(instance.risk_id)
+    elif pk_set:
+        enum_choices_changed(*RiskField.objects.filter(pk__in=pk_set).values_list('risk_id', flat=True).distinct())
+
+
+@receiver(pre_delete, sender=EnumChoice)
+def enum_choice_deleting(sender, instance, **kwargs):
+    # Read while the links to the fields still exist
+    instance._risk_ids = instance.get_risk_ids()
+
+
+@receiver(post_delete, sender=EnumChoice)
+def enum_choice_deleted(sender, instance, **kwargs):
+    # Sent for queryset deletes as well, e.g. the delete action of the admin
+    enum_choices_changed(*getattr(instance, '_risk_ids', ()))
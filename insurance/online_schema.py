@@ -0,0 +1,242 @@
+import logging
+import time
+from django.db import transaction
+from django.db.backends.utils import truncate_name
+from django.db.models import NOT_PROVIDED
+from .partitions import is_partitioned, leaf_partitions
+from .enums import conversion_map, conversion_sql
+from .placement import model_connection
+
+logger = logging.getLogger(__name__)
+
+ONLINE_BATCH_SIZE = 5000
+# Seconds to sleep between two backfill batches so intake traffic keeps up
+ONLINE_PAUSE = 0.05
+
+
+def log_progress(stage, done, total):
+    logger.info("%s: %s/%s", stage, done, total)
+
+
+class OnlineSchemaEditor:
+    """
+    Column changes for large dynamic tables that avoid holding an ACCESS
+    EXCLUSIVE lock while the table is rewritten or scanned, on PostgreSQL:
+
+    * columns are added nullable without default, which only touches the catalog
+    * values are backfilled by primary key range in throttled batches, each
+      batch being its own transaction when not run inside an atomic block
+    * NOT NULL is enforced with a CHECK ... NOT VALID constraint validated
+      afterwards, which PostgreSQL 12+ then uses to skip the scan of SET NOT NULL
+    * type changes fill a shadow column kept in sync by a trigger and swap it in
+    * indexes are built and dropped CONCURRENTLY when outside a transaction,
+      except on partitioned tables where PostgreSQL does not support it
+
+    ``progress`` is called with (stage, done, total) after every batch.
+    Other databases fall back to the regular schema editor.
+    """
+
+    def __init__(self, model, batch_size=ONLINE_BATCH_SIZE, pause=ONLINE_PAUSE, progress=log_progress, using=None):
+        self.model = model
+        self.table = model._meta.db_table
+        self.connection = model_connection(model, using)
+        self.batch_size = batch_size
+        self.pause = pause
+        self.progress = progress
+
+    @property
+    def is_online(self):
+        return self.connection.vendor == 'postgresql'
+
+    @property
+    def concurrently(self):
+        # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+        return (self.is_online and not self.connection.in_atomic_block
+                and not is_partitioned(self.table, self.connection.alias))
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def object_name(self, *parts):
+        return truncate_name('_'.join((self.table,) + parts), self.connection.ops.max_name_length())
+
+    def execute(self, sql, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def add_field(self, field):
+        if not self.is_online:
+            with self.connection.schema_editor() as editor:
+                editor.add_field(self.model, field)
+            return
+        nullable = field.clone()
+        nullable.set_attributes_from_name(field.name)
+        nullable.model = self.model
+        nullable.null, nullable.default, nullable.db_index = True, NOT_PROVIDED, False
+        with self.connection.schema_editor() as editor:
+            editor.add_field(self.model, nullable)
+        if field.has_default():
+            default = field.get_db_prep_save(field.get_default(), self.connection)
+            self.backfill(field.column, '%s', [default], f'{self.quote(field.column)} IS NULL')
+        if not field.null:
+            self.set_not_null(field)
+        if field.db_index:
+            self.create_index([field])
+
+    def alter_field(self, old_field, new_field):
+        if not self.is_online:
+            with self.connection.schema_editor() as editor:
+                editor.alter_field(self.model, old_field, new_field)
+            return
+        if old_field.column != new_field.column:
+            # Renaming a column only touches the catalog
+            self.execute(f'ALTER TABLE {self.quote(self.table)} RENAME COLUMN '
+                         f'{self.quote(old_field.column)} TO {self.quote(new_field.column)}')
+        old_type = old_field.db_parameters(self.connection)['type']
+        new_type = new_field.db_parameters(self.connection)['type']
+        type_changed = old_type != new_type
+        if type_changed:
+            mapping = conversion_map(old_field, new_field)
+            # Enum labels and codes are mapped, other values cast
+            cast = (lambda column: conversion_sql(column, mapping, self.connection)) if mapping is not None else None
+            indexes = self.index_names()
+            self.change_type(new_field, new_type, cast)
+            # Dropping the old column drops the indexes over it or partial on it, e.g. the
+            # composite and partial indexes of the RiskFields, see IndexSpec
+            dropped = indexes - self.index_names()
+        if new_field.null and not old_field.null:
+            self.execute(f'ALTER TABLE {self.quote(self.table)} ALTER COLUMN {self.quote(new_field.column)} '
+                         f'DROP NOT NULL')
+        elif not new_field.null and (old_field.null or type_changed):
+            if new_field.has_default():
+                default = new_field.get_db_prep_save(new_field.get_default(), self.connection)
+                self.backfill(new_field.column, '%s', [default], f'{self.quote(new_field.column)} IS NULL')
+            self.set_not_null(new_field)
+        # A type change drops the old column with its index and unique constraint
+        if new_field.unique and (type_changed or not old_field.unique):
+            self.create_unique(new_field)
+        elif old_field.unique and not new_field.unique:
+            with self.connection.schema_editor() as editor:
+                for name in editor._constraint_names(self.model, [new_field.column], unique=True):
+                    editor.execute(editor._delete_unique_sql(self.model, name))
+        if new_field.db_index and not new_field.unique and (type_changed or not old_field.db_index):
+            self.create_index([new_field])
+        elif old_field.db_index and not new_field.db_index:
+            with self.connection.schema_editor() as editor:
+                for name in editor._constraint_names(self.model, [new_field.column], index=True):
+                    editor.execute(editor._delete_index_sql(self.model, name))
+        if type_changed:
+            for index in self.model._meta.indexes:
+                if index.name in dropped:
+                    self.add_index(index)
+
+    def index_names(self):
+        "Names of the indexes of the table, constraints included"
+        with self.connection.cursor() as cursor:
+            return set(self.connection.introspection.get_constraints(cursor, self.table))
+
+    def backfill(self, column, expression, params=(), condition=''):
+        "Sets column to expression, batch by batch of primary keys"
+        pk = self.quote(self.model._meta.pk.column)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN({pk}), MAX({pk}) FROM {self.quote(self.table)}')
+            low, high = cursor.fetchone()
+        if low is None:
+            return
+        total = high - low + 1
+        where = f' AND ({condition})' if condition else ''
+        sql = (f'UPDATE {self.quote(self.table)} SET {self.quote(column)} = {expression} '
+               f'WHERE {pk} >= %s AND {pk} < %s{where}')
+        for start in range(low, high + 1, self.batch_size):
+            with transaction.atomic(using=self.connection.alias):
+                self.execute(sql, list(params) + [start, start + self.batch_size])
+            self.progress(f'backfill {self.table}.{column}', min(start + self.batch_size - low, total), total)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def set_not_null(self, field):
+        table, column = self.quote(self.table), self.quote(field.column)
+        check = self.quote(self.object_name(field.column, 'notnull'))
+        # The rows of a partitioned table are in its partitions, each one gets the check
+        using = self.connection.alias
+        tables = leaf_partitions(self.table, using) if is_partitioned(self.table, using) else [table]
+        for name in tables:
+            self.execute(f'ALTER TABLE {name} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID')
+            # VALIDATE only takes a SHARE UPDATE EXCLUSIVE lock, writes go on
+            self.execute(f'ALTER TABLE {name} VALIDATE CONSTRAINT {check}')
+        self.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL')
+        for name in tables:
+            self.execute(f'ALTER TABLE {name} DROP CONSTRAINT {check}')
+        self.progress(f'not null {self.table}.{field.column}', 1, 1)
+
+    def change_type(self, field, new_type, cast=None):
+        "Changes the type of a column, ``cast`` returns the SQL converting a column reference"
+        table, column = self.quote(self.table), self.quote(field.column)
+        if cast is None:
+            cast = lambda value: f'{value}::{new_type}'
+        shadow_name = truncate_name(f'{field.column}__new', self.connection.ops.max_name_length())
+        shadow = self.quote(shadow_name)
+        function = self.quote(self.object_name(field.column, 'sync'))
+        # Values that do not convert fail here, before the trigger would fail every write.
+        # The statement has no parameters, literal % of the cast are kept
+        self.execute(f'SELECT COUNT({cast(column)}) FROM {table}')
+        self.execute(f'ALTER TABLE {table} ADD COLUMN {shadow} {new_type} NULL')
+        try:
+            # Rows written while the backfill runs are converted by the trigger
+            self.execute(f'CREATE FUNCTION {function}() RETURNS trigger AS $$ BEGIN '
+                         f'NEW.{shadow} := {cast(f"NEW.{column}")}; RETURN NEW; END $$ LANGUAGE plpgsql')
+            self.execute(f'CREATE TRIGGER {function} BEFORE INSERT OR UPDATE ON {table} '
+                         f'FOR EACH ROW EXECUTE PROCEDURE {function}()')
+            # The backfill statement has parameters, literal % of the cast are escaped
+            self.backfill(shadow_name, cast(column).replace('%', '%%'))
+        except Exception:
+            # e.g. a value written since the check that does not convert, the table is left as it
+            # was. Within a transaction the rollback of the caller does it
+            if self.connection.in_atomic_block:
+                raise
+            with transaction.atomic(using=self.connection.alias):
+                self.execute(f'DROP TRIGGER IF EXISTS {function} ON {table}')
+                self.execute(f'DROP FUNCTION IF EXISTS {function}()')
+                self.execute(f'ALTER TABLE {table} DROP COLUMN {shadow}')
+            raise
+        with transaction.atomic(using=self.connection.alias):
+            self.execute(f'DROP TRIGGER {function} ON {table}')
+            self.execute(f'DROP FUNCTION {function}()')
+            self.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+            self.execute(f'ALTER TABLE {table} RENAME COLUMN {shadow} TO {column}')
+
+    def create_index(self, fields):
+        concurrently = self.concurrently
+        with self.connection.schema_editor(atomic=not concurrently) as editor:
+            kwargs = {'concurrently': True} if concurrently else {}
+            editor.execute(editor._create_index_sql(self.model, fields, **kwargs))
+        self.progress(f"index {self.table}({', '.join(f.column for f in fields)})", 1, 1)
+
+    def create_unique(self, field):
+        if not self.concurrently:
+            with self.connection.schema_editor() as editor:
+                editor.execute(editor._create_unique_sql(self.model, [field.column]))
+        else:
+            # Built without blocking writes, then turned into the constraint
+            with self.connection.schema_editor(atomic=False) as editor:
+                name = self.quote(editor._create_index_name(self.table, [field.column], suffix='_uniq'))
+            self.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {name} ON {self.quote(self.table)} '
+                         f'({self.quote(field.column)})')
+            self.execute(f'ALTER TABLE {self.quote(self.table)} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}')
+        self.progress(f'unique {self.table}({field.column})', 1, 1)
+
+    def add_index(self, index):
+        concurrently = self.concurrently
+        with self.connection.schema_editor(atomic=not concurrently) as editor:
+            kwargs = {'concurrently': True} if concurrently else {}
+            editor.add_index(self.model, index, **kwargs)
+        self.progress(f'index {index.name}', 1, 1)
+
+    def remove_index(self, name):
+        if not self.is_online:
+            with self.connection.schema_editor() as editor:
+                editor.execute(editor._delete_index_sql(self.model, name))
+            return
+        # The index is gone already when one of its columns was dropped
+        concurrently = 'CONCURRENTLY ' if self.concurrently else ''
+        self.execute(f'DROP INDEX {concurrently}IF EXISTS {self.quote(name)}')
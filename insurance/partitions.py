@@ -0,0 +1,223 @@
+import logging
+import re
+from collections import namedtuple
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.backends.utils import truncate_name
+from django.utils import timezone
+from .placement import model_connection
+
+logger = logging.getLogger(__name__)
+
+RANGE = 'range'
+HASH = 'hash'
+INTERVALS = ('month', 'year')
+BOUNDS = re.compile(r"FROM \('(\d{4}-\d{2}-\d{2})'\) TO \('(\d{4}-\d{2}-\d{2})'\)")
+
+
+class Partitioning(namedtuple('Partitioning', 'method field interval ahead retention partitions')):
+    """
+    How the table of a risk is partitioned, read from Risk.partitioning:
+
+    * ``{"method": "range", "field": "bought"}`` partitions by range on the
+      date field ``field``, one partition per ``interval`` (month or year).
+      ``ahead`` partitions are kept created after the current one and the
+      ones older than ``retention`` intervals are dropped, when it is set.
+      Rows out of the partitions, e.g. back-dated, go to a default partition.
+    * ``{"method": "hash"}`` partitions by hash on the id into ``partitions``
+      partitions.
+    """
+
+    @classmethod
+    def parse(cls, data):
+        "Returns the Partitioning of a JSON object, None when empty, raising ValueError when invalid"
+        if not data:
+            return None
+        if not isinstance(data, dict):
+            raise ValueError('Must be a JSON object')
+        unknown = set(data) - set(cls._fields)
+        if unknown:
+            raise ValueError(f"Unknown key(s): {', '.join(sorted(unknown))}")
+        partitioning = cls(data.get('method'), data.get('field'), data.get('interval', 'month'),
+                           data.get('ahead', 3), data.get('retention'), data.get('partitions', 8))
+        if partitioning.method not in (RANGE, HASH):
+            raise ValueError(f'The method must be "{RANGE}" or "{HASH}"')
+        if partitioning.method == RANGE and not partitioning.field:
+            raise ValueError('A range partitioning needs the name of a date field')
+        if partitioning.interval not in INTERVALS:
+            raise ValueError(f"The interval must be one of: {', '.join(INTERVALS)}")
+        for key in ('ahead', 'retention', 'partitions'):
+            value = getattr(partitioning, key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValueError(f'{key} must be a positive integer')
+        return partitioning
+
+
+def interval_start(day, interval):
+    return day.replace(day=1) if interval == 'month' else day.replace(month=1, day=1)
+
+
+def add_intervals(start, interval, count):
+    if interval == 'year':
+        return start.replace(year=start.year + count)
+    months = start.year * 12 + start.month - 1 + count
+    return start.replace(year=months // 12, month=months % 12 + 1)
+
+
+class PartitionManager:
+    """
+    Partitions of the table of a dynamic model on PostgreSQL. The parent
+    table holds no rows: columns added, altered or removed on it are changed
+    in every partition by PostgreSQL, and its indexes are created on each.
+    """
+
+    def __init__(self, model, partitioning, using=None):
+        self.model = model
+        self.partitioning = partitioning
+        self.table = model._meta.db_table
+        self.connection = model_connection(model, using)
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def execute(self, sql, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall() if cursor.description is not None else None
+
+    def partition_name(self, suffix):
+        return truncate_name(f'{self.table}_{suffix}', self.connection.ops.max_name_length())
+
+    @property
+    def key_field(self):
+        if self.partitioning.method == HASH:
+            return self.model._meta.pk
+        return self.model._meta.get_field(self.partitioning.field)
+
+    def create_table(self, today=None):
+        "Creates the partitioned table with its indexes and first partitions"
+        key = self.key_field
+        with self.connection.schema_editor() as editor:
+            columns = []
+            for field in self.model._meta.local_fields:
+                definition, params = editor.column_sql(self.model, field)
+                if field.primary_key:
+                    definition = definition.replace(' PRIMARY KEY', '')
+                columns.append(f'{self.quote(field.column)} {definition}')
+            # The primary key of a partitioned table has to hold the partition key
+            primary_key = dict.fromkeys([self.model._meta.pk.column, key.column])
+            columns.append(f"PRIMARY KEY ({', '.join(self.quote(column) for column in primary_key)})")
+            editor.execute(f"CREATE TABLE {self.quote(self.table)} ({', '.join(columns)}) "
+                           f"PARTITION BY {self.partitioning.method.upper()} ({self.quote(key.column)})")
+            editor.deferred_sql.extend(editor._model_indexes_sql(self.model))
+        if self.partitioning.method == HASH:
+            for remainder in range(self.partitioning.partitions):
+                self.execute(f'CREATE TABLE {self.quote(self.partition_name(f"p{remainder}"))} PARTITION OF '
+                             f'{self.quote(self.table)} FOR VALUES WITH (MODULUS {self.partitioning.partitions}, '
+                             f'REMAINDER {remainder})')
+            return
+        self.execute(f'CREATE TABLE {self.quote(self.partition_name("default"))} PARTITION OF '
+                     f'{self.quote(self.table)} DEFAULT')
+        self.maintain(today)
+
+    def partitions(self):
+        "Returns the {name: bounds} of the partitions, read from the catalog so renaming the table keeps them"
+        return dict(self.execute('SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) '
+                                 'FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                                 'WHERE pg_inherits.inhparent = to_regclass(%s)', [self.quote(self.table)]))
+
+    def default_partition(self):
+        return next((name for name, bounds in self.partitions().items() if bounds == 'DEFAULT'), None)
+
+    def range_partitions(self):
+        "Returns the {name: (start, end)} of the range partitions, the default one left out"
+        partitions = {}
+        for name, bounds in self.partitions().items():
+            match = BOUNDS.search(bounds)
+            if match is not None:
+                partitions[name] = tuple(timezone.datetime.strptime(value, '%Y-%m-%d').date()
+                                         for value in match.groups())
+        return partitions
+
+    def create_partition(self, start):
+        interval = self.partitioning.interval
+        end = add_intervals(start, interval, 1)
+        name = self.partition_name(f"p{start:%Y%m}" if interval == 'month' else f"p{start:%Y}")
+        table, partition = self.quote(self.table), self.quote(name)
+        column = self.quote(self.key_field.column)
+        default = self.default_partition()
+        with transaction.atomic(using=self.connection.alias):
+            self.execute(f'CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            if default is not None:
+                # Rows of the range that went to the default partition while this one was missing
+                self.execute(f'WITH moved AS (DELETE FROM {self.quote(default)} '
+                             f'WHERE {column} >= %s AND {column} < %s RETURNING *) '
+                             f'INSERT INTO {partition} SELECT * FROM moved', [start, end])
+            self.execute(f'ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)',
+                         [start, end])
+        return name
+
+    def drop_partition(self, name):
+        with transaction.atomic(using=self.connection.alias):
+            self.execute(f'ALTER TABLE {self.quote(self.table)} DETACH PARTITION {self.quote(name)}')
+            self.execute(f'DROP TABLE {self.quote(name)}')
+
+    def maintain(self, today=None):
+        """
+        Creates the range partitions from the current interval to ``ahead``
+        intervals after it, and drops the ones ending ``retention`` intervals
+        before it. Returns the names of the created and dropped partitions.
+        """
+        created, dropped = [], []
+        if self.partitioning.method != RANGE:
+            return {'created': created, 'dropped': dropped}
+        interval = self.partitioning.interval
+        current = interval_start(today or timezone.localdate(), interval)
+        partitions = self.range_partitions()
+        starts = {start for start, end in partitions.values()}
+        for count in range(self.partitioning.ahead + 1):
+            start = add_intervals(current, interval, count)
+            if start not in starts:
+                created.append(self.create_partition(start))
+        if self.partitioning.retention:
+            cutoff = add_intervals(current, interval, -self.partitioning.retention)
+            for name, (start, end) in sorted(partitions.items()):
+                if end <= cutoff:
+                    self.drop_partition(name)
+                    dropped.append(name)
+        if created or dropped:
+            logger.info("Partitions of %s: created %s, dropped %s", self.table, created, dropped)
+        return {'created': created, 'dropped': dropped}
+
+
+def is_partitioned(table, using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)",
+                       [connection.ops.quote_name(table)])
+        row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def leaf_partitions(table, using=DEFAULT_DB_ALIAS):
+    "Returns the names of the partitions holding the rows of a partitioned table, quoted when needed"
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relid::regclass::text FROM pg_partition_tree(%s) WHERE isleaf',
+                       [connection.ops.quote_name(table)])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def maintain_partitions(today=None):
+    "Creates and drops the range partitions of every risk, returns their names by risk id"
+    from .models import Risk
+    results = {}
+    for risk in Risk.objects.exclude(partitioning={}):
+        partitioning = risk.get_partitioning()
+        if partitioning is not None and partitioning.method == RANGE:
+            results[risk.id] = PartitionManager(risk.get_django_model(), partitioning).maintain(today)
+    return results
+
+
+def scheduled_maintenance(event, context):
+    "Entry point of the daily scheduled event of Zappa, see zappa_settings.json"
+    maintain_partitions()
@@ -0,0 +1,172 @@
+import copy
+import logging
+import re
+import threading
+from django.core.management.color import no_style
+from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_NAME = re.compile(r'^[a-z_][a-z0-9_]{0,62}$')
+MOVE_BATCH_SIZE = 5000
+_lock = threading.Lock()
+
+
+def placement_alias(database='', db_schema=''):
+    """
+    Returns the alias of the connections to the tables placed on the schema
+    ``db_schema`` of the database ``database``, both optional. A PostgreSQL
+    schema gets an alias of its own, a copy of the settings of its database
+    whose search path is the schema, so the tables keep their plain names and
+    the DDL, introspection and queries of Django all find them.
+    """
+    database = database or DEFAULT_DB_ALIAS
+    if not db_schema:
+        return database
+    alias = f'{database}:{db_schema}'
+    with _lock:
+        if alias not in connections.databases:
+            # The settings in use, e.g. the test database name
+            settings_dict = copy.deepcopy(connections[database].settings_dict)
+            options = settings_dict.setdefault('OPTIONS', {})
+            options['options'] = f"{options.get('options', '')} -c search_path={db_schema}".strip()
+            # Ignored by Django, see create_schema()
+            settings_dict['SCHEMA'] = db_schema
+            connections.databases[alias] = settings_dict
+    return alias
+
+
+def create_schema(connection):
+    "Creates the schema the tables of a placement alias go to, when missing"
+    db_schema = connection.settings_dict.get('SCHEMA')
+    if db_schema:
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {connection.ops.quote_name(db_schema)}')
+
+
+def model_connection(model, using=None):
+    "Returns the connection holding the table of a model, see PlacementRouter"
+    return connections[using or router.db_for_write(model)]
+
+
+class PlacementRouter:
+    """
+    Routes the queries of the dynamic models of the risks to the database and
+    schema of their risk, see Risk.database and Risk.db_schema. The other
+    models are left to the next routers, the risk metadata only being
+    migrated on the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        # Set on the models of the risks stored in a table of their own
+        placement = getattr(model, '__risk_placement__', None)
+        return placement_alias(*placement) if placement is not None else None
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'insurance' and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
+
+
+def same_database(alias, other):
+    "True when two aliases connect to the same PostgreSQL database, e.g. two of its schemas"
+    settings_dicts = [connections[name].settings_dict for name in (alias, other)]
+    return all(connections[name].vendor == 'postgresql' for name in (alias, other)) and len(
+        {tuple(settings.get(key) for key in ('HOST', 'PORT', 'NAME')) for settings in settings_dicts}) == 1
+
+
+def set_schema(model, source, target, db_schema):
+    "Moves the table of a model, its partitions, indexes and sequences, to a schema of the same database"
+    connection = connections[source]
+    quote = connection.ops.quote_name
+    if not db_schema:
+        # Back to the search path of the database, the tables go where it creates them
+        with connections[target].cursor() as cursor:
+            cursor.execute('SELECT current_schema()')
+            db_schema = cursor.fetchone()[0]
+    # All on the connection holding the lock, the target one would not see the uncommitted changes
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {quote(db_schema)}')
+        cursor.execute('SELECT relid::regclass::text FROM pg_partition_tree(%s) ORDER BY level DESC',
+                       [quote(model._meta.db_table)])
+        # No rows for a table that is not partitioned
+        tables = [row[0] for row in cursor.fetchall()] or [quote(model._meta.db_table)]
+        for table in tables:
+            cursor.execute(f'ALTER TABLE {table} SET SCHEMA {quote(db_schema)}')
+
+
+def copy_table(model, source, target, partitioning=None, batch_size=MOVE_BATCH_SIZE):
+    """
+    Creates the table of a model on another database and copies its rows by
+    batches of primary keys. The values are copied as stored, the model would
+    convert them, e.g. the codes of enum choices removed from their field
+    would read as None.
+    """
+    from .model_utils import SchemaBuilder
+    SchemaBuilder(model, using=target).create_db_table(partitioning)
+    source_connection, target_connection = connections[source], connections[target]
+    quote = source_connection.ops.quote_name
+    fields = model._meta.concrete_fields
+    table, pk = quote(model._meta.db_table), quote(model._meta.pk.column)
+    columns = ', '.join(quote(field.column) for field in fields)
+    pk_index = fields.index(model._meta.pk)
+    last, copied = None, 0
+    while True:
+        with source_connection.cursor() as cursor:
+            cursor.execute(f"SELECT {columns} FROM {table} {'' if last is None else f'WHERE {pk} > %s '}"
+                           f"ORDER BY {pk} LIMIT %s", ([] if last is None else [last]) + [batch_size])
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        # As many rows per INSERT as the parameters of the target allow
+        size = max(target_connection.ops.bulk_batch_size(fields, rows), 1)
+        with target_connection.cursor() as cursor:
+            for start in range(0, len(rows), size):
+                chunk = rows[start:start + size]
+                values = ', '.join([f"({', '.join(['%s'] * len(fields))})"] * len(chunk))
+                cursor.execute(f'INSERT INTO {table} ({columns}) VALUES {values}',
+                               [value for row in chunk for value in row])
+        last, copied = rows[-1][pk_index], copied + len(rows)
+        logger.info("Copied %s rows of %s to %s", copied, model._meta.db_table, target)
+    # New rows take ids after the copied ones
+    with target_connection.cursor() as cursor:
+        for sql in target_connection.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(sql)
+    return copied
+
+
+def move_risk(risk, database='', db_schema='', batch_size=MOVE_BATCH_SIZE):
+    """
+    Moves the table of a risk to another database and schema, see
+    Risk.database and Risk.db_schema, and points the risk to it. Between
+    schemas of a database only the catalog changes, other moves copy the rows
+    to a table created on the target then drop the source table. Writes wait
+    for the move, the source table being locked in SHARE mode. Returns False
+    when the table is there already.
+    """
+    from .models import Risk, SchemaVersion
+    from .model_utils import SchemaBuilder
+    if risk.storage != Risk.TABLE:
+        raise ValueError('Only the risks stored in a table of their own can be moved')
+    source, target = risk.get_placement_alias(), placement_alias(database, db_schema)
+    if source == target:
+        return False
+    model = risk.get_django_model()
+    with transaction.atomic(), transaction.atomic(using=source), transaction.atomic(using=target):
+        source_connection = connections[source]
+        if source_connection.vendor == 'postgresql':
+            with source_connection.cursor() as cursor:
+                cursor.execute(f'LOCK TABLE {source_connection.ops.quote_name(model._meta.db_table)} IN SHARE MODE')
+        if same_database(source, target):
+            set_schema(model, source, target, db_schema)
+        else:
+            copy_table(model, source, target, risk.get_partitioning(), batch_size)
+            SchemaBuilder(model, using=source).delete_model()
+        Risk.objects.filter(pk=risk.pk).update(database=database, db_schema=db_schema)
+        risk.database, risk.db_schema = database, db_schema
+        # Rebuilt with the new placement, here and in the other processes
+        risk.unregister_django_model()
+        SchemaVersion.bump(risk.pk)
+    return True
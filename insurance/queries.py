@@ -0,0 +1,139 @@
+import base64
+import json
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from .documents import record_fields
+
+LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte', 'in', 'isnull')
+ORDERING_PARAM = 'ordering'
+BOOLEANS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+class QueryError(ValueError):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class RecordQuery:
+    """
+    Filters and ordering of the records of a dynamic model, read from query
+    parameters:
+
+    * ``<field>=value`` or ``<field>__<lookup>=value`` with the lookups exact,
+      gt, gte, lt, lte, in (comma separated values) and isnull (true/false)
+    * ``ordering=-date_bought,name``, id is always added as the last key so
+      the order is total and usable for keyset pagination
+
+    Values are converted with the fields of the model, so a bad value is an
+    error instead of a failing query, and the whole query compiles to a single
+    parameterized SELECT. Nulls sort last ascending and first descending,
+    which is the order of a PostgreSQL btree index.
+    """
+
+    def __init__(self, model, params, ignore=()):
+        self.model = model
+        self.fields = {field.name: field for field in record_fields(model)}
+        errors = {}
+        self.where = Q()
+        for param, value in params.items():
+            if param == ORDERING_PARAM or param in ignore:
+                continue
+            try:
+                self.where &= self.get_condition(param, value)
+            except QueryError as err:
+                errors[param] = err.errors
+        try:
+            self.ordering = self.get_ordering(params.get(ORDERING_PARAM, ''))
+        except QueryError as err:
+            errors[ORDERING_PARAM] = err.errors
+        if errors:
+            raise QueryError(errors)
+
+    def get_field(self, name):
+        if name not in self.fields:
+            raise QueryError([f"Unknown field: {name}"])
+        return self.fields[name]
+
+    def convert(self, name, value):
+        "Returns a query value as the Python value of a field"
+        if value is None:
+            return None
+        try:
+            return self.get_field(name).to_python(value)
+        except ValidationError as err:
+            raise QueryError(err.messages)
+
+    def get_condition(self, param, value):
+        name, _, lookup = param.partition('__')
+        lookup = lookup or 'exact'
+        self.get_field(name)
+        if lookup not in LOOKUPS:
+            raise QueryError([f"Unknown lookup: {lookup}. Use one of: {', '.join(LOOKUPS)}"])
+        if lookup == 'isnull':
+            if value.lower() not in BOOLEANS:
+                raise QueryError(['Must be true or false.'])
+            value = BOOLEANS[value.lower()]
+        elif lookup == 'in':
+            value = [self.convert(name, item) for item in value.split(',')]
+        else:
+            value = self.convert(name, value)
+        return Q(**{f'{name}__{lookup}': value})
+
+    def get_ordering(self, value):
+        "Returns the (field name, descending) keys of the ordering"
+        ordering = []
+        for item in filter(None, value.split(',')):
+            name = item.lstrip('-')
+            self.get_field(name)
+            ordering.append((name, item.startswith('-')))
+        if 'id' not in (name for name, descending in ordering):
+            ordering.append(('id', False))
+        return ordering
+
+    def get_order_by(self):
+        return [F(name).desc(nulls_first=True) if descending else F(name).asc(nulls_last=True)
+                for name, descending in self.ordering]
+
+    def get_queryset(self):
+        return self.model.objects.filter(self.where).order_by(*self.get_order_by())
+
+    def get_position(self, record):
+        "Returns the ordering key values of a record"
+        return [getattr(record, name) for name, descending in self.ordering]
+
+    def after(self, position):
+        """
+        Returns the condition selecting the records that come after the given
+        ordering key values, e.g. ``a > x OR (a = x AND id > y)``
+        """
+        condition = None
+        for (name, descending), value in reversed(list(zip(self.ordering, position))):
+            if value is None:
+                # Nulls are last ascending: nothing comes after them but the next keys
+                after = Q(**{f'{name}__isnull': False}) if descending else None
+                equal = Q(**{f'{name}__isnull': True})
+            else:
+                after = Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+                if not descending and self.fields[name].null:
+                    after |= Q(**{f'{name}__isnull': True})
+                equal = Q(**{name: value})
+            if condition is None:
+                condition = after if after is not None else Q(pk__in=[])
+            else:
+                condition = equal & condition if after is None else after | (equal & condition)
+        return condition
+
+    def encode_position(self, position):
+        data = json.dumps(position, cls=DjangoJSONEncoder).encode()
+        return base64.urlsafe_b64encode(data).decode()
+
+    def decode_position(self, cursor):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise QueryError(['Invalid cursor.'])
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise QueryError(['Invalid cursor.'])
+        return [self.convert(name, value) for (name, descending), value in zip(self.ordering, position)]
@@ -0,0 +1,159 @@
+import json
+from collections import namedtuple
+from django.apps.registry import Apps
+from django.core.exceptions import FieldError, ValidationError
+from django.db import connection, models
+from django.db.models import Index, Q
+from django.db.models.sql import Query
+from .enums import EnumField
+
+# kwargs describing the index led by a field: db_index turns it on, index_with
+# lists the other fields of a composite index and index_condition holds the
+# lookups of a partial index, e.g. {"status": "active"}
+INDEX_KWARGS = ('db_index', 'index_with', 'index_condition')
+
+# kwargs that do not change the column itself: defaults are not kept in the
+# database, enum choices live in EnumChoice and indexes are IndexSpecs
+NON_DDL_KWARGS = ('default', 'choices') + INDEX_KWARGS
+
+
+class FieldSpec(namedtuple('FieldSpec', 'key name field_type kwargs choices')):
+    """
+    Stored description of one RiskField: ``key`` is its id, ``kwargs`` the
+    JSON text of its kwargs so specs stay hashable, ``choices`` the sorted
+    EnumChoice values or None when they were not loaded.
+    """
+
+    def get_kwargs(self):
+        return json.loads(self.kwargs)
+
+    def get_ddl(self):
+        "Returns what the column looks like in the database"
+        kwargs = {key: value for key, value in self.get_kwargs().items() if key not in NON_DDL_KWARGS}
+        return self.name, self.field_type, kwargs
+
+
+class IndexSpec(namedtuple('IndexSpec', 'name fields condition')):
+    """
+    Stored description of an index of a risk table, matched by its database
+    name: ``fields`` the tuple of column names, ``condition`` the JSON text of
+    the lookups of a partial index or None.
+    """
+
+    def get_index(self):
+        condition = Q(**json.loads(self.condition)) if self.condition else None
+        return Index(fields=list(self.fields), name=self.name, condition=condition)
+
+
+def check_condition(condition, fields):
+    """
+    Raises ValidationError unless every lookup of a partial index condition
+    is one of the given Django fields, keyed by name, with a lookup it has and
+    a value it takes, by compiling the condition against a model of them
+    """
+    # Built in a registry of its own, the model is thrown away
+    attrs = {name: (field.text_field() if isinstance(field, EnumField) else field.clone())
+             for name, field in fields.items()}
+    attrs.update(__module__=__name__, Meta=type('Meta', (), {'app_label': 'insurance', 'apps': Apps()}))
+    query = Query(type('IndexCondition', (models.Model,), attrs))
+    for lookup, value in condition.items():
+        if lookup.split('__')[0] not in fields:
+            raise ValidationError(f'Unknown field in the lookup "{lookup}"')
+        try:
+            query.get_compiler(connection=connection).compile(query.build_where(Q(**{lookup: value})))
+        except (FieldError, ValidationError, ValueError, TypeError) as error:
+            message = error.messages[0] if isinstance(error, ValidationError) else error
+            raise ValidationError(f'Invalid lookup "{lookup}": {message}')
+
+
+Operation = namedtuple('Operation', 'action old new')
+
+
+def field_spec(risk_field, with_choices=False):
+    choices = tuple(sorted(c.value for c in risk_field.choices.all())) if with_choices else None
+    return FieldSpec(risk_field.id, risk_field.name, risk_field.field_type,
+                     json.dumps(risk_field.kwargs, sort_keys=True), choices)
+
+
+def index_specs(risk_fields):
+    "Returns the IndexSpecs of the indexed RiskFields, leaving out names of missing fields"
+    names = {f.name for f in risk_fields}
+    specs = []
+    for risk_field in risk_fields:
+        kwargs = risk_field.kwargs
+        if not kwargs.get('db_index'):
+            continue
+        columns = dict.fromkeys([risk_field.name] + [name for name in kwargs.get('index_with') or [] if name in names])
+        condition = {lookup: value for lookup, value in (kwargs.get('index_condition') or {}).items()
+                     if lookup.split('__')[0] in names}
+        specs.append(IndexSpec(risk_field.get_index_name(), tuple(columns),
+                               json.dumps(condition, sort_keys=True) if condition else None))
+    return sorted(specs)
+
+
+def schema_snapshot(risk_fields, with_choices=False):
+    """
+    Returns the FieldSpecs of a set of RiskFields ordered by id, followed by
+    the IndexSpecs of their indexes ordered by name
+    """
+    risk_fields = list(risk_fields)
+    fields = sorted((field_spec(f, with_choices) for f in risk_fields), key=lambda spec: spec.key or 0)
+    return tuple(fields) + tuple(index_specs(risk_fields))
+
+
+def diff_schema(old, new):
+    """
+    Returns the minimal ordered list of operations turning the columns of the
+    ``old`` snapshot into those of the ``new`` one. Fields are matched by key:
+    a changed name alone is a ``rename``, any other column change an ``alter``
+    (which may rename too). Drops come first and adds last so names are free
+    when they are reused; renames that swap names go through a temporary name.
+    Changed indexes are dropped before the columns change and created after.
+    """
+    old_indexes = {spec for spec in old if isinstance(spec, IndexSpec)}
+    new_indexes = {spec for spec in new if isinstance(spec, IndexSpec)}
+    old = [spec for spec in old if isinstance(spec, FieldSpec)]
+    new = [spec for spec in new if isinstance(spec, FieldSpec)]
+    index_removes = [Operation('remove_index', spec, None) for spec in sorted(old_indexes - new_indexes)]
+    index_adds = [Operation('add_index', None, spec) for spec in sorted(new_indexes - old_indexes)]
+    old_by_key = {spec.key: spec for spec in old}
+    new_by_key = {spec.key: spec for spec in new}
+    removes = [Operation('remove', spec, None) for spec in old if spec.key not in new_by_key]
+    adds = [Operation('add', None, spec) for spec in new if spec.key not in old_by_key]
+    changes = []
+    for spec in old:
+        latest = new_by_key.get(spec.key)
+        if latest is None or latest == spec:
+            continue
+        old_ddl, new_ddl = spec.get_ddl(), latest.get_ddl()
+        if old_ddl == new_ddl:
+            continue
+        only_renamed = old_ddl[1:] == new_ddl[1:]
+        changes.append(Operation('rename' if only_renamed else 'alter', spec, latest))
+    occupied = {spec.name for spec in old if spec.key in new_by_key}
+    return index_removes + removes + order_changes(changes, occupied) + adds + index_adds
+
+
+def order_changes(changes, occupied):
+    # Run a rename only once its target name has been freed
+    pending, ordered = list(changes), []
+    while pending:
+        for operation in pending:
+            if operation.old.name == operation.new.name or operation.new.name not in occupied:
+                ordered.append(operation)
+                occupied.discard(operation.old.name)
+                occupied.add(operation.new.name)
+                pending.remove(operation)
+                break
+        else:
+            # Only cycles are left, park one column under a temporary name
+            operation = pending[0]
+            temp_name = f'{operation.old.name}__tmp'
+            while temp_name in occupied:
+                temp_name += '_'
+            parked = operation.old._replace(name=temp_name)
+            ordered.append(Operation('rename', operation.old, parked))
+            occupied.discard(operation.old.name)
+            occupied.add(temp_name)
+            pending[0] = operation._replace(old=parked)
+    return ordered
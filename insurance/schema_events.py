@@ -0,0 +1,166 @@
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection
+from django.db.utils import DatabaseError
+from django.db.models import Max
+from .model_cache import model_cache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'insurance_schema'
+EVENT_MODES = ('listen', 'poll')
+# Tells the events of this process apart, its own cache is already up to date
+PROCESS_TOKEN = uuid.uuid4().hex
+# Ids per NOTIFY, whose payload must stay under 8000 bytes
+NOTIFY_BATCH_SIZE = 500
+# Past this many ids the other processes evict every model in a single event
+NOTIFY_MAX_IDS = 5000
+
+
+def publish(risk_ids):
+    """
+    Sends the ids of the risks whose schema changed to the other processes,
+    split across events of NOTIFY_BATCH_SIZE ids. NOTIFY is transactional,
+    the events go out when the change commits.
+    """
+    if connection.vendor != 'postgresql' or not risk_ids:
+        return
+    risk_ids = sorted(set(risk_ids))
+    if len(risk_ids) > NOTIFY_MAX_IDS:
+        payloads = [json.dumps({'origin': PROCESS_TOKEN, 'all': True})]
+    else:
+        payloads = [json.dumps({'origin': PROCESS_TOKEN, 'risks': risk_ids[start:start + NOTIFY_BATCH_SIZE]})
+                    for start in range(0, len(risk_ids), NOTIFY_BATCH_SIZE)]
+    with connection.cursor() as cursor:
+        for payload in payloads:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, payload])
+
+
+def handle_event(payload):
+    "Evicts the cached models of the risks of an event sent by another process"
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning("Ignored schema event: %r", payload)
+        return
+    if event.get('origin') == PROCESS_TOKEN:
+        return
+    if event.get('all'):
+        model_cache.clear()
+        return
+    for risk_id in event.get('risks', ()):
+        model_cache.evict(risk_id)
+
+
+def get_last_change_id():
+    "Returns the id of the last SchemaChange, 0 when the log is empty"
+    from .models import SchemaChange
+    return SchemaChange.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+class SchemaPoller:
+    """
+    Evicts the models of the risks changed by other processes from the
+    SchemaChange log, at most once every ``interval`` seconds and with one
+    primary key range query. For servers without a listener thread, e.g.
+    Lambda, where it runs at the start of the requests. ``last_change_id``
+    is the last change the models in the cache have seen, read before they
+    are built, see start().
+    """
+
+    def __init__(self, interval=1.0, last_change_id=None):
+        self.interval = interval
+        self.last_change_id = last_change_id
+        self.next_poll = 0
+
+    def poll(self, **kwargs):
+        from .models import SchemaChange
+        now = time.monotonic()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + self.interval
+        if self.last_change_id is None:
+            # The log could not be read at start, the models built from now on are current
+            self.last_change_id = get_last_change_id()
+            return
+        changes = list(SchemaChange.objects.filter(id__gt=self.last_change_id).values_list('id', 'risk_id'))
+        for change_id, risk_id in changes:
+            model_cache.evict(risk_id)
+            self.last_change_id = max(self.last_change_id, change_id)
+
+
+class SchemaListener(threading.Thread):
+    """
+    Daemon thread holding its own connection that LISTENs to the schema
+    events and evicts the affected models as soon as a change commits. After
+    a lost connection every model is evicted, events may have been missed.
+    """
+
+    def __init__(self, connection_params, timeout=5.0, retry=1.0):
+        super().__init__(name='insurance-schema-listener', daemon=True)
+        self.connection_params = connection_params
+        self.timeout = timeout
+        self.retry = retry
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except Exception:
+                logger.exception("Schema listener lost its connection")
+            self.listening.clear()
+            model_cache.clear()
+            self.stopped.wait(self.retry)
+
+    def listen(self):
+        import psycopg2
+        listen_connection = psycopg2.connect(**self.connection_params)
+        try:
+            listen_connection.autocommit = True
+            with listen_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            self.listening.set()
+            while not self.stopped.is_set():
+                if select.select([listen_connection], [], [], self.timeout) == ([], [], []):
+                    continue
+                listen_connection.poll()
+                while listen_connection.notifies:
+                    handle_event(listen_connection.notifies.pop(0).payload)
+        finally:
+            listen_connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start(mode=None):
+    """
+    Starts following the schema changes of the other processes, as set by
+    INSURANCE_SCHEMA_EVENTS: 'listen' starts a SchemaListener, 'poll' a
+    SchemaPoller run when requests start. Returns the listener or poller.
+    Runs before the models are built, the changes made while they are
+    built are evicted at the first poll.
+    """
+    mode = mode or getattr(settings, 'INSURANCE_SCHEMA_EVENTS', '')
+    if mode not in EVENT_MODES:
+        return None
+    if mode == 'poll':
+        try:
+            last_change_id = get_last_change_id()
+        except DatabaseError:
+            # e.g. migrate runs before the log exists, the first poll reads it
+            last_change_id = None
+        poller = SchemaPoller(getattr(settings, 'INSURANCE_SCHEMA_POLL_INTERVAL', 1.0), last_change_id)
+        request_started.connect(poller.poll, weak=False, dispatch_uid='insurance-schema-poller')
+        return poller
+    listener = SchemaListener(connection.get_connection_params())
+    listener.start()
+    return listener
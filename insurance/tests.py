@@ -1,7 +1,39 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from datetime import date
+from unittest import mock
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, AsyncClient, override_settings
 from rest_framework.test import APITestCase, APIClient
-from .models import Risk, RiskField
-from .api.serializers import RiskAndFieldsSerializer, RiskOnlySerializer
+from django.db import connection, connections, router, models, DataError, IntegrityError, transaction
+from django.core.management import call_command, CommandError
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.core.signals import request_started
+from django.test.client import FakePayload
+from asgiref.sync import sync_to_async
+from django.test.utils import CaptureQueriesContext
+from .models import Risk, RiskField, RiskRecord, EnumChoice, EnumCode, SchemaVersion, SchemaChange
+from .model_utils import SchemaBuilder
+from .enums import MAX_CODE, get_codes_queryset
+from .online_schema import OnlineSchemaEditor
+from .model_cache import model_cache
+from .imports import import_records
+from .queries import RecordQuery
+from .partitions import PartitionManager, add_intervals, is_partitioned
+from .schema_diff import FieldSpec, IndexSpec, diff_schema
+from .bootstrap import bootstrap, dump_snapshot
+from .catalog import import_catalog, export_catalog, CatalogError
+from .placement import move_risk
+from .async_db import close_pools
+from .metrics import metrics
+from .schema_events import SchemaPoller, SchemaListener, CHANNEL, handle_event, publish
+from . import schema_events
+from .api.serializers import RiskAndFieldsSerializer, RiskOnlySerializer, get_record_serializer
 from django.contrib.auth.models import User
 from django.apps import apps
 
@@ -27,9 +59,31 @@ class GetRiskTest(APITestCase):
         """
         response = self.client.get('/api/v1/risks-fields/', content_type={'Content-Type': 'application/json'})
         serializer = RiskAndFieldsSerializer(Risk.objects.all(), many=True)
-        self.assertEqual(response.json(), serializer.data)
+        self.assertEqual(response.json()['results'], serializer.data)
         self.assertEqual(response.status_code, 200)
 
+    def test_risk_fields_api_query_count(self):
+        """
+        Test the number of queries does not grow with risks and fields
+        """
+        choices = EnumChoice.objects.bulk_create([EnumChoice(choice='Sedan', value='sedan'),
+                                                  EnumChoice(choice='Truck', value='truck')])
+        query_counts = []
+        for size in (2, 6):
+            for i in range(size):
+                risk = Risk.objects.create(name=f'Risk {size} {i}', description='risk model')
+                for j in range(size):
+                    field = RiskField.objects.bulk_create([
+                        RiskField(name=f'field_{j}', field_type='CharField', risk=risk,
+                                  kwargs={'choices': True, 'max_length': 20, 'null': True})
+                    ])[0]
+                    field.choices.set(choices)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/risks-fields/')
+            self.assertEqual(response.status_code, 200)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_single_risk_api(self):
         """
         Test the rest api for single risk
@@ -40,6 +94,59 @@ class GetRiskTest(APITestCase):
         self.assertEqual(response.json(), serializer.data)
         self.assertEqual(response.status_code, 200)
 
+    def test_conditional_get(self):
+        """
+        Test unchanged schemas answer 304 from one version lookup and field changes bump the versions
+        """
+        risk_obj = Risk.objects.first()
+        for max_length, url in ((30, f'/api/v1/risks/{risk_obj.id}/'), (40, '/api/v1/risks-fields/')):
+            response = self.client.get(url)
+            self.assertTrue(response.has_header('Last-Modified'))
+            with CaptureQueriesContext(connection) as queries:
+                cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(len(queries), 1)
+            field = risk_obj.fields.first()
+            field.kwargs = {'max_length': max_length, 'null': True}
+            field.save()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        choice = EnumChoice.objects.create(choice='Sedan', value='sedan')
+        field.choices.set([choice])
+        version = Risk.objects.get(pk=risk_obj.id).schema_version
+        choice.value = 'saloon'
+        choice.save()
+        self.assertEqual(Risk.objects.get(pk=risk_obj.id).schema_version, version + 1)
+        # Deleted along with a queryset, as the admin action does
+        EnumChoice.objects.filter(pk=choice.pk).delete()
+        self.assertEqual(Risk.objects.get(pk=risk_obj.id).schema_version, version + 2)
+
+    def test_risk_api_bad_pk(self):
+        """
+        Test a non-numeric primary key answers 404
+        """
+        self.assertEqual(self.client.get('/api/v1/risks/abc/').status_code, 404)
+
+    def test_schema_changes(self):
+        """
+        Test the delta sync returns the changed risks and tombstones after a cursor
+        """
+        cursor = self.client.get('/api/v1/risks-fields/changes/').json()['cursor']
+        car = Risk.objects.get(name='Car Risk')
+        bike = Risk.objects.create(name='Bike', description='bike risk model')
+        RiskField.objects.bulk_create([RiskField(name='wheels', field_type='IntegerField', risk=bike,
+                                                 kwargs={'null': True})])
+        car.fields.get(name='no_seats').delete()
+        response = self.client.get('/api/v1/risks-fields/changes/', {'since': cursor}).json()
+        self.assertEqual([risk['name'] for risk in response['risks']], ['Car Risk', 'Bike'])
+        self.assertEqual([len(risk['fields']) for risk in response['risks']], [2, 1])
+        self.assertEqual([field['risk'] for field in response['deleted_fields']], [car.id])
+        bike_id = bike.id
+        bike.delete()
+        response = self.client.get('/api/v1/risks-fields/changes/', {'since': response['cursor']}).json()
+        self.assertEqual((response['risks'], response['deleted_risks']), ([], [bike_id]))
+        response = self.client.get('/api/v1/risks-fields/changes/', {'since': response['cursor']}).json()
+        self.assertEqual((response['risks'], response['deleted_risks'], response['more']), ([], [], False))
+
 
 class ModelTest(TestCase):
     def setUp(self):
@@ -47,7 +154,8 @@ class ModelTest(TestCase):
         Initialize certain process/actions
         """
         self.client.force_login(User.objects.create_superuser('admin_test', '123'))
-        self.post_data = {'name': ['Car'], 'description': ['This is for an insurance'], 'fields-TOTAL_FORMS': ['2'],
+        self.post_data = {'name': ['Car'], 'description': ['This is for an insurance'], 'storage': ['table'],
+                          'fields-TOTAL_FORMS': ['2'],
                           'fields-INITIAL_FORMS': ['0'], 'fields-MIN_NUM_FORMS': ['0'],
                           'fields-MAX_NUM_FORMS': ['1000'], 'fields-0-id': [''], 'fields-0-risk': [''],
                           'fields-0-name': ['name'], 'fields-0-field_type': ['CharField'],
@@ -127,3 +235,1254 @@ class ModelTest(TestCase):
         risk.save()
         latest_model = risk.get_django_model()
         self.assertEqual(risk.get_model_name, latest_model._meta.model_name)
+
+    def test_admin_change_applies_change_set(self):
+        """
+        Test an admin save renames, drops and adds fields with one model rebuild
+        """
+        risk = Risk.objects.first()
+        name_field, age_field = risk.fields.order_by('id')
+        risk.get_django_model()
+        post_data = {'name': 'Car', 'description': 'This is for an insurance', 'fields-TOTAL_FORMS': '3',
+                     'fields-INITIAL_FORMS': '2', 'fields-MIN_NUM_FORMS': '0', 'fields-MAX_NUM_FORMS': '1000',
+                     'fields-0-id': name_field.id, 'fields-0-risk': risk.id, 'fields-0-name': 'car_name',
+                     'fields-0-field_type': 'CharField', 'fields-0-max_length': '20', 'fields-0-default': '',
+                     'fields-1-id': age_field.id, 'fields-1-risk': risk.id, 'fields-1-name': 'age',
+                     'fields-1-field_type': 'IntegerField', 'fields-1-default': '', 'fields-1-DELETE': 'on',
+                     'fields-2-id': '', 'fields-2-risk': risk.id, 'fields-2-name': 'colour',
+                     'fields-2-field_type': 'CharField', 'fields-2-max_length': '10', 'fields-2-null': 'on',
+                     'fields-2-default': '', '_save': 'Save'}
+        builds = model_cache.builds
+        response = self.client.post(f'/admin/insurance/risk/{risk.id}/change/', data=post_data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(model_cache.builds, builds + 1)
+        model = risk.get_django_model()
+        self.assertEqual([field.name for field in model._meta.fields], ['id', 'car_name', 'colour'])
+        record = model.objects.create(car_name='Toyota', colour='red')
+        self.assertEqual(model.objects.get(pk=record.pk).colour, 'red')
+
+    def test_admin_checks_index_condition(self):
+        """
+        Test the lookups of a partial index are checked against the fields of the risk
+        """
+        # The form is rendered again with its errors, partitioning included
+        post_data = dict(self.post_data, name=['Van'], partitioning=['{}'], **{'fields-0-db_index': ['on']})
+        for condition, status_code in (('{"age__near": 3}', 200), ('{"age": "old"}', 200), ('{"id": 1}', 200),
+                                       ('{"age__gte": 18, "name__startswith": "T"}', 302)):
+            post_data['fields-0-index_condition'] = [condition]
+            response = self.client.post('/admin/insurance/risk/add/', data=post_data)
+            self.assertEqual(response.status_code, status_code, condition)
+            if status_code == 200:
+                self.assertContains(response, 'lookup &quot;')
+        self.assertTrue(Risk.objects.filter(name='Van').exists())
+
+
+class ModelCacheTest(TestCase):
+    def setUp(self):
+        """
+        Create a risk with its table
+        """
+        self.risk = Risk.objects.create(name='Boat', description='boat risk model')
+        RiskField.objects.create(name='name', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 25, 'null': True})
+        SchemaBuilder(self.risk.get_django_model()).create_db_table()
+
+    def test_cache_hit_without_query(self):
+        """
+        Test a cached model is served without touching the database
+        """
+        model = self.risk.get_django_model()
+        hits = model_cache.hits
+        with self.assertNumQueries(0):
+            self.assertIs(model, self.risk.get_django_model())
+        self.assertEqual(model_cache.hits, hits + 1)
+
+    def test_unchanged_field_keeps_model(self):
+        """
+        Test saving a field without schema change does not rebuild the model
+        """
+        model = self.risk.get_django_model()
+        field = self.risk.fields.first()
+        field.save()
+        self.assertIs(model, self.risk.get_django_model())
+
+    def test_unchanged_field_runs_no_ddl(self):
+        """
+        Test saving an unchanged field only updates its row
+        """
+        field = self.risk.fields.first()
+        with CaptureQueriesContext(connection) as queries:
+            field.save()
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['UPDATE'])
+
+    def test_field_change_invalidates_model(self):
+        """
+        Test a schema change builds a new model
+        """
+        model = self.risk.get_django_model()
+        field = self.risk.fields.first()
+        field.name = 'boat_name'
+        field.save()
+        latest_model = self.risk.get_django_model()
+        self.assertIsNot(model, latest_model)
+        self.assertEqual('boat_name', latest_model._meta.get_field('boat_name').name)
+        RiskField.objects.create(name='length', field_type='IntegerField', risk=self.risk, kwargs={'null': True})
+        self.assertIn('length', [f.name for f in self.risk.get_django_model()._meta.fields])
+
+    def test_concurrent_builds(self):
+        """
+        Test threads missing the same model at once share a single build
+        """
+        fields = list(self.risk.fields.all())
+
+        def build():
+            time.sleep(0.05)
+            return self.risk.build_django_model(fields)
+
+        models_built = []
+        model_cache.invalidate(self.risk.id)
+        builds = model_cache.builds
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            threads = [threading.Thread(target=lambda: models_built.append(
+                model_cache.get_or_build(self.risk.id, self.risk.get_model_name, build))) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(model_cache.builds, builds + 1)
+        self.assertEqual(len(models_built), 8)
+        self.assertEqual(len(set(models_built)), 1)
+        self.assertIs(apps.get_model('insurance', self.risk.get_model_name), models_built[0])
+
+    def test_risk_iteration_is_lazy(self):
+        """
+        Test loading risks runs no query for their dynamic models
+        """
+        model_cache.clear()
+        with self.assertNumQueries(1):
+            list(Risk.objects.all())
+
+    def test_bootstrap(self):
+        """
+        Test the registry is built from the database in two queries, or a current snapshot in one
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        dump_snapshot(path)
+        for mode, queries, source in (('build', 2, 'database'), ('snapshot', 1, 'snapshot')):
+            self.risk.unregister_django_model()
+            with self.assertNumQueries(queries):
+                stats = bootstrap(mode, path)
+            self.assertEqual((stats['source'], stats['queries'], stats['models']), (source, queries, 1))
+            with self.assertNumQueries(0):
+                self.assertEqual(Risk(id=self.risk.id, name='Boat').get_django_model()._meta.db_table,
+                                 'insurance_boat')
+        SchemaVersion.bump(self.risk.id)
+        self.assertEqual(bootstrap('snapshot', path)['source'], 'database')
+        os.remove(path)
+
+
+class SchemaEventsTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a risk with a cached model
+        """
+        self.risk = Risk.objects.create(name='Plane', description='plane risk model')
+        RiskField.objects.bulk_create([RiskField(name='wings', field_type='IntegerField', risk=self.risk,
+                                                 kwargs={'null': True})])
+        self.risk.get_django_model()
+
+    def tearDown(self):
+        self.risk.unregister_django_model()
+
+    def test_poll_evicts_changed_risks(self):
+        """
+        Test the poller evicts the models of the risks in the change log since its last poll
+        """
+        poller = SchemaPoller(interval=0)
+        poller.poll()
+        SchemaVersion.bump(self.risk.id)
+        with self.assertNumQueries(1):
+            poller.poll()
+        self.assertIsNone(model_cache.get(self.risk.id, self.risk.get_model_name))
+
+    def test_poller_starts_from_the_models_built(self):
+        """
+        Test a poller started before the models are built evicts the changes made since, at its first poll
+        """
+        poller = schema_events.start('poll')
+        try:
+            SchemaVersion.bump(self.risk.id)
+            poller.poll()
+            self.assertIsNone(model_cache.get(self.risk.id, self.risk.get_model_name))
+        finally:
+            request_started.disconnect(dispatch_uid='insurance-schema-poller')
+
+    def test_append_holds_lock_until_commit(self):
+        """
+        Test the changes are inserted in the transaction holding the log lock, even in autocommit
+        """
+        def bulk_create(changes):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pg_locks WHERE locktype = 'advisory' AND objid = %s "
+                               "AND pid = pg_backend_pid()", [SchemaChange.LOCK_ID])
+                locks.append(cursor.fetchone()[0])
+
+        locks = []
+        with mock.patch.object(SchemaChange.objects, 'bulk_create', side_effect=bulk_create):
+            SchemaChange.append([SchemaChange(risk_id=self.risk.id)])
+        self.assertEqual(locks, [1])
+
+    def test_listener_evicts_changed_risks(self):
+        """
+        Test a NOTIFY sent by another process evicts the model of its risks
+        """
+        listener = SchemaListener(connection.get_connection_params(), timeout=0.1)
+        listener.start()
+        try:
+            self.assertTrue(listener.listening.wait(5))
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)',
+                               [CHANNEL, json.dumps({'origin': 'other', 'risks': [self.risk.id]})])
+            for _ in range(50):
+                if model_cache.get_fingerprint(self.risk.id) is None:
+                    break
+                listener.stopped.wait(0.1)
+            self.assertIsNone(model_cache.get_fingerprint(self.risk.id))
+        finally:
+            listener.stop()
+            listener.join()
+
+    def test_publish_splits_large_events(self):
+        """
+        Test the ids of a large change go out in several NOTIFYs, or as one event evicting every model
+        """
+        import psycopg2
+        listen_connection = psycopg2.connect(**connection.get_connection_params())
+
+        def receive(count):
+            for _ in range(50):
+                listen_connection.poll()
+                if len(listen_connection.notifies) >= count:
+                    break
+                time.sleep(0.1)
+            payloads = [notify.payload for notify in listen_connection.notifies]
+            listen_connection.notifies.clear()
+            return payloads
+
+        try:
+            listen_connection.autocommit = True
+            with listen_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            risk_ids = range(1_000_000, 1_003_000)
+            SchemaVersion.bump(*risk_ids)
+            payloads = receive(6)
+            self.assertEqual(len(payloads), 6)
+            self.assertTrue(all(len(payload) < 8000 for payload in payloads))
+            self.assertEqual([risk_id for payload in payloads for risk_id in json.loads(payload)['risks']],
+                             list(risk_ids))
+            publish(range(10_000))
+            payloads = receive(1)
+        finally:
+            listen_connection.close()
+        self.assertEqual([json.loads(payload).get('all') for payload in payloads], [True])
+        handle_event(payloads[0].replace(json.loads(payloads[0])['origin'], 'other'))
+        self.assertIsNone(model_cache.get_fingerprint(self.risk.id))
+
+
+class MetricsTest(APITestCase):
+    def setUp(self):
+        """
+        Create a risk with its table and start from empty metrics
+        """
+        metrics.clear()
+        self.risk = Risk.objects.create(name='Tractor', description='tractor risk model')
+        RiskField.objects.create(name='name', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 25, 'null': True})
+        SchemaBuilder(self.risk.get_django_model()).create_db_table()
+        self.url = f'/api/v1/risks/{self.risk.id}/records/'
+
+    def get_value(self, text, metric):
+        lines = [line for line in text.splitlines() if line.startswith(metric + ' ')]
+        return float(lines[0].split()[-1]) if lines else None
+
+    def test_metrics_endpoint(self):
+        """
+        Test the requests, queries, model builds, DDL and serialization are exposed per endpoint
+        """
+        self.client.get(self.url)
+        self.client.get(self.url)
+        text = self.client.get('/metrics/').content.decode()
+        endpoint = '{endpoint="api:risk-records-list"}'
+        self.assertIn('# TYPE insurance_request_total counter', text)
+        self.assertEqual(self.get_value(text, f'insurance_request_total{endpoint}'), 2)
+        self.assertEqual(self.get_value(text, f'insurance_db_query_total{endpoint}'), 4)
+        self.assertGreater(self.get_value(text, f'insurance_db_query_seconds_total{endpoint}'), 0)
+        self.assertEqual(self.get_value(text, f'insurance_serialization_total{endpoint}'), 2)
+        self.assertEqual(self.get_value(text, 'insurance_model_build_total{endpoint="-"}'), 1)
+        self.assertEqual(self.get_value(text, 'insurance_ddl_total{endpoint="-",operation="create_db_table"}'), 1)
+
+    def test_metrics_allowed_ips(self):
+        """
+        Test only the allowed addresses read the metrics
+        """
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    @override_settings(INSURANCE_SLOW_REQUEST_SECONDS=1e-9)
+    def test_slow_request_log(self):
+        """
+        Test a slow request is logged with its SQL
+        """
+        with self.assertLogs('insurance.metrics', 'WARNING') as logs:
+            self.client.get(f'{self.url}?name=Volvo')
+        self.assertIn(f'GET {self.url} (api:risk-records-list)', logs.output[0])
+        self.assertIn('FROM "insurance_tractor" WHERE "insurance_tractor"."name" = %s', logs.output[0])
+
+
+class RecordApiTest(APITestCase):
+    storage = Risk.TABLE
+    # Enums stored as their labels, the way they were before EnumField
+    enum_field_type, enum_kwargs = 'CharField', {'choices': True, 'max_length': 20, 'null': True}
+
+    def setUp(self):
+        """
+        Create a risk with an enum field and its table
+        """
+        self.client.force_authenticate(User.objects.create_superuser('api_test', '123'))
+        self.risk = Risk.objects.create(name='Truck', description='truck risk model', storage=self.storage)
+        RiskField.objects.create(name='name', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 25, 'null': True})
+        RiskField.objects.create(name='no_seats', field_type='IntegerField', risk=self.risk, kwargs={'null': True})
+        self.vehicle_class = RiskField.objects.create(name='vehicle_class', field_type=self.enum_field_type,
+                                                      risk=self.risk, kwargs=self.enum_kwargs)
+        # Created in label order, the codes of the choices sort like the labels then
+        self.vehicle_class.choices.set(EnumChoice.objects.bulk_create([EnumChoice(choice='Heavy', value='heavy'),
+                                                                       EnumChoice(choice='Light', value='light')]))
+        SchemaBuilder(self.risk.get_django_model()).create_db_table()
+        self.url = f'/api/v1/risks/{self.risk.id}/records/'
+
+    def test_create_and_retrieve_record(self):
+        """
+        Test a record is written to and read from the dynamic table
+        """
+        response = self.client.post(self.url, {'name': 'Volvo', 'no_seats': 2, 'vehicle_class': 'heavy'},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(f"{self.url}{response.json()['id']}/")
+        self.assertEqual(response.json()['name'], 'Volvo')
+        self.assertEqual(response.json()['vehicle_class'], 'heavy')
+
+    def test_enum_choice_validation(self):
+        """
+        Test enum values outside the field choices are rejected
+        """
+        response = self.client.post(self.url, {'name': 'Volvo', 'vehicle_class': 'boat'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('vehicle_class', response.json())
+
+    def test_bulk_create_and_update(self):
+        """
+        Test records are created and updated in bulk
+        """
+        records = [{'name': f'Truck {i}', 'no_seats': i, 'vehicle_class': 'light'} for i in range(25)]
+        response = self.client.post(f'{self.url}bulk/', records, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'created': 25})
+        model = self.risk.get_django_model()
+        updates = [{'id': record.id, 'no_seats': 10} for record in model.objects.all()[:5]]
+        response = self.client.patch(f'{self.url}bulk/', updates, format='json')
+        self.assertEqual(response.json(), {'updated': 5})
+        self.assertEqual(model.objects.filter(no_seats=10).count(), 6)
+        response = self.client.patch(f'{self.url}bulk/', [{'id': 0, 'no_seats': 1}], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_records(self):
+        """
+        Test records are listed with cursor pagination
+        """
+        self.risk.get_django_model().objects.create(name='Scania', no_seats=3)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record['name'] for record in response.json()['results']], ['Scania'])
+
+    def test_query_records(self):
+        """
+        Test records are filtered, ordered and paged by keyset through nulls and ties
+        """
+        model = self.risk.get_django_model()
+        model.objects.bulk_create([model(name=f'Truck {i}', no_seats=i % 3 or None) for i in range(10)])
+        query = {'no_seats__isnull': 'false', 'name__in': 'Truck 1,Truck 2,Truck 4,Truck 5'}
+        response = self.client.get(self.url, dict(query, ordering='-no_seats'))
+        self.assertEqual([record['name'] for record in response.json()['results']],
+                         ['Truck 2', 'Truck 5', 'Truck 1', 'Truck 4'])
+        names, url = [], self.url
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                response = self.client.get(url, {'ordering': 'no_seats', 'page_size': 3} if url == self.url else None)
+                names += [record['name'] for record in response.json()['results']]
+                url = response.json()['next']
+        self.assertEqual(names, ['Truck 1', 'Truck 4', 'Truck 7', 'Truck 2', 'Truck 5', 'Truck 8',
+                                 'Truck 0', 'Truck 3', 'Truck 6', 'Truck 9'])
+        self.assertNotIn('OFFSET', queries[-1]['sql'])
+        response = self.client.get(self.url, {'no_seats__gt': 'many', 'colour': 'red', 'ordering': 'age'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()), {'no_seats__gt', 'colour', 'ordering'})
+
+    def test_aggregate_records(self):
+        """
+        Test records are grouped by enum and date bucket with statistics computed in one query
+        """
+        RiskField.objects.create(name='bought', field_type='DateField', risk=self.risk, kwargs={'null': True})
+        model = self.risk.get_django_model()
+        model.objects.bulk_create([
+            model(vehicle_class='light', no_seats=2, bought=date(2020, 1, 5)),
+            model(vehicle_class='light', no_seats=4, bought=date(2020, 1, 20)),
+            model(vehicle_class='heavy', no_seats=3, bought=date(2020, 2, 1)),
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'{self.url}aggregate/', {'group_by': 'vehicle_class,bought:month',
+                                                                 'metrics': 'count,avg:no_seats,p50:no_seats',
+                                                                 'no_seats__gte': 2})
+        self.assertEqual(response.json(), [
+            {'vehicle_class': 'heavy', 'bought_month': '2020-02-01', 'count': 1, 'avg_no_seats': 3.0,
+             'p50_no_seats': 3.0},
+            {'vehicle_class': 'light', 'bought_month': '2020-01-01', 'count': 2, 'avg_no_seats': 3.0,
+             'p50_no_seats': 3.0},
+        ])
+        self.assertEqual(sum('GROUP BY' in query['sql'] for query in queries), 1)
+        response = self.client.get(f'{self.url}aggregate/', {'group_by': 'name:month', 'metrics': 'avg:name'})
+        self.assertEqual(set(response.json()), {'group_by', 'metrics'})
+        # Result keys that are the names of fields
+        RiskField.objects.create(name='bought_year', field_type='IntegerField', risk=self.risk, kwargs={'null': True})
+        RiskField.objects.create(name='sum_no_seats', field_type='IntegerField', risk=self.risk,
+                                 kwargs={'null': True})
+        response = self.client.get(f'{self.url}aggregate/', {'group_by': 'bought:year', 'metrics': 'sum:no_seats'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'group_by': ['Result key clashes with a field or group: bought_year'],
+                                           'metrics': ['Result key clashes with a field or group: sum_no_seats']})
+
+    @override_settings(AGGREGATION_CACHE_TIMEOUT=60)
+    def test_aggregation_cache(self):
+        """
+        Test cached aggregations are served until records are written
+        """
+        url = f'{self.url}aggregate/?metrics=sum:no_seats'
+        self.client.post(self.url, {'name': 'Volvo', 'no_seats': 2}, format='json')
+        self.assertEqual(self.client.get(url).json(), [{'sum_no_seats': 2}])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([query for query in queries if 'SUM' in query['sql']])
+        self.client.post(f'{self.url}bulk/', [{'name': 'Scania', 'no_seats': 3}], format='json')
+        self.assertEqual(self.client.get(url).json(), [{'sum_no_seats': 5}])
+
+    def test_export_records(self):
+        """
+        Test records are streamed as NDJSON and CSV with projection and since
+        """
+        model = self.risk.get_django_model()
+        first = model.objects.create(name='Scania', no_seats=3)
+        model.objects.create(name='Volvo', no_seats=2)
+        response = self.client.get(f'{self.url}export/', {'fields': 'id,name', 'since': first.id})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Volvo'])
+        self.assertEqual(set(json.loads(lines[0])), {'id', 'name'})
+        response = self.client.get(f'{self.url}export/', {'output': 'csv', 'fields': 'name,no_seats'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, ['name,no_seats', 'Scania,3', 'Volvo,2'])
+        response = self.client.get(f'{self.url}export/', {'fields': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_records(self):
+        """
+        Test valid rows are copied into the table and invalid ones rejected
+        """
+        stream = io.StringIO('name,no_seats,vehicle_class\n'
+                             'Scania,3,heavy\n'
+                             'Volvo,,\n'
+                             'Man,three,light\n'
+                             'Daf,2,boat\n')
+        rejects = io.StringIO()
+        stats = import_records(self.risk, stream, 'csv', batch_size=1, rejects=rejects)
+        self.assertEqual((stats['loaded'], stats['rejected']), (2, 2))
+        model = self.risk.get_django_model()
+        self.assertEqual(list(model.objects.order_by('id').values_list('name', 'no_seats', 'vehicle_class')),
+                         [('Scania', 3, 'heavy'), ('Volvo', None, None)])
+        rejected = [json.loads(line) for line in rejects.getvalue().splitlines()]
+        self.assertEqual([(row['line'], list(row['errors'])) for row in rejected],
+                         [(4, ['no_seats']), (5, ['vehicle_class'])])
+
+
+class DocumentRecordApiTest(RecordApiTest):
+    """
+    The record API tests run against a risk stored as documents
+    """
+    storage = Risk.DOCUMENT
+
+    def test_records_are_documents(self):
+        """
+        Test records are rows of RiskRecord keyed by field id and schema changes run no DDL
+        """
+        model = self.risk.get_django_model()
+        record = model.objects.create(name='Volvo', no_seats=2)
+        field = RiskField.objects.get(risk=self.risk, name='no_seats')
+        self.assertEqual(RiskRecord.objects.get(pk=record.pk).document[str(field.id)], 2)
+        with CaptureQueriesContext(connection) as queries:
+            field.name = 'seats'
+            field.save()
+            RiskField.objects.create(name='bought', field_type='DateField', risk=self.risk, kwargs={'null': True})
+        self.assertFalse([query for query in queries if 'ALTER' in query['sql']])
+        response = self.client.get(self.url, {'seats': 2})
+        self.assertEqual([(r['name'], r['seats'], r['bought']) for r in response.json()['results']],
+                         [('Volvo', 2, None)])
+        # Values of another type read as null, like a failed column conversion
+        field.field_type, field.kwargs = 'DateField', {'null': True}
+        field.save()
+        self.assertEqual(self.client.get(self.url).json()['results'][0]['seats'], None)
+        # Numbers stored before the field became text read and filter as their text
+        field.field_type, field.kwargs = 'CharField', {'max_length': 10, 'null': True}
+        field.save()
+        self.risk.get_django_model().objects.create(name='Saab', seats='2')
+        response = self.client.get(self.url, {'seats': '2'})
+        self.assertEqual([(r['name'], r['seats']) for r in response.json()['results']],
+                         [('Volvo', '2'), ('Saab', '2')])
+        self.assertEqual(len(self.client.get(self.url, {'seats': '3'}).json()['results']), 0)
+
+    def test_equality_uses_containment(self):
+        """
+        Test equality filters compile to a JSON containment the GIN index serves
+        """
+        query = str(RecordQuery(self.risk.get_django_model(), {'name': 'Volvo'}).get_queryset().query)
+        self.assertIn('"document" @>', query)
+
+
+class EnumRecordApiTest(RecordApiTest):
+    """
+    The record API tests run against enums stored as small integer codes
+    """
+    enum_field_type, enum_kwargs = 'EnumField', {'null': True}
+
+    def get_stored_values(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT vehicle_class FROM insurance_truck ORDER BY id')
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_enums_are_codes(self):
+        """
+        Test labels are stored as the codes of their choices, filtered by label and validated in memory
+        """
+        self.client.post(self.url, {'name': 'Volvo', 'vehicle_class': 'heavy'}, format='json')
+        self.assertEqual(self.get_stored_values(), [1])
+        self.assertEqual([record['vehicle_class'] for record in self.client.get(self.url).json()['results']],
+                         ['heavy'])
+        response = self.client.get(self.url, {'vehicle_class': 'heavy'})
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertEqual(self.client.get(self.url, {'vehicle_class': 'boat'}).status_code, 400)
+        model = self.risk.get_django_model()
+        serializer_class = get_record_serializer(model)
+        with self.assertNumQueries(0):
+            self.assertFalse(serializer_class(data={'vehicle_class': 'boat'}).is_valid())
+        # A new choice rebuilds the model with its code map
+        self.vehicle_class.choices.add(EnumChoice.objects.create(choice='Medium', value='medium'))
+        response = self.client.post(self.url, {'name': 'Scania', 'vehicle_class': 'medium'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNot(self.risk.get_django_model(), model)
+
+    def test_codes_per_field(self):
+        """
+        Test the codes number the choices of each field, are kept for removed choices and never reused
+        """
+        medium = EnumChoice.objects.create(choice='Medium', value='medium')
+        self.vehicle_class.choices.add(medium)
+        response = self.client.post(self.url, {'name': 'Scania', 'vehicle_class': 'medium'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get_stored_values(), [3])
+        self.vehicle_class.choices.remove(medium)
+        self.assertIsNone(self.client.get(self.url).json()['results'][0]['vehicle_class'])
+        self.vehicle_class.choices.add(medium)
+        self.assertEqual(self.client.get(self.url).json()['results'][0]['vehicle_class'], 'medium')
+        medium.delete()
+        trailer = EnumChoice.objects.create(choice='Trailer', value='trailer')
+        self.vehicle_class.choices.add(trailer)
+        self.assertEqual(dict(get_codes_queryset(self.vehicle_class.id)), {'heavy': 1, 'light': 2, 'trailer': 4})
+        other = RiskField.objects.create(name='trailer_class', field_type='EnumField', risk=self.risk,
+                                         kwargs={'null': True})
+        other.choices.add(trailer)
+        self.assertEqual(dict(get_codes_queryset(other.id)), {'trailer': 1})
+        # The codes of a field fit a smallint
+        EnumCode.objects.filter(risk_field=other).update(code=MAX_CODE)
+        light = EnumChoice.objects.get(value='light')
+        with self.assertRaises(ValidationError), transaction.atomic():
+            other.choices.add(light)
+        self.assertEqual(other.choices.count(), 1)
+
+    def test_text_enums_are_converted(self):
+        """
+        Test enums stored as labels are turned into codes and back, keeping the values
+        """
+        self.risk.get_django_model().objects.create(name='Volvo', vehicle_class='light')
+        self.vehicle_class.field_type, self.vehicle_class.kwargs = 'CharField', RecordApiTest.enum_kwargs
+        self.vehicle_class.save()
+        self.assertEqual(self.get_stored_values(), ['light'])
+        out = io.StringIO()
+        call_command('compact_enums', str(self.risk.id), stdout=out)
+        self.assertEqual(out.getvalue(), 'Truck: vehicle_class\n')
+        self.assertEqual(self.get_stored_values(), [2])
+        self.assertEqual(RiskField.objects.get(pk=self.vehicle_class.pk).kwargs, {'null': True})
+        self.assertEqual(self.client.get(self.url).json()['results'][0]['vehicle_class'], 'light')
+
+
+class DocumentIndexTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a document risk to index
+        """
+        self.risk = Risk.objects.create(name='Truck', description='truck risk model', storage=Risk.DOCUMENT)
+        with SchemaBuilder.change_set(self.risk, create_table=True):
+            self.status = RiskField.objects.create(name='status', field_type='CharField', risk=self.risk,
+                                                   kwargs={'max_length': 10, 'null': True})
+            self.seats = RiskField.objects.create(name='seats', field_type='IntegerField', risk=self.risk,
+                                                  kwargs={'null': True, 'unique': True})
+
+    def tearDown(self):
+        self.risk.delete()
+
+    def get_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname LIKE %s',
+                           ['insurance_riskrecord', f'insurance_r{self.risk.id}_%'])
+            return dict(cursor.fetchall())
+
+    def test_expression_indexes(self):
+        """
+        Test indexed and unique fields get expression indexes partial on the risk, kept through renames
+        """
+        unique = f'insurance_r{self.risk.id}_f{self.seats.id}_uniq'
+        self.assertIn('CREATE UNIQUE INDEX', self.get_indexes()[unique])
+        self.seats.kwargs = {'null': True, 'unique': True, 'db_index': True, 'index_condition': {'status': 'active'}}
+        self.seats.save()
+        name = self.seats.get_index_name()
+        definition = self.get_indexes()[name]
+        self.assertIn(f"->> '{self.seats.id}'::text))::integer", definition)
+        self.assertIn(f"(risk_id = {self.risk.id}) AND (document @> ", definition)
+        self.status.name = 'state'
+        self.status.save()
+        self.assertEqual(self.get_indexes()[name], definition)
+        model = self.risk.get_django_model()
+        model.objects.create(state='active', seats=2)
+        response = APIClient().get(f'/api/v1/risks/{self.risk.id}/records/', {'seats__gte': 2, 'state': 'active'})
+        self.assertEqual(len(response.json()['results']), 1)
+        with self.assertRaises(IntegrityError):
+            model.objects.create(state='idle', seats=2)
+        self.seats.delete()
+        self.assertEqual(self.get_indexes(), {})
+
+
+class SchemaDiffTest(SimpleTestCase):
+    def spec(self, key, name, field_type='IntegerField', **kwargs):
+        return FieldSpec(key, name, field_type, json.dumps(dict({'null': True}, **kwargs), sort_keys=True), None)
+
+    def test_unchanged_schema(self):
+        """
+        Test identical schemas and python-only kwargs produce no operation
+        """
+        old = (self.spec(1, 'age'), self.spec(2, 'name', 'CharField', max_length=20))
+        new = (self.spec(1, 'age', default='3'), self.spec(2, 'name', 'CharField', max_length=20, choices=True))
+        self.assertEqual(diff_schema(old, old), [])
+        self.assertEqual(diff_schema(old, new), [])
+
+    def test_operations_order(self):
+        """
+        Test drops come first, then renames and alters, then adds
+        """
+        old = (self.spec(1, 'age'), self.spec(2, 'name', 'CharField', max_length=20), self.spec(3, 'seats'))
+        new = (self.spec(1, 'years'), self.spec(2, 'name', 'CharField', max_length=40), self.spec(4, 'seats'))
+        self.assertEqual([(op.action, op.old and op.old.name, op.new and op.new.name)
+                          for op in diff_schema(old, new)],
+                         [('remove', 'seats', None), ('rename', 'age', 'years'),
+                          ('alter', 'name', 'name'), ('add', None, 'seats')])
+
+    def test_swapped_names(self):
+        """
+        Test swapping two column names goes through a temporary name
+        """
+        old = (self.spec(1, 'a'), self.spec(2, 'b'))
+        new = (self.spec(1, 'b'), self.spec(2, 'a'))
+        self.assertEqual([(op.old.name, op.new.name) for op in diff_schema(old, new)],
+                         [('a', 'a__tmp'), ('b', 'a'), ('a__tmp', 'b')])
+
+    def test_index_operations(self):
+        """
+        Test changed indexes are dropped first and created last, without touching the column
+        """
+        old = (self.spec(1, 'age', db_index=True), IndexSpec('age_idx', ('age',), None))
+        new = (self.spec(1, 'years', db_index=True), IndexSpec('age_idx', ('years',), None))
+        self.assertEqual([op.action for op in diff_schema(old, new)], ['remove_index', 'rename', 'add_index'])
+        self.assertEqual(diff_schema(old, old[:1] + (IndexSpec('age_idx', ('age',), None),)), [])
+
+
+class AsyncApiTest(TransactionTestCase):
+    storage = Risk.TABLE
+    enum_field_type, enum_kwargs = RecordApiTest.enum_field_type, RecordApiTest.enum_kwargs
+
+    def setUp(self):
+        """
+        Create a risk with an enum field and its table, committed for the connections of the async views
+        """
+        self.risk = Risk.objects.create(name='Van', description='van risk model', storage=self.storage)
+        RiskField.objects.create(name='name', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 25, 'null': True})
+        vehicle_class = RiskField.objects.create(name='vehicle_class', field_type=self.enum_field_type,
+                                                 risk=self.risk, kwargs=self.enum_kwargs)
+        vehicle_class.choices.set(EnumChoice.objects.bulk_create([EnumChoice(choice='Light', value='light'),
+                                                                  EnumChoice(choice='Heavy', value='heavy')]))
+        SchemaBuilder(self.risk.get_django_model()).create_db_table()
+        self.async_client.force_login(User.objects.create_superuser('async_test', '123'))
+        self.url = f'/api/v1/async/risks/{self.risk.id}/records/'
+
+    def tearDown(self):
+        self.risk.delete()
+
+    def post(self, client, data):
+        # The async test client of Django 3.1.3 sends a broken Content-Length, build the request here
+        body = json.dumps(data).encode()
+        return client.generic('POST', self.url, _body_file=FakePayload(body), headers=[
+            (b'host', b'testserver'), (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ])
+
+    async def test_async_risks_and_records(self):
+        """
+        Test the async endpoints list risks like the sync ones and write and page through records
+        """
+        try:
+            # Same envelope, cursors and order of fields and choices as the sync view
+            for query in ('', '?page_size=1'):
+                expected = (await sync_to_async(self.client.get)(f'/api/v1/risks-fields/{query}')).json()
+                response = await self.async_client.get(f'/api/v1/async/risks-fields/{query}')
+                self.assertEqual(response.json(), dict(expected, next=expected['next'] and expected['next'].replace(
+                    '/risks-fields/', '/async/risks-fields/')))
+            # Same validators, answering 304 while the catalog is unchanged
+            self.assertEqual(response['ETag'], (await sync_to_async(self.client.get)('/api/v1/risks-fields/'))['ETag'])
+            self.assertTrue(response.has_header('Last-Modified'))
+            headers = [(b'host', b'testserver'), (b'if-none-match', response['ETag'].encode())]
+            cached = await self.async_client.get('/api/v1/async/risks-fields/', headers=headers)
+            self.assertEqual(cached.status_code, 304)
+            other = await sync_to_async(Risk.objects.create)(name='Bus', description='bus risk model')
+            response = await self.async_client.get('/api/v1/async/risks-fields/', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            try:
+                response = await self.async_client.get('/api/v1/async/risks-fields/?page_size=1')
+                self.assertEqual([risk['name'] for risk in response.json()['results']], ['Van'])
+                response = await self.async_client.get(response.json()['next'])
+                self.assertEqual([risk['name'] for risk in response.json()['results']], ['Bus'])
+                self.assertIsNone(response.json()['next'])
+                response = await self.async_client.get(response.json()['previous'])
+                self.assertEqual([risk['name'] for risk in response.json()['results']], ['Van'])
+            finally:
+                await sync_to_async(other.delete)()
+            response = await self.post(AsyncClient(), {'name': 'Ford'})
+            self.assertEqual(response.status_code, 403)
+            response = await self.post(self.async_client, {'name': 'Ford', 'vehicle_class': 'boat'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('vehicle_class', response.json())
+            for name in ('Ford', 'Audi'):
+                response = await self.post(self.async_client, {'name': name, 'vehicle_class': 'light'})
+                self.assertEqual(response.status_code, 201)
+            response = await self.async_client.get(f'{self.url}?ordering=name&page_size=1')
+            self.assertEqual([record['name'] for record in response.json()['results']], ['Audi'])
+            response = await self.async_client.get(response.json()['next'])
+            self.assertEqual(response.json(), {'next': None, 'results': [
+                {'id': response.json()['results'][0]['id'], 'name': 'Ford', 'vehicle_class': 'light'}]})
+            response = await self.async_client.get(f'{self.url}?colour=red')
+            self.assertEqual(response.status_code, 400)
+        finally:
+            close_pools()
+
+
+class EnumAsyncApiTest(AsyncApiTest):
+    """
+    The async API tests run against enums stored as small integer codes, whose code maps load without blocking
+    """
+    enum_field_type, enum_kwargs = EnumRecordApiTest.enum_field_type, EnumRecordApiTest.enum_kwargs
+
+
+class DocumentAsyncApiTest(AsyncApiTest):
+    """
+    The async API tests run against a risk stored as documents
+    """
+    storage = Risk.DOCUMENT
+
+
+class BenchmarkTest(TestCase):
+    def test_json_results(self):
+        """
+        Test the benchmark command writes its results and environment as JSON
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'benchmark.json')
+        call_command('benchmark', '--only', 'model_build', 'schema_changes', '--json', path, stdout=io.StringIO())
+        with open(path) as results_file:
+            results = json.load(results_file)
+        os.remove(path)
+        self.assertEqual(results['environment']['database'], connection.vendor)
+        self.assertEqual(set(results['suites']), {'model_build', 'schema_changes'})
+        self.assertEqual(set(results['suites']['model_build']['results']), {'10_fields', '50_fields', '200_fields'})
+        self.assertIn('alter_10000_rows', results['suites']['schema_changes']['results'])
+        self.assertFalse(Risk.objects.exists())
+
+    def test_load_test_needs_test_database(self):
+        """
+        Test the load test refuses to commit its data to a database other than a test one
+        """
+        with mock.patch.dict(connection.settings_dict, {'NAME': 'risk'}):
+            with self.assertRaisesMessage(CommandError, 'risk is not a test database'):
+                call_command('load_test', stdout=io.StringIO())
+        self.assertFalse(Risk.objects.exists())
+
+
+class OnlineSchemaTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a risk table holding a few records
+        """
+        self.risk = Risk.objects.create(name='Bike', description='bike risk model')
+        RiskField.objects.create(name='wheels', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 5, 'null': True})
+        self.model = self.risk.get_django_model()
+        SchemaBuilder(self.model).create_db_table()
+        self.model.objects.bulk_create([self.model(wheels=str(i)) for i in range(5)])
+        self.stages = []
+        self.options = {'batch_size': 2, 'pause': 0, 'progress': lambda *args: self.stages.append(args[0])}
+
+    def tearDown(self):
+        self.risk.delete()
+
+    def get_column(self, name):
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, self.model._meta.db_table)
+        return next(column for column in columns if column.name == name)
+
+    def test_add_not_null_field_online(self):
+        """
+        Test a NOT NULL column with default is added nullable, backfilled then constrained
+        """
+        field = models.IntegerField(default=4)
+        field.set_attributes_from_name('seats')
+        SchemaBuilder(self.model).add_field(None, field, online=True, **self.options)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT DISTINCT seats FROM {self.model._meta.db_table}')
+            self.assertEqual(cursor.fetchall(), [(4,)])
+        self.assertFalse(self.get_column('seats').null_ok)
+        self.assertEqual(self.stages.count(f'backfill {self.model._meta.db_table}.seats'), 3)
+
+    def test_change_type_online(self):
+        """
+        Test a type change goes through a shadow column and keeps the data
+        """
+        old_field = self.model._meta.get_field('wheels')
+        new_field = models.IntegerField(null=True)
+        new_field.set_attributes_from_name('wheels')
+        SchemaBuilder(self.model).alter_field(old_field, new_field, online=True, **self.options)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT wheels FROM {self.model._meta.db_table} ORDER BY wheels')
+            self.assertEqual([row[0] for row in cursor.fetchall()], [0, 1, 2, 3, 4])
+            cursor.execute('SELECT COUNT(*) FROM pg_trigger WHERE tgname LIKE %s', ['%wheels_sync'])
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(self.get_column('wheels').type_code, self.get_column('id').type_code)
+
+    def test_change_type_online_failure(self):
+        """
+        Test a failed type change leaves the table as it was, without trigger nor shadow column
+        """
+        old_field = self.model._meta.get_field('wheels')
+        new_field = models.IntegerField(null=True)
+        new_field.set_attributes_from_name('wheels')
+        self.model.objects.create(wheels='four')
+        with self.assertRaises(DataError):
+            SchemaBuilder(self.model).alter_field(old_field, new_field, online=True, **self.options)
+        # Simulate a non-convertible value written while the backfill runs
+        with mock.patch.object(OnlineSchemaEditor, 'backfill', side_effect=DataError):
+            self.model.objects.filter(wheels='four').delete()
+            with self.assertRaises(DataError):
+                SchemaBuilder(self.model).alter_field(old_field, new_field, online=True, **self.options)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM pg_trigger WHERE tgname LIKE %s', ['%wheels_sync'])
+            self.assertEqual(cursor.fetchone()[0], 0)
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, self.model._meta.db_table)
+        self.assertEqual({column.name for column in columns}, {'id', 'wheels'})
+        self.model.objects.create(wheels='8')
+
+    def test_change_type_online_keeps_field_indexes(self):
+        """
+        Test the indexes of the RiskFields over a converted column, composite ones included, are rebuilt
+        """
+        wheels = RiskField.objects.get(risk=self.risk, name='wheels')
+        with SchemaBuilder.change_set(self.risk):
+            wheels.kwargs = dict(wheels.kwargs, db_index=True)
+            wheels.save()
+            seats = RiskField.objects.create(name='seats', field_type='IntegerField', risk=self.risk,
+                                             kwargs={'null': True, 'db_index': True, 'index_with': ['wheels']})
+        names = {wheels.get_index_name(), seats.get_index_name()}
+        with SchemaBuilder.change_set(self.risk, online=True):
+            wheels.field_type, wheels.kwargs = 'IntegerField', {'null': True, 'db_index': True}
+            wheels.save()
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, 'insurance_bike')
+        self.assertEqual({name: constraints[name]['columns'] for name in names if name in constraints},
+                         {wheels.get_index_name(): ['wheels'], seats.get_index_name(): ['seats', 'wheels']})
+        self.assertEqual(self.get_column('wheels').type_code, self.get_column('id').type_code)
+
+    def test_change_type_online_keeps_constraints(self):
+        """
+        Test the index and the unique constraint of a field are rebuilt on the converted column
+        """
+        for kwargs in ({'db_index': True}, {'unique': True}):
+            old_field = self.model._meta.get_field('wheels')
+            new_field = models.CharField(max_length=5, null=True, **kwargs)
+            new_field.set_attributes_from_name('wheels')
+            SchemaBuilder(self.model).alter_field(old_field, new_field, online=True, **self.options)
+            old_field, new_field = new_field, models.IntegerField(null=True, **kwargs)
+            new_field.set_attributes_from_name('wheels')
+            SchemaBuilder(self.model).alter_field(old_field, new_field, online=True, **self.options)
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, self.model._meta.db_table)
+            wheels = [c for c in constraints.values() if c['columns'] == ['wheels']]
+            # A unique constraint is not reported as an index
+            self.assertEqual([c['unique'] for c in wheels], ['unique' in kwargs])
+            # Back to the original column for the next round
+            SchemaBuilder(self.model).alter_field(new_field, self.model._meta.get_field('wheels'), online=True,
+                                                  **self.options)
+
+
+class IndexTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a risk table to index
+        """
+        self.risk = Risk.objects.create(name='Truck', description='truck risk model')
+        with SchemaBuilder.change_set(self.risk, create_table=True):
+            self.status = RiskField.objects.create(name='status', field_type='CharField', risk=self.risk,
+                                                   kwargs={'max_length': 10, 'null': True})
+            self.bought = RiskField.objects.create(name='bought', field_type='DateField', risk=self.risk,
+                                                   kwargs={'null': True})
+
+    def tearDown(self):
+        self.risk.delete()
+
+    def get_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname != %s',
+                           ['insurance_truck', 'insurance_truck_pkey'])
+            return dict(cursor.fetchall())
+
+    def test_composite_partial_index(self):
+        """
+        Test an index spanning fields with a condition is created, follows renames and drops deleted fields
+        """
+        self.bought.kwargs = {'null': True, 'db_index': True, 'index_with': ['status'],
+                              'index_condition': {'status': 'active'}}
+        self.bought.save()
+        name = self.bought.get_index_name()
+        self.assertIn('(bought, status) WHERE ((status)::text = \'active\'::text)', self.get_indexes()[name])
+        model = self.risk.get_django_model()
+        self.assertFalse(model._meta.get_field('bought').db_index)
+        self.assertEqual([index.name for index in model._meta.indexes], [name])
+        self.status.name = 'state'
+        self.status.save()
+        self.assertEqual(RiskField.objects.get(pk=self.bought.pk).kwargs['index_with'], ['state'])
+        self.assertIn('(bought, state) WHERE ((state)::text', self.get_indexes()[name])
+        RiskField.objects.get(pk=self.status.pk).delete()
+        self.assertTrue(self.get_indexes()[name].endswith('(bought)'))
+        bought = RiskField.objects.get(pk=self.bought.pk)
+        bought.kwargs = {'null': True}
+        bought.save()
+        self.assertEqual(self.get_indexes(), {})
+
+
+class PartitionTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a risk table partitioned by month on a date field
+        """
+        self.risk = Risk.objects.create(name='Auto', description='auto risk model', partitioning={
+            'method': 'range', 'field': 'bought', 'ahead': 1, 'retention': 2})
+        with SchemaBuilder.change_set(self.risk, create_table=True):
+            self.bought = RiskField.objects.create(name='bought', field_type='DateField', risk=self.risk,
+                                                   kwargs={'default': '2026-01-01', 'null': False})
+            self.plate = RiskField.objects.create(name='plate', field_type='CharField', risk=self.risk,
+                                                  kwargs={'max_length': 10, 'null': True})
+        self.model = self.risk.get_django_model()
+        self.manager = PartitionManager(self.model, self.risk.get_partitioning())
+
+    def tearDown(self):
+        self.risk.delete()
+
+    def get_columns(self, table):
+        with connection.cursor() as cursor:
+            return {column.name: column for column in connection.introspection.get_table_description(cursor, table)}
+
+    def test_range_partitions(self):
+        """
+        Test the table is split by month, rows out of the partitions wait in the default one until created
+        """
+        today = timezone.localdate()
+        self.assertTrue(is_partitioned('insurance_auto'))
+        self.assertEqual(sorted(start for start, end in self.manager.range_partitions().values()),
+                         [today.replace(day=1), add_intervals(today.replace(day=1), 'month', 1)])
+        self.model.objects.create(bought=today, plate='A')
+        self.model.objects.create(bought=date(2020, 1, 15), plate='B')
+        self.assertEqual(self.manager.maintain(date(2020, 1, 20))['created'],
+                         ['insurance_auto_p202001', 'insurance_auto_p202002'])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT plate FROM insurance_auto_p202001')
+            self.assertEqual(cursor.fetchall(), [('B',)])
+            cursor.execute('SELECT COUNT(*) FROM insurance_auto_default')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        changes = self.manager.maintain(today)
+        self.assertEqual(changes, {'created': [], 'dropped': ['insurance_auto_p202001', 'insurance_auto_p202002']})
+        self.assertEqual(list(self.model.objects.values_list('plate', flat=True)), ['A'])
+
+    def test_field_changes_reach_partitions(self):
+        """
+        Test columns and indexes added or altered on the table are on every partition
+        """
+        RiskField.objects.create(name='seats', field_type='IntegerField', risk=self.risk,
+                                 kwargs={'default': 4, 'null': False})
+        self.plate.kwargs = {'max_length': 20, 'null': True, 'db_index': True}
+        self.plate.save()
+        for table in self.manager.partitions():
+            columns = self.get_columns(table)
+            self.assertFalse(columns['seats'].null_ok)
+            self.assertEqual(columns['plate'].internal_size, 20)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE tablename = %s AND indexdef LIKE '%%(plate)'",
+                               [table])
+                self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_partition_key_is_kept(self):
+        """
+        Test the date field partitioning the table can be renamed but neither removed nor made nullable
+        """
+        with self.assertRaises(ValidationError):
+            self.bought.delete()
+        self.bought.kwargs = {'default': '2026-01-01', 'null': True}
+        with self.assertRaises(ValidationError):
+            self.bought.clean()
+        self.bought.kwargs = {'default': '2026-01-01', 'null': False}
+        self.bought.name = 'purchased'
+        self.bought.save()
+        self.assertEqual(Risk.objects.get(pk=self.risk.pk).get_partitioning().field, 'purchased')
+        out = io.StringIO()
+        call_command('manage_partitions', '--today', '2020-01-01', stdout=out)
+        self.assertIn(f'Risk {self.risk.id}: created insurance_auto_p202001, insurance_auto_p202002', out.getvalue())
+
+    def test_hash_partitions(self):
+        """
+        Test a table partitioned by hash on the id gets NOT NULL columns added online on every partition
+        """
+        risk = Risk.objects.create(name='Fleet', description='fleet risk model',
+                                   partitioning={'method': 'hash', 'partitions': 4})
+        with SchemaBuilder.change_set(risk, create_table=True):
+            RiskField.objects.create(name='size', field_type='IntegerField', risk=risk, kwargs={'null': True})
+        model = risk.get_django_model()
+        model.objects.bulk_create([model(size=i) for i in range(20)])
+        manager = PartitionManager(model, risk.get_partitioning())
+        self.assertEqual(len(manager.partitions()), 4)
+        field = models.IntegerField(default=1)
+        field.set_attributes_from_name('trucks')
+        SchemaBuilder(model).add_field(None, field, online=True, pause=0)
+        for table in manager.partitions():
+            self.assertFalse(self.get_columns(table)['trucks'].null_ok)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM insurance_fleet WHERE trucks = 1')
+            self.assertEqual(cursor.fetchone()[0], 20)
+        risk.delete()
+
+
+class CatalogTest(APITestCase):
+    def setUp(self):
+        """
+        Define a catalog of two risks, one with an enum
+        """
+        self.catalog = {'risks': [
+            {'name': 'Boat', 'description': 'boat risk model', 'storage': 'table', 'partitioning': {},
+             'database': '', 'db_schema': '', 'fields': [
+                {'name': 'hull', 'field_type': 'CharField', 'kwargs': {'max_length': 10, 'null': True}},
+                {'name': 'kind', 'field_type': 'EnumField', 'kwargs': {'null': True},
+                 'choices': [{'choice': 'Sail', 'value': 'sail'}, {'choice': 'Motor', 'value': 'motor'}]},
+            ]},
+            {'name': 'Plane', 'description': 'plane risk model', 'storage': 'table', 'partitioning': {},
+             'database': '', 'db_schema': '', 'fields': [
+                {'name': 'built', 'field_type': 'DateField', 'kwargs': {'default': '2020-01-01', 'null': False}},
+            ]},
+        ]}
+
+    def test_import_and_export(self):
+        """
+        Test a catalog creates the risks and their tables, exports back the same and is diffed when imported again
+        """
+        changes = import_catalog(self.catalog)
+        self.assertEqual((changes['created'], changes['altered']), (['Boat', 'Plane'], {}))
+        boat = Risk.objects.get(name='Boat')
+        model = boat.get_django_model()
+        model.objects.create(hull='wood', kind='motor')
+        self.assertEqual(list(model.objects.values_list('hull', 'kind')), [('wood', 'motor')])
+        self.assertEqual(export_catalog()['risks'], self.catalog['risks'])
+        self.assertEqual(import_catalog(self.catalog)['altered'], {})
+        boat_data = self.catalog['risks'][0]
+        boat_data['description'] = 'boats'
+        boat_data['fields'][0]['kwargs'] = {'max_length': 30, 'null': True}
+        boat_data['fields'].append({'name': 'length', 'field_type': 'IntegerField', 'kwargs': {'null': True}})
+        del self.catalog['risks'][1]
+        changes = import_catalog(self.catalog, prune=True)
+        self.assertEqual(changes['altered'], {'Boat': {'added': ['length'], 'changed': ['hull'],
+                                                       'description': 'boats'}})
+        self.assertEqual(changes['deleted'], ['Plane'])
+        model = boat.get_django_model()
+        model.objects.create(hull='x' * 30, length=12)
+        self.assertEqual(model.objects.count(), 2)
+        self.assertFalse(Risk.objects.filter(name='Plane').exists())
+
+    def test_invalid_catalog(self):
+        """
+        Test every problem of a catalog is reported and nothing is imported
+        """
+        self.catalog['risks'][0]['fields'][1]['kwargs'] = {'default': 'oars'}
+        self.catalog['risks'][1]['fields'].append({'name': '1st', 'field_type': 'FloatField', 'kwargs': {}})
+        self.catalog['risks'][1]['partitioning'] = {'method': 'range', 'field': 'sold'}
+        with self.assertRaises(CatalogError) as context:
+            import_catalog(self.catalog)
+        self.assertEqual(context.exception.errors, [
+            'Boat: fields.kind: The default must be the value of one of the choices',
+            'Plane: fields.1st: name: Must start with an alphabetical character',
+            "Plane: fields.1st: field_type: Value 'FloatField' is not a valid choice.",
+        ])
+        del self.catalog['risks'][1]['fields'][1]
+        with self.assertRaises(CatalogError) as context:
+            import_catalog(self.catalog)
+        self.assertEqual(context.exception.errors[1], 'Plane: "sold" partitions the table, it has to be one of the '
+                                                      'fields, a date that is not null')
+        self.catalog['risks'][0]['fields'][1]['kwargs'] = {'null': True}
+        self.catalog['risks'][0]['fields'][0]['kwargs'].update(db_index=True, index_condition={'kind__near': 'sail'})
+        with self.assertRaises(CatalogError) as context:
+            import_catalog(self.catalog)
+        self.assertEqual(context.exception.errors[0],
+                         'Boat: fields.hull: Invalid lookup "kind__near": Unsupported lookup \'near\' for CharField '
+                         'or join on the field not permitted.')
+        self.assertFalse(Risk.objects.exists())
+
+    def test_api_and_commands(self):
+        """
+        Test the catalog is imported by staff users through the API, and exported and imported by the commands
+        """
+        response = self.client.post('/api/v1/catalog/', self.catalog, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.client.force_authenticate(User.objects.create_superuser('catalog_test', '123'))
+        response = self.client.post('/api/v1/catalog/?dry_run=1', self.catalog, format='json')
+        self.assertEqual((response.json()['created'], response.json()['dry_run']), (['Boat', 'Plane'], True))
+        self.assertFalse(Risk.objects.exists())
+        response = self.client.post('/api/v1/catalog/', {'risks': [{'name': 'Car'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.json())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.json')
+            with open(path, 'w') as catalog_file:
+                json.dump(self.catalog, catalog_file)
+            out = io.StringIO()
+            call_command('import_catalog', path, stdout=out)
+            self.assertIn('+ Boat\n+ Plane\n', out.getvalue())
+            path = os.path.join(directory, 'export.json')
+            call_command('export_catalog', 'Plane', '-o', path)
+            with open(path) as catalog_file:
+                self.assertEqual(json.load(catalog_file)['risks'], self.catalog['risks'][1:])
+        response = self.client.get('/api/v1/catalog/')
+        self.assertEqual([risk['name'] for risk in response.json()['risks']], ['Boat', 'Plane'])
+
+
+class PlacementTest(TransactionTestCase):
+    def setUp(self):
+        """
+        Create a risk whose table is in a schema of its own
+        """
+        self.risk = Risk.objects.create(name='Barge', description='barge risk model', db_schema='cargo')
+        with SchemaBuilder.change_set(self.risk, create_table=True):
+            RiskField.objects.create(name='tonnage', field_type='IntegerField', risk=self.risk, kwargs={'null': True})
+        self.model = self.risk.get_django_model()
+        self.model.objects.bulk_create([self.model(tonnage=i) for i in range(10)])
+
+    def tearDown(self):
+        self.risk.delete()
+        with connection.cursor() as cursor:
+            cursor.execute('DROP SCHEMA IF EXISTS cargo, moved CASCADE')
+        for alias in [alias for alias in connections.databases if alias != 'default']:
+            connections[alias].close()
+            del connections.databases[alias]
+
+    def get_schema(self, table='insurance_barge'):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT schemaname FROM pg_tables WHERE tablename = %s', [table])
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_placement_field_name(self):
+        """
+        Test a field named after the placement attribute neither replaces it nor loses its values
+        """
+        RiskField.objects.create(name='risk_placement', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 10, 'null': True})
+        model = self.risk.get_django_model()
+        self.assertEqual(router.db_for_write(model), 'default:cargo')
+        model.objects.create(tonnage=99, risk_placement='hold')
+        self.assertEqual(model.objects.get(tonnage=99).risk_placement, 'hold')
+        with self.assertRaises(ValidationError):
+            RiskField(name='__risk_placement__', field_type='CharField', risk=self.risk).clean()
+
+    def test_schema_placement(self):
+        """
+        Test the table, its field changes and records are in the schema of the risk, and moved out of it
+        """
+        self.assertEqual(self.get_schema(), ['cargo'])
+        self.assertEqual(router.db_for_write(self.model), 'default:cargo')
+        RiskField.objects.create(name='flag', field_type='CharField', risk=self.risk,
+                                 kwargs={'max_length': 10, 'null': True, 'db_index': True})
+        model = self.risk.get_django_model()
+        model.objects.create(tonnage=99, flag='NL')
+        self.assertEqual(model.objects.filter(flag='NL').count(), 1)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE schemaname = 'cargo' AND indexdef LIKE '%%(flag)'")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        out = io.StringIO()
+        call_command('move_risk', self.risk.id, stdout=out)
+        self.assertIn('Moved Barge from default:cargo to default', out.getvalue())
+        self.assertEqual(self.get_schema(), ['public'])
+        self.risk.refresh_from_db()
+        model = self.risk.get_django_model()
+        self.assertEqual(router.db_for_read(model), 'default')
+        self.assertEqual(model.objects.count(), 11)
+        self.assertEqual(model.objects.create(tonnage=1).id, 12)
+
+    def test_move_to_another_database(self):
+        """
+        Test the rows of a table are copied to a table created on another database, then the source is dropped
+        """
+        # Another alias of the test database, which connects to it by another host name
+        settings_dict = dict(connections['default'].settings_dict, HOST='127.0.0.1')
+        connections.databases['ingest'] = settings_dict
+        with self.assertRaises(CommandError):
+            call_command('move_risk', self.risk.id, '--database', 'missing')
+        kind = RiskField.objects.create(name='kind', field_type='EnumField', risk=self.risk, kwargs={'null': True})
+        tanker, dry = EnumChoice.objects.bulk_create([EnumChoice(choice='Tanker', value='tanker'),
+                                                      EnumChoice(choice='Dry', value='dry')])
+        kind.choices.set([tanker, dry])
+        self.risk.get_django_model().objects.filter(tonnage__lt=5).update(kind='tanker')
+        # The stored codes of a removed choice read as None until it is added back
+        kind.choices.remove(tanker)
+        self.assertTrue(move_risk(self.risk, 'ingest', 'moved', batch_size=3))
+        self.assertEqual(self.get_schema(), ['moved'])
+        model = self.risk.get_django_model()
+        self.assertEqual(router.db_for_write(model), 'ingest:moved')
+        self.assertEqual(list(model.objects.order_by('id').values_list('tonnage', flat=True)), list(range(10)))
+        self.assertEqual(model.objects.create(tonnage=10).id, 11)
+        kind.choices.add(tanker)
+        self.assertEqual(self.risk.get_django_model().objects.filter(kind='tanker').count(), 5)
+        self.assertFalse(move_risk(self.risk, 'ingest', 'moved'))
@@ -1,7 +1,10 @@
+from django.conf import settings
+from django.http import HttpResponseForbidden
 from django.shortcuts import render, HttpResponse, redirect, reverse
 from django.db import connection
 from django.db.utils import ProgrammingError
 from .models import *
+from .metrics import metrics as metrics_registry
 
 
 # Create your views here.
@@ -14,3 +17,10 @@ def handler500(request):
     response = render(request, '', {})
     response.status_code = 500
     return response
+
+
+def metrics(request):
+    "Prometheus text of the request metrics, for the addresses of INSURANCE_METRICS_ALLOWED_IPS only"
+    if request.META.get('REMOTE_ADDR') not in settings.INSURANCE_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')